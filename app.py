@@ -1,16 +1,33 @@
 import gradio as gr
 import os
+import threading
 from multi_tool_agent.gmail_agent_logic import (
     get_gmail_service,
+    invalidate_cached_mailbox,
+    invalidate_cached_message,
     search_emails,
     summarize_email_with_gemini,
     generate_reply_with_gemini,
-    send_reply,
     get_total_unread_count,
     get_emails_received_today_count,
     list_recent_emails
 )
 import google.generativeai as genai
+from multi_tool_agent.function_calling import build_tool, extract_function_calls
+from multi_tool_agent.planner import build_plan, execute_plan
+from multi_tool_agent.outbox import queue_reply, get_send_status
+from multi_tool_agent.attachments import summarize_attachment
+from multi_tool_agent.inbox_pager import get_inbox_pager
+from multi_tool_agent.mail_watcher import (
+    LabelChangeEvent, MailboxResyncEvent, MailEvent, MessageDeletedEvent, NewMessageEvent, get_mail_watcher,
+    mail_events, serve_push_endpoint, start_gmail_watch,
+)
+from multi_tool_agent.triage import get_triage_scorer
+from multi_tool_agent.profiling import PROFILE_ENABLED, profile_turn
+from multi_tool_agent.projection import wire_meter
+from multi_tool_agent import cassette
+from multi_tool_agent.resilience import dependency_status, gemini_breaker, guard_model, stale_note, STATE_OPEN
+from multi_tool_agent.routing import ROUTE_AGENT, ROUTE_TOOL, SENDING_AGENT, route_message
 from dotenv import load_dotenv
 import json # Import json for parsing LLM response
 
@@ -29,6 +46,13 @@ try:
 except Exception as e:
     print(f"FATAL: Error initializing Gemini model: {e}")
     gemini_model = None # Indicate model is not available
+# Record or replay Gemini traffic when GMAIL_AGENT_CASSETTE_MODE is set, and
+# put every call behind the Gemini circuit breaker and deadline.
+gemini_model = guard_model(cassette.wrap_model(gemini_model, 'gemini-1.5-flash'))
+
+# Controller mode: 'function_calling' (default, one round trip with native tool
+# calls) or 'json' (free-form JSON intent parsing).
+CONTROLLER_MODE = os.environ.get("GMAIL_AGENT_CONTROLLER", "function_calling").lower()
 
 # Initialize Gmail Service (Requires pre-existing token.json)
 # NOTE: The initial OAuth flow needs to happen *before* starting this app.
@@ -37,13 +61,14 @@ print("Attempting to build Gmail service...")
 gmail_service = get_gmail_service()
 if not gmail_service:
     print("WARNING: Failed to build Gmail service. Check token.json and credentials.json.")
-    # UI should reflect that Gmail functions are unavailable
+    # Tools retry building the service on each call and serve cached results meanwhile
 
 # --- State Management (Simple Demo) ---
 conversation_context = {
     "last_email_summary": None,
     "last_email_details": {}, # To store subject, body, sender, thread_id, etc.
     "last_reply_draft": None,
+    "last_outbox_id": None, # Outbox ID of the most recently queued reply
 }
 
 # --- LLM Prompt for Intent Recognition ---
@@ -54,9 +79,11 @@ Available intents and their required parameters:
 - LIST_RECENT: requires optional 'count' (integer, default 5) to list the most recent emails in the inbox.
 - SEARCH: requires 'query' (e.g., "from:a@b.com subject:hello")
 - SUMMARIZE_BY_ID: requires 'email_id'
+- SUMMARIZE_ATTACHMENT: optional 'email_id' (defaults to context['last_email_details']['id']) and optional 'filename'; summarizes a text, CSV or PDF attachment.
 - SUMMARIZE_LAST: requires context indicating a specific email (e.g., from a previous search or mention). Check context['last_email_details']['id'].
 - GENERATE_REPLY: requires 'reply_instructions' (what the user wants to say) and context from a previously summarized email (context['last_email_details'] required).
 - SEND_REPLY: requires confirmation (e.g., "yes", "send it") and context from a previously generated reply draft (context['last_reply_draft'] and context['last_email_details'] required).
+- GET_SEND_STATUS: optional 'outbox_id'; reports whether a queued reply has been sent (defaults to context['last_outbox_id']).
 - GET_UNREAD_COUNT: No parameters required.
 - GET_TODAY_EMAIL_COUNT: No parameters required.
 - GREETING/OTHER: if the intent is unclear, a simple greeting, or doesn't match the capabilities.
@@ -69,9 +96,10 @@ Current User message: "{user_message}"
 Current Context (JSON):
 {context_json}
 
-Based ONLY on the **Current User message** and the **Current Context**, determine the single most likely intent and extract the parameters.
+Based ONLY on the **Current User message** and the **Current Context**, determine the most likely intent and extract the parameters.
 
 Output your decision STRICTLY as a JSON object with 'intent' (string) and 'parameters' (dictionary) keys. If parameters are not applicable or derivable, use an empty dictionary {{}}.
+If the message asks for several things, output instead a JSON object with a 'plan' key holding a list of such objects in the order they should happen (use SUMMARIZE_LAST to act on an email found by an earlier step).
 Example for "list my last 3 emails": {{"intent": "LIST_RECENT", "parameters": {{"count": 3}}}}
 Example for "search for emails from test@test.com": {{"intent": "SEARCH", "parameters": {{"query": "from:test@test.com"}}}}
 Example for "summarize email with id 123": {{"intent": "SUMMARIZE_BY_ID", "parameters": {{"email_id": "123"}}}}
@@ -80,28 +108,407 @@ Example for "yes send it": {{"intent": "SEND_REPLY", "parameters": {{}}}}
 Example for "how many unread emails do I have": {{"intent": "GET_UNREAD_COUNT", "parameters": {{}}}}
 Example for "how many emails today": {{"intent": "GET_TODAY_EMAIL_COUNT", "parameters": {{}}}}
 Example for "hello there": {{"intent": "GREETING/OTHER", "parameters": {{}}}}
+Example for "how many unread do I have, and show the last 5 from boss@company.com": {{"plan": [{{"intent": "GET_UNREAD_COUNT", "parameters": {{}}}}, {{"intent": "SEARCH", "parameters": {{"query": "from:boss@company.com"}}}}]}}
 
 JSON Response:
 """
 
-# --- Chatbot Logic ---
-def handle_chat(message, history):
-    """
-    Processes user message using an LLM controller, interacts with Gmail/Gemini tools.
+# --- Intent Handlers ---
+# Shared by both controller modes: each handler runs one tool, updates the
+# conversation context and returns the text to show the user.
+def _format_email_list(emails):
+    email_strings = []
+    for email in emails:
+        email_str = (
+            f"Subject: {email.get('subject', 'N/A')}\n\n"  # Double newline
+            f"From: {email.get('from', 'N/A')}\n\n"      # Double newline
+            f"Date: {email.get('date', 'N/A')}"
+        )
+        email_strings.append(email_str)
+    # Join with Markdown horizontal rule separator
+    return "\n\n---\n\n".join(email_strings)
+
+
+def _most_recent(emails):
+    # Listings are ordered by priority; "the last email" means the newest one.
+    return min(emails, key=lambda email: email.get("recency", 0))
+
+
+def _with_stale_note(response_text, result):
+    # Results served from cache while Gmail/Gemini is down say so.
+    note = stale_note(result)
+    return f"{response_text}\n\n_{note}_" if note else response_text
+
+
+def handle_list_recent(count=5, context=None):
+    context = conversation_context if context is None else context
+    try:
+        count = int(count)
+    except (TypeError, ValueError):
+        count = 5 # Fallback if count is not a valid integer
+
+    list_result = list_recent_emails(user_id='me', max_results=count)
+    if list_result["status"] == "success" and list_result["emails"]:
+        response_text = (f"Here are your {len(list_result['emails'])} most recent emails, most important first:\n\n"
+                         + _format_email_list(list_result["emails"]))
+        response_text = _with_stale_note(response_text, list_result)
+        # Store the newest result for potential follow-up ("summarize the last email")
+        context["last_email_details"] = _most_recent(list_result["emails"])
+        context["last_reply_draft"] = None # Clear any old draft
+    elif list_result["status"] == "success":
+        response_text = "No emails found in your inbox."
+    else:
+        response_text = f"Error listing recent emails: {list_result.get('error_message', 'Unknown error')}"
+    return response_text
+
+
+def handle_search(query, context=None):
+    context = conversation_context if context is None else context
+    if not query:
+        return "My controller understood you want to search, but didn't find search criteria. Please specify (e.g., 'from:...' or 'subject:...')."
+    search_result = search_emails(query=query, user_id='me')
+    if search_result["status"] == "success" and search_result["emails"]:
+        response_text = _with_stale_note("Found emails, most important first:\n\n" + _format_email_list(search_result["emails"]), search_result)
+        # Store the newest match for potential follow-up
+        context["last_email_details"] = _most_recent(search_result["emails"])
+        context["last_reply_draft"] = None # Clear any old draft
+    elif search_result["status"] == "success":
+        response_text = "No emails found matching your query."
+    else:
+        response_text = f"Error searching emails: {search_result.get('error_message', 'Unknown error')}"
+    return response_text
+
+
+def handle_summarize(email_id, from_context=False, context=None):
+    context = conversation_context if context is None else context
+    used_context = from_context and not email_id
+    if used_context:
+        email_id = context.get("last_email_details", {}).get("id")
+    if not email_id:
+        if from_context:
+            return "I don't have a 'last email' in context to summarize. Please search for or specify an email first."
+        return "My controller understood you want to summarize by ID, but didn't find an ID. Please provide it."
+    summary_result = summarize_email_with_gemini(user_id='me', email_id=email_id)
+    if summary_result["status"] == "success":
+        if used_context:
+            response_text = f"Summary of the last mentioned email (ID: {email_id}):\n{summary_result['summary']}"
+        else:
+            response_text = f"Summary:\n{summary_result['summary']}"
+        response_text = _with_stale_note(response_text, summary_result)
+        context["last_email_summary"] = summary_result['summary']
+        context["last_email_details"] = summary_result # Store all details
+        context["last_reply_draft"] = None # Clear any old draft
+    else:
+        response_text = f"Error summarizing email {email_id}: {summary_result.get('error_message', 'Unknown error')}"
+    return response_text
+
+
+def handle_generate_reply(instructions="", reply_body="", context=None):
+    context = conversation_context if context is None else context
+    details = context.get("last_email_details", {})
+    original_body = details.get("original_body")
+
+    if not original_body:
+        return "I need the context of an email (specifically its body) to generate a reply. Please summarize an email first."
+
+    if not reply_body:
+        # Combine original body with user instructions for the prompt
+        generation_prompt_body = f"User wants reply to address: '{instructions}'\n\nOriginal Email Body:\n{original_body}"
+
+        reply_result = generate_reply_with_gemini(
+            original_subject=details.get("subject", "No Subject"),
+            original_body=generation_prompt_body
+        )
+        if reply_result["status"] != "success":
+            return f"Error generating reply draft: {reply_result.get('error_message', 'Unknown error')}"
+        reply_body = reply_result['reply_body']
+
+    context["last_reply_draft"] = reply_body # Store draft
+    return f"Draft Reply:\n------\n{reply_body}\n------\n\nWould you like me to send this reply?"
+
+
+def handle_send_reply(context=None):
+    context = conversation_context if context is None else context
+    details = context.get("last_email_details", {})
+    draft = context.get("last_reply_draft")
+
+    if (draft and details.get("sender_email") and details.get("subject") and
+        details.get("thread_id") and details.get("original_message_id")):
+
+        send_result = queue_reply(
+            user_id='me',
+            to=details["sender_email"],
+            sender='me',
+            subject=details["subject"],
+            reply_body=draft,
+            thread_id=details["thread_id"],
+            original_message_id=details["original_message_id"],
+            references=details.get("references", "")
+         )
+        if send_result["status"] == "success":
+            if send_result["duplicate"]:
+                response_text = f"This reply was already handed to the outbox (ID: {send_result['outbox_id']}, status: {send_result['send_status']}). It will not be sent twice."
+            else:
+                response_text = f"Reply queued for sending (ID: {send_result['outbox_id']}). It will go out in the background; ask me for its status anytime."
+            context["last_outbox_id"] = send_result["outbox_id"]
+            context["last_reply_draft"] = None # Clear draft after sending
+        else:
+            response_text = f"Error sending reply: {send_result.get('error_message', 'Unknown error')}"
+    elif not draft:
+        response_text = "There is no reply draft stored in context to send. Please generate one first."
+    else:
+        response_text = "I'm missing some details from the original email context (like sender, thread ID, or message ID) needed to send the reply. Please summarize the relevant email again."
+    return response_text
+
+
+def handle_summarize_attachment(email_id="", filename="", context=None):
+    context = conversation_context if context is None else context
+    email_id = email_id or context.get("last_email_details", {}).get("id")
+    if not email_id:
+        return "I need an email to look for attachments in. Please search for or specify an email first."
+    attachment_result = summarize_attachment(user_id='me', email_id=email_id, filename=filename or "")
+    if attachment_result["status"] == "success":
+        return f"Summary of attachment '{attachment_result['filename']}':\n{attachment_result['summary']}"
+    return f"Error summarizing attachment: {attachment_result.get('error_message', 'Unknown error')}"
+
+
+def handle_send_status(outbox_id="", context=None):
+    context = conversation_context if context is None else context
+    status_result = get_send_status(outbox_id or context.get("last_outbox_id") or "")
+    if status_result["status"] != "success":
+        return f"Error getting send status: {status_result.get('error_message', 'Unknown error')}"
+    entry = status_result["entry"]
+    response_text = f"Reply to '{entry.get('subject', 'N/A')}' is {entry['send_status']} (attempts: {entry.get('attempts', 0)})."
+    if entry.get("message_id"):
+        response_text += f" Message ID: {entry['message_id']}"
+    elif entry.get("error"):
+        response_text += f" Last error: {entry['error']}"
+    return response_text
+
+
+def handle_unread_count():
+    unread_result = get_total_unread_count(user_id='me')
+    if unread_result["status"] == "success":
+        return _with_stale_note(f"You have {unread_result['unread_count']} unread emails in your inbox.", unread_result)
+    return f"Error getting unread count: {unread_result.get('error_message', 'Unknown error')}"
+
+
+def handle_today_count():
+    today_count_result = get_emails_received_today_count(user_id='me')
+    if today_count_result["status"] == "success":
+        return _with_stale_note(
+            f"You received approximately {today_count_result['today_count']} emails in the last 24 hours.", today_count_result
+        )
+    return f"Error counting today's emails: {today_count_result.get('error_message', 'Unknown error')}"
+
+
+def handle_greeting():
+    # Simple response for greetings or unrecognized input
+    return "Hello! How can I help you with your Gmail today?"
+
+
+# Intent name (JSON controller) -> callable taking the 'parameters' dict and
+# the conversation context the handler should read and update.
+INTENT_HANDLERS = {
+    "LIST_RECENT": lambda params, context: handle_list_recent(params.get("count", 5), context),
+    "SEARCH": lambda params, context: handle_search(params.get("query"), context),
+    "SUMMARIZE_BY_ID": lambda params, context: handle_summarize(params.get("email_id"), context=context),
+    "SUMMARIZE_LAST": lambda params, context: handle_summarize(None, from_context=True, context=context),
+    "GENERATE_REPLY": lambda params, context: handle_generate_reply(params.get("reply_instructions", ""), context=context),
+    "SEND_REPLY": lambda params, context: handle_send_reply(context),
+    "SUMMARIZE_ATTACHMENT": lambda params, context: handle_summarize_attachment(
+        params.get("email_id", ""), params.get("filename", ""), context
+    ),
+    "GET_SEND_STATUS": lambda params, context: handle_send_status(params.get("outbox_id", ""), context),
+    "GET_UNREAD_COUNT": lambda params, context: handle_unread_count(),
+    "GET_TODAY_EMAIL_COUNT": lambda params, context: handle_today_count(),
+    "GREETING/OTHER": lambda params, context: handle_greeting(),
+}
+
+# Which steps read/update the conversation context; the planner uses these to
+# order dependent steps and run the rest concurrently.
+CONTEXT_READING_INTENTS = {"SUMMARIZE_LAST", "SUMMARIZE_ATTACHMENT", "GENERATE_REPLY", "SEND_REPLY", "GET_SEND_STATUS"}
+CONTEXT_WRITING_INTENTS = {"LIST_RECENT", "SEARCH", "SUMMARIZE_BY_ID", "SUMMARIZE_LAST", "GENERATE_REPLY", "SEND_REPLY"}
+
+
+def run_plan(calls, handlers, reads_context, writes_context):
+    """Executes the controller's calls as a plan and merges their outputs.
+
+    Independent steps run concurrently. Each step works on its own copy of the
+    conversation context (seeded with the updates of the steps it depends on),
+    and the updates are applied to the shared context in plan order at the end,
+    so the result is the same as running the steps one after another.
     """
-    global conversation_context # Use global for simplicity in this demo
+    steps = build_plan(calls, reads_context, writes_context)
+    step_updates = {}
+
+    def run_step(step):
+        handler = handlers.get(step.name)
+        if not handler:
+            return f"Sorry, I received an unexpected request ('{step.name}') from the controller. I don't know how to handle that."
+        step_context = dict(conversation_context)
+        for index in sorted(step.depends_on):
+            step_context.update(step_updates.get(index, {}))
+        before = dict(step_context)
+        try:
+            return handler(step.args, step_context)
+        except Exception as e:
+            print(f"Error executing plan step {step}: {e}") # Log unexpected errors
+            # Include traceback for debugging
+            import traceback
+            traceback.print_exc()
+            return f"An unexpected error occurred while executing the action: {e}"
+        finally:
+            step_updates[step.index] = {
+                key: value for key, value in step_context.items()
+                if key not in before or before[key] is not value
+            }
+
+    outputs = execute_plan(steps, run_step)
+    for step in steps:
+        conversation_context.update(step_updates.get(step.index, {}))
+    return "\n\n---\n\n".join(str(output) for output in outputs)
+# --- End Intent Handlers ---
+
+
+# --- Function-Calling Controller ---
+# Conversation-level actions exposed to the model next to the Gmail tools.
+# They work on the conversation context rather than on Gmail, so they have no
+# tool function to derive a declaration from; they are declared here and
+# handled by FUNCTION_CALL_HANDLERS like every other call.
+CONVERSATION_ACTION_DECLARATIONS = [
+    {
+        "name": "draft_reply",
+        "description": "Drafts a reply to the email currently held in context (last_email_details).",
+        "parameters": {
+            "type": "OBJECT",
+            "properties": {
+                "reply_instructions": {
+                    "type": "STRING",
+                    "description": "What the user wants the reply to say.",
+                },
+                "reply_body": {
+                    "type": "STRING",
+                    "description": "The complete reply text, written by you from the original email body in the "
+                                   "context. Leave empty if the original body is not available in the context.",
+                },
+            },
+            "required": ["reply_instructions"],
+        },
+    },
+    {
+        "name": "send_drafted_reply",
+        "description": "Sends the reply draft currently held in context (last_reply_draft) after the user confirms.",
+    },
+]
+
+CONTROLLER_TOOL_FUNCTIONS = [
+    list_recent_emails,
+    search_emails,
+    summarize_email_with_gemini,
+    summarize_attachment,
+    get_total_unread_count,
+    get_emails_received_today_count,
+    get_send_status,
+]
+
+# Function name -> callable taking the model-supplied arguments dict and the
+# conversation context.
+FUNCTION_CALL_HANDLERS = {
+    "list_recent_emails": lambda args, context: handle_list_recent(args.get("max_results", 5), context),
+    "search_emails": lambda args, context: handle_search(args.get("query"), context),
+    "summarize_email_with_gemini": lambda args, context: handle_summarize(
+        args.get("email_id"), from_context=True, context=context
+    ),
+    "get_total_unread_count": lambda args, context: handle_unread_count(),
+    "get_emails_received_today_count": lambda args, context: handle_today_count(),
+    "draft_reply": lambda args, context: handle_generate_reply(
+        args.get("reply_instructions", ""), args.get("reply_body", ""), context
+    ),
+    "send_drafted_reply": lambda args, context: handle_send_reply(context),
+    "summarize_attachment": lambda args, context: handle_summarize_attachment(
+        args.get("email_id", ""), args.get("filename", ""), context
+    ),
+    "get_send_status": lambda args, context: handle_send_status(args.get("outbox_id", ""), context),
+}
 
-    # Basic checks
-    if not gmail_service:
-        return "Error: Gmail service is not available. Please ensure authentication (token.json) is complete and restart."
-    if not gemini_model:
-         return "Error: Gemini model is not available. Check API key and configuration."
+CONTEXT_READING_FUNCTIONS = {"draft_reply", "send_drafted_reply", "get_send_status"}
+CONTEXT_WRITING_FUNCTIONS = {"list_recent_emails", "search_emails", "summarize_email_with_gemini", "draft_reply", "send_drafted_reply"}
 
+
+def _function_reads_context(name, args):
+    # Summarizing without an explicit id means "the email from the previous step".
+    if name in ("summarize_email_with_gemini", "summarize_attachment"):
+        return not args.get("email_id")
+    return name in CONTEXT_READING_FUNCTIONS
+
+
+FUNCTION_CALLING_SYSTEM_PROMPT = """
+You are the controller for a Gmail assistant. Answer the user by calling the available functions.
+- Call several functions in one response when the user asks for several things. They run concurrently unless one needs the result of an earlier one.
+- To act on an email found by an earlier call in the same response (e.g. "find the latest from X and summarize it"), call summarize_email_with_gemini with an empty email_id after that call.
+- Use the 'Current Context' JSON to resolve references such as "that email" or "the last email" (last_email_details.id).
+- When asked to draft a reply and last_email_details.original_body is present, write the full reply text yourself in draft_reply.reply_body. Do not include greetings or closings like "Hi" or "Best regards".
+- Only call send_drafted_reply when the user clearly confirms sending.
+- For greetings or requests outside these capabilities, answer briefly in plain text without calling a function.
+"""
+
+controller_model = None
+if gemini_model:
+    try:
+        controller_model = genai.GenerativeModel(
+            'gemini-1.5-flash',
+            tools=[build_tool(CONTROLLER_TOOL_FUNCTIONS, declarations=CONVERSATION_ACTION_DECLARATIONS)],
+            system_instruction=FUNCTION_CALLING_SYSTEM_PROMPT,
+        )
+    except Exception as e:
+        print(f"Error initializing function-calling controller, falling back to JSON controller: {e}")
+        controller_model = None
+    controller_model = guard_model(cassette.wrap_model(controller_model, 'gemini-1.5-flash'))
+
+
+def _build_controller_contents(message, history):
+    contents = []
+    for user_turn, assistant_turn in history:
+        contents.append({"role": "user", "parts": [user_turn or ""]})
+        contents.append({"role": "model", "parts": [assistant_turn or ""]})
+    context_json = json.dumps(conversation_context, indent=2)
+    contents.append({
+        "role": "user",
+        "parts": [f"Current Context (JSON):\n{context_json}\n\nCurrent User message: {message}"],
+    })
+    return contents
+
+
+def run_function_calling_controller(message, history):
+    """Resolves the turn with a single function-calling round trip to Gemini."""
+    contents = _build_controller_contents(message, history)
+    try:
+        controller_response = controller_model.generate_content(
+            contents,
+            tool_config={"function_calling_config": {"mode": "AUTO"}},
+        )
+        calls, model_text = extract_function_calls(controller_response)
+        print(f"--- Controller Function Calls ---\n{calls}\n--------------------------- ")
+    except Exception as e:
+        print(f"Error during controller LLM call: {e}")
+        return run_degraded_controller(message, reason=str(e))
+
+    if not calls:
+        return model_text or handle_greeting()
+
+    response_text = run_plan(calls, FUNCTION_CALL_HANDLERS, _function_reads_context, CONTEXT_WRITING_FUNCTIONS)
+    if model_text:
+        response_text = f"{model_text}\n\n{response_text}"
+    return response_text
+# --- End Function-Calling Controller ---
+
+
+# --- JSON Controller ---
+def run_json_controller(message, history):
+    """Resolves the turn with the free-form JSON intent controller."""
     # --- 1. Call LLM Controller ---
-    # ADDED DEBUG:
-    # print(f"[DEBUG] History object received: {history}") # Removed this print
     history_string = "\n".join([f"User: {h[0]}\nAssistant: {h[1]}" for h in history])
-    # ADDED DEBUG: Check if history_string was created
     print(f"[DEBUG] history_string assigned (length: {len(history_string)}).") 
     context_json = json.dumps(conversation_context, indent=2)
     prompt = CONTROLLER_PROMPT_TEMPLATE.format(
@@ -119,208 +526,226 @@ def handle_chat(message, history):
         cleaned_response_text = controller_response.text.strip().replace('```json', '').replace('```', '')
         decision = json.loads(cleaned_response_text)
         intent = decision.get("intent")
-        parameters = decision.get("parameters", {})
+        parameters = decision.get("parameters", {}) or {}
 
     except json.JSONDecodeError as e:
         print(f"Error decoding controller JSON: {e}\nResponse was: {controller_response.text}")
         return "Sorry, I had trouble understanding that request (JSON Decode Error)."
     except Exception as e:
         print(f"Error during controller LLM call: {e}")
-        return f"Sorry, an error occurred while processing your request: {e}"
+        return run_degraded_controller(message, reason=str(e))
 
-    # --- 2. Execute Action based on Intent ---    response_text = "Sorry, I couldn't process that request based on the understood intent."
-    try:
-        if intent == "LIST_RECENT":
-            count = parameters.get("count", 5) # Default to 5 if not specified
-            try:
-                count = int(count)
-            except ValueError:
-                count = 5 # Fallback if count is not a valid integer
-            
-            list_result = list_recent_emails(user_id='me', max_results=count)
-            if list_result["status"] == "success" and list_result["emails"]:
-                email_strings = []
-                for email in list_result["emails"]:
-                    email_str = (
-                        f"Subject: {email.get('subject', 'N/A')}\n\n"  # Double newline
-                        f"From: {email.get('from', 'N/A')}\n\n"      # Double newline
-                        f"Date: {email.get('date', 'N/A')}"
-                    )
-                    email_strings.append(email_str)
-                response_text = f"Here are your last {len(email_strings)} emails:\n\n" + "\n\n---\n\n".join(email_strings)
-                # Store the first result's ID for potential follow-up
-                conversation_context["last_email_details"] = list_result["emails"][0] # Store first found
-                conversation_context["last_reply_draft"] = None # Clear any old draft
-            elif list_result["status"] == "success":
-                 response_text = "No emails found in your inbox."
-            else:
-                 response_text = f"Error listing recent emails: {list_result.get('error_message', 'Unknown error')}"
+    # --- 2. Execute Action(s) based on Intent(s) ---
+    if "plan" in decision:
+        calls = [(step.get("intent"), step.get("parameters", {})) for step in decision.get("plan") or []]
+    else:
+        calls = [(intent, parameters)]
+    return run_plan(calls, INTENT_HANDLERS, CONTEXT_READING_INTENTS, CONTEXT_WRITING_INTENTS)
+# --- End JSON Controller ---
 
-        elif intent == "SEARCH":
-            query = parameters.get("query")
-            if not query:
-                response_text = "My controller understood you want to search, but didn't find search criteria. Please specify (e.g., 'from:...' or 'subject:...')."
-            else:
-                search_result = search_emails(query=query, user_id='me')
-                if search_result["status"] == "success" and search_result["emails"]:
-                    # Format emails for better readability in Markdown
-                    email_strings = []
-                    for email in search_result["emails"]:
-                        email_str = (
-                            f"Subject: {email.get('subject', 'N/A')}\n\n"  # Double newline
-                            f"From: {email.get('from', 'N/A')}\n\n"      # Double newline
-                            f"Date: {email.get('date', 'N/A')}"
-                        )
-                        email_strings.append(email_str)
-                    
-                    # Join with Markdown horizontal rule separator
-                    response_text = "Found emails:\n\n" + "\n\n---\n\n".join(email_strings)
-                        
-                    # Store the first result's ID for potential follow-up
-                    conversation_context["last_email_details"] = search_result["emails"][0] # Store first found
-                    conversation_context["last_reply_draft"] = None # Clear any old draft
-                elif search_result["status"] == "success":
-                     response_text = "No emails found matching your query."
-                else:
-                     response_text = f"Error searching emails: {search_result.get('error_message', 'Unknown error')}"
-
-        elif intent == "SUMMARIZE_BY_ID":
-            email_id = parameters.get("email_id")
-            if email_id:
-                summary_result = summarize_email_with_gemini(user_id='me', email_id=email_id)
-                if summary_result["status"] == "success":
-                    response_text = f"Summary:\n{summary_result['summary']}"
-                    conversation_context["last_email_summary"] = summary_result['summary']
-                    conversation_context["last_email_details"] = summary_result # Store all details
-                    conversation_context["last_reply_draft"] = None # Clear any old draft
-                else:
-                    response_text = f"Error summarizing email {email_id}: {summary_result.get('error_message', 'Unknown error')}"
-            else:
-                response_text = "My controller understood you want to summarize by ID, but didn't find an ID. Please provide it."
-
-        elif intent == "SUMMARIZE_LAST":
-             email_id = conversation_context["last_email_details"].get("id")
-             if email_id:
-                 summary_result = summarize_email_with_gemini(user_id='me', email_id=email_id)
-                 if summary_result["status"] == "success":
-                     response_text = f"Summary of the last mentioned email (ID: {email_id}):\n{summary_result['summary']}"
-                     conversation_context["last_email_summary"] = summary_result['summary']
-                     conversation_context["last_email_details"] = summary_result # Store all details
-                     conversation_context["last_reply_draft"] = None # Clear any old draft
-                 else:
-                    response_text = f"Error summarizing email {email_id}: {summary_result.get('error_message', 'Unknown error')}"
-             else:
-                 response_text = "I don't have a 'last email' in context to summarize. Please search for or specify an email first."
-
-        elif intent == "GENERATE_REPLY":
-            instructions = parameters.get("reply_instructions", "")
-            details = conversation_context.get("last_email_details", {})
-            original_body = details.get("original_body")
-
-            if original_body:
-                # Combine original body with user instructions for the prompt
-                generation_prompt_body = f"User wants reply to address: '{instructions}'\n\nOriginal Email Body:\n{original_body}"
-
-                reply_result = generate_reply_with_gemini(
-                    original_subject=details.get("subject", "No Subject"),
-                    original_body=generation_prompt_body
-                )
-                if reply_result["status"] == "success":
-                    response_text = f"Draft Reply:\n------\n{reply_result['reply_body']}\n------\n\nWould you like me to send this reply?"
-                    conversation_context["last_reply_draft"] = reply_result['reply_body'] # Store draft
-                else:
-                    response_text = f"Error generating reply draft: {reply_result.get('error_message', 'Unknown error')}"
-            else:
-                response_text = "I need the context of an email (specifically its body) to generate a reply. Please summarize an email first."
-
-        elif intent == "SEND_REPLY":
-            details = conversation_context.get("last_email_details", {})
-            draft = conversation_context.get("last_reply_draft")
-
-            if (draft and details.get("sender_email") and details.get("subject") and
-                details.get("thread_id") and details.get("original_message_id")):
-
-                send_result = send_reply(
-                    user_id='me',
-                    to=details["sender_email"],
-                    sender='me',
-                    subject=details["subject"],
-                    reply_body=draft,
-                    thread_id=details["thread_id"],
-                    original_message_id=details["original_message_id"],
-                    references=details.get("references", "")
-                 )
-                if send_result["status"] == "success":
-                    response_text = f"Reply sent successfully! Message ID: {send_result['message_id']}"
-                    conversation_context["last_reply_draft"] = None # Clear draft after sending
-                    # Optionally clear last_email_details too?
-                else:
-                     response_text = f"Error sending reply: {send_result.get('error_message', 'Unknown error')}"
-            elif not draft:
-                response_text = "There is no reply draft stored in context to send. Please generate one first."
-            else:
-                response_text = "I'm missing some details from the original email context (like sender, thread ID, or message ID) needed to send the reply. Please summarize the relevant email again."
 
-        elif intent == "GET_UNREAD_COUNT":
-            unread_result = get_total_unread_count(user_id='me')
-            if unread_result["status"] == "success":
-                response_text = f"You have {unread_result['unread_count']} unread emails in your inbox."
-            else:
-                response_text = f"Error getting unread count: {unread_result.get('error_message', 'Unknown error')}"
+# --- Degraded Controller ---
+def run_degraded_controller(message, reason="Gemini is not available."):
+    """Resolves the turn without the LLM controller, using the rule-based router.
 
-        elif intent == "GET_TODAY_EMAIL_COUNT":
-            today_count_result = get_emails_received_today_count(user_id='me')
-            if today_count_result["status"] == "success":
-                response_text = f"You received approximately {today_count_result['today_count']} emails in the last 24 hours."
-            else:
-                response_text = f"Error counting today's emails: {today_count_result.get('error_message', 'Unknown error')}"
+    Used while Gemini is unavailable (not configured, or its circuit breaker is
+    open). Obvious requests (counts, recent emails, search by sender,
+    summarize by ID, send the draft) still work; everything else gets an
+    explanation instead of a long hang.
+    """
+    route = route_message(message)
+    if route and route.kind == ROUTE_TOOL and route.name in FUNCTION_CALL_HANDLERS:
+        return FUNCTION_CALL_HANDLERS[route.name](route.args, conversation_context)
+    if route and route.kind == ROUTE_AGENT and route.name == SENDING_AGENT:
+        return handle_send_reply()
+    return (
+        f"I'm running in limited mode right now ({reason}). I can still show recent emails, "
+        "find emails from an address, count unread or today's emails, summarize an email by ID "
+        "and send a drafted reply."
+    )
+# --- End Degraded Controller ---
+
+
+# --- Mail Watcher ---
+# The background watcher (started at launch) publishes mailbox changes; the
+# inbox panel refreshes the pages they affect, and new inbox mail is
+# announced at the top of the next chat reply.
+WATCH_MAIL = os.environ.get("GMAIL_AGENT_WATCH_MAIL", "1") != "0"
+PUSH_PORT = os.environ.get("GMAIL_AGENT_PUSH_PORT")
+PUBSUB_TOPIC = os.environ.get("GMAIL_AGENT_PUBSUB_TOPIC")
+_new_mail = []
+_new_mail_lock = threading.Lock()
+
+
+def _on_new_message(event):
+    if "INBOX" in event.label_ids:
+        with _new_mail_lock:
+            _new_mail.append(event.message_id)
+
+
+def _take_new_mail_notice():
+    with _new_mail_lock:
+        count = len(_new_mail)
+        _new_mail.clear()
+    if not count:
+        return ""
+    return f"📬 {count} new email{'s' if count != 1 else ''} arrived since your last message.\n\n"
+
+
+mail_events.subscribe(MailEvent, lambda event: get_inbox_pager(event.user_id).handle_mail_event(event))
+mail_events.subscribe(NewMessageEvent, _on_new_message)
+# Keep the message caches (shared with the other workers) in step with the mailbox
+mail_events.subscribe(LabelChangeEvent, lambda event: invalidate_cached_message(event.user_id, event.message_id))
+mail_events.subscribe(MessageDeletedEvent,
+                      lambda event: invalidate_cached_message(event.user_id, event.message_id, deleted=True))
+mail_events.subscribe(MailboxResyncEvent, lambda event: invalidate_cached_mailbox(event.user_id))
+# Stars, archiving, trashing and reads done in Gmail itself train the triage model
+mail_events.subscribe(LabelChangeEvent, lambda event: get_triage_scorer().learn_from_mail_event(event))
+
+
+def start_mail_watcher():
+    watcher = get_mail_watcher('me').start()
+    if PUSH_PORT:
+        serve_push_endpoint(port=int(PUSH_PORT))
+    if PUBSUB_TOPIC:
+        try:
+            start_gmail_watch('me', PUBSUB_TOPIC)
+        except Exception as e:
+            print(f"Error starting Gmail push notifications, polling only: {e}")
+    return watcher
+# --- End Mail Watcher ---
 
-        elif intent == "GREETING/OTHER":
-            # Simple response for greetings or unrecognized input
-            response_text = "Hello! How can I help you with your Gmail today?"
 
-        else: # Handles cases where intent is missing or unrecognized by the Python code
-            response_text = f"Sorry, I received an unexpected intent ('{intent}') from the controller. I don't know how to handle that."
+# --- Chatbot Logic ---
+# Prefix a message with "/profile " to profile just that turn (see profiling.py).
+PROFILE_COMMAND = "/profile "
 
-    except Exception as e:
-        print(f"Error executing action for intent {intent}: {e}") # Log unexpected errors
-        # Include traceback for debugging
-        import traceback
-        traceback.print_exc()
-        response_text = f"An unexpected error occurred while executing the action: {e}"
 
-    return response_text
+def handle_chat(message, history):
+    """
+    Processes user message using an LLM controller, interacts with Gmail/Gemini tools.
+    """
+    force_profile = message.startswith(PROFILE_COMMAND)
+    if force_profile:
+        message = message[len(PROFILE_COMMAND):].strip()
+    with profile_turn("chat-turn", force=force_profile), wire_meter.turn() as wire:
+        response = _take_new_mail_notice() + _handle_chat(message, history)
+    if PROFILE_ENABLED or force_profile:
+        print(f"[wire] chat turn: {wire.summary()}")
+    return response
+
+
+def _handle_chat(message, history):
+    # Degraded mode: skip the LLM controller while Gemini is missing or failing
+    if not gemini_model:
+        return run_degraded_controller(message, reason="Gemini is not configured")
+    if gemini_breaker.state == STATE_OPEN:
+        return run_degraded_controller(message, reason="Gemini is temporarily unavailable")
+
+    if CONTROLLER_MODE == "function_calling" and controller_model:
+        return run_function_calling_controller(message, history)
+    return run_json_controller(message, history)
+
+# --- Inbox Panel ---
+# A page-at-a-time view of the inbox next to the chat. Pages come from the
+# shared InboxPager (cursor and page caches, next-page prefetch); clicking a
+# row loads that email's body and makes it the chat's current email.
+INBOX_PREVIEW_CHARS = 3000
+
+
+def load_inbox_page(page_number):
+    index = max(int(page_number or 1), 1) - 1
+    pager = get_inbox_pager('me')
+    page_result = pager.get_page(index)
+    if page_result["status"] != "success":
+        return gr.update(), gr.update(), gr.update(), f"Error: {page_result.get('error_message', 'Unknown error')}"
+    emails = page_result["emails"]
+    rows = [[email.get('from', 'N/A'), email.get('subject', 'N/A'), email.get('date', 'N/A')] for email in emails]
+    status = f"Page {index + 1}"
+    if page_result["total_estimate"]:
+        status += f" of ~{max(-(-page_result['total_estimate'] // pager.page_size), index + 1)}"
+    if not page_result["has_next"]:
+        status += " (last page)"
+    return rows, index + 1, [email['id'] for email in emails], status
+
+
+def refresh_inbox():
+    get_inbox_pager('me').invalidate()
+    return load_inbox_page(1)
+
+
+def open_inbox_email(email_ids, evt: gr.SelectData):
+    row = evt.index[0] if isinstance(evt.index, (list, tuple)) else evt.index
+    if row is None or row >= len(email_ids):
+        return gr.update()
+    details = get_inbox_pager('me').get_message(email_ids[row])
+    if details["status"] != "success":
+        return f"Error opening email: {details.get('error_message', 'Unknown error')}"
+    get_triage_scorer().record_action(details, "opened")
+    # Hand the email to the chat: "summarize this" / "draft a reply" now act on it
+    conversation_context["last_email_details"] = {key: value for key, value in details.items() if key != "status"}
+    conversation_context["last_email_summary"] = None
+    conversation_context["last_reply_draft"] = None
+    body = details.get("original_body") or "(No text body)"
+    if len(body) > INBOX_PREVIEW_CHARS:
+        body = body[:INBOX_PREVIEW_CHARS] + "\n\n…"
+    return (
+        f"**{details['subject']}**\n\nFrom: {details['sender_email']} · ID: {details['id']}\n\n"
+        f"_Selected for the chat: ask me to summarize or reply to it._\n\n---\n\n{body}"
+    )
+# --- End Inbox Panel ---
+
 
 # --- Gradio Interface ---
-iface = gr.ChatInterface(
-    fn=handle_chat,
-    title="Gmail AI Agent (Natural Language)", # Updated Title
-    description=(
-        "Chat with your Gmail assistant using natural language. Examples:\n"
-        "- 'Show my last 5 emails'\n"
-        "- 'Find emails I got from boss@company.com about the project report'\n"
-        "- 'Summarize the email with id 18abc9def0123456'\n"
-        "- 'Can you summarize the last email we discussed?'\n"
-        "- 'Draft a reply to that email saying I will look into it.'\n"
-        "- 'Ok send the reply'\n"
-        "- 'How many unread emails do I have?'\n"
-        "- 'How many emails did I get today?'"
-    ), # Updated Description
-    chatbot=gr.Chatbot(height=600),
-    textbox=gr.Textbox(placeholder="Type your message here...", container=False, scale=7), # Removed lines=3
-    theme=gr.themes.Soft(), # Added theme
-    # retry_btn=None, # Removed
-    # undo_btn="Delete Previous", # Removed
-    # clear_btn="Clear Conversation", # Removed
-)
+with gr.Blocks(title="Gmail AI Agent", theme=gr.themes.Soft()) as iface:
+    with gr.Row():
+        with gr.Column(scale=3):
+            gr.ChatInterface(
+                fn=handle_chat,
+                title="Gmail AI Agent (Natural Language)", # Updated Title
+                description=(
+                    "Chat with your Gmail assistant using natural language. Examples:\n"
+                    "- 'Show my last 5 emails'\n"
+                    "- 'Find emails I got from boss@company.com about the project report'\n"
+                    "- 'Summarize the email with id 18abc9def0123456'\n"
+                    "- 'Can you summarize the last email we discussed?'\n"
+                    "- 'Draft a reply to that email saying I will look into it.'\n"
+                    "- 'Ok send the reply'\n"
+                    "- 'How many unread emails do I have?'\n"
+                    "- 'How many emails did I get today?'"
+                ), # Updated Description
+                chatbot=gr.Chatbot(height=600),
+                textbox=gr.Textbox(placeholder="Type your message here...", container=False, scale=7), # Removed lines=3
+            )
+        with gr.Column(scale=2):
+            gr.Markdown("### Inbox")
+            inbox_status = gr.Markdown()
+            inbox_table = gr.Dataframe(headers=["From", "Subject", "Date"], interactive=False, wrap=True)
+            with gr.Row():
+                newer_button = gr.Button("◀ Newer")
+                page_number = gr.Number(value=1, precision=0, minimum=1, label="Page")
+                older_button = gr.Button("Older ▶")
+                refresh_button = gr.Button("Refresh")
+            email_preview = gr.Markdown()
+            inbox_email_ids = gr.State([])
+
+    inbox_outputs = [inbox_table, page_number, inbox_email_ids, inbox_status]
+    iface.load(load_inbox_page, inputs=page_number, outputs=inbox_outputs)
+    page_number.submit(load_inbox_page, inputs=page_number, outputs=inbox_outputs)
+    newer_button.click(lambda number: load_inbox_page((number or 1) - 1), inputs=page_number, outputs=inbox_outputs)
+    older_button.click(lambda number: load_inbox_page((number or 1) + 1), inputs=page_number, outputs=inbox_outputs)
+    refresh_button.click(refresh_inbox, outputs=inbox_outputs)
+    inbox_table.select(open_inbox_email, inputs=inbox_email_ids, outputs=email_preview)
 
 # --- Launch App ---
 if __name__ == "__main__":
     if not gmail_service or not gemini_model:
-         print("\n---")
-         print("ERROR: Cannot launch Gradio UI because Gmail Service or Gemini Model failed to initialize.")
-         print("Please check errors above, ensure token.json exists and GOOGLE_API_KEY is valid in .env.")
-         print("---")
-    else:
-        print("Launching Gradio Interface...")
-        iface.launch() 
\ No newline at end of file
+        print("\n---")
+        print("WARNING: Starting in degraded mode because the Gmail Service or Gemini Model failed to initialize.")
+        print("Please check errors above, ensure token.json exists and GOOGLE_API_KEY is valid in .env.")
+        print(f"Dependency status: {dependency_status()}")
+        print("---")
+    if WATCH_MAIL:
+        start_mail_watcher()
+    print("Launching Gradio Interface...")
+    iface.launch() 
\ No newline at end of file
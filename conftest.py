@@ -0,0 +1 @@
+# Lets the tests import multi_tool_agent and the top-level scripts from the repo root.
@@ -0,0 +1,374 @@
+import argparse
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import date, datetime
+
+from multi_tool_agent.atomic_files import atomic_write_json
+from multi_tool_agent.gmail_agent_logic import (
+    email_details_from_metadata,
+    fetch_listing_details,
+    fetch_messages_batch,
+    get_email_body,
+    get_gmail_service,
+    summarize_text_with_gemini,
+)
+from multi_tool_agent.ingest import create_parse_pool, ingest_messages
+from multi_tool_agent.projection import LIST_IDS_FIELDS, NEED_BODY
+from multi_tool_agent.triage import get_triage_scorer
+
+# --- Digest Configuration ---
+DEFAULT_QUERY = "label:inbox newer_than:1d"  # Same window as get_emails_received_today_count
+LIST_PAGE_SIZE = 500
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_CONCURRENCY = 4
+DEFAULT_PARSE_WORKERS = os.cpu_count() or 1  # 0: fetch the parsed payload and read it in-process
+DEFAULT_CHECKPOINT_DIR = "digest_checkpoints"
+DEFAULT_OUTPUT_DIR = "digests"
+# --- End Digest Configuration ---
+
+
+# --- Checkpoint ---
+class DigestCheckpoint:
+    """Progress of one digest run, persisted after every unit of work.
+
+    The file records the listing position (page token), the message IDs found
+    so far and, per message, its metadata and summary. A rerun with the same
+    checkpoint skips finished pages and messages, so an interrupted run never
+    pays for the same LLM summary twice.
+
+    Listing pages rewrite the file; each summary is instead appended (and
+    fsynced) to a JSON-lines journal next to it, which save() folds back into
+    the file at the end of a run, so recording a message costs the same
+    however many came before it.
+    """
+
+    def __init__(self, path, query, user_id):
+        self.path = path
+        self.journal_path = f"{path}.journal"
+        self._journal = None
+        self._lock = threading.Lock()
+        self.state = {
+            "query": query,
+            "user_id": user_id,
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "next_page_token": None,
+            "listing_complete": False,
+            "message_ids": [],
+            "messages": {},
+        }
+        resumed = False
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as checkpoint_file:
+                saved = json.load(checkpoint_file)
+            if saved.get("query") == query and saved.get("user_id") == user_id:
+                self.state = saved
+                resumed = True
+            else:
+                print(f"Checkpoint {path} is for a different query or user; starting over.")
+        if os.path.exists(self.journal_path):
+            if resumed:
+                self._replay_journal()
+                self.save()
+            else:
+                os.remove(self.journal_path)
+        if resumed:
+            print(f"Resuming digest from checkpoint {path}: "
+                  f"{len(self.summarized_ids())}/{len(self.state['message_ids'])} messages already summarized.")
+
+    def _replay_journal(self):
+        with open(self.journal_path, "r", encoding="utf-8") as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn final write from a crash; everything before it is intact.
+                    continue
+                self.state["messages"][entry["id"]] = entry["record"]
+
+    def save(self):
+        """Rewrites the checkpoint file with the full state and empties the journal."""
+        with self._lock:
+            atomic_write_json(self.path, self.state)  # A crash never leaves a torn checkpoint
+            # Only once the file holds every journaled record.
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+
+    def add_page(self, message_ids, next_page_token):
+        known = set(self.state["message_ids"])
+        self.state["message_ids"].extend(msg_id for msg_id in message_ids if msg_id not in known)
+        self.state["next_page_token"] = next_page_token
+        self.state["listing_complete"] = not next_page_token
+        self.save()
+
+    def record_message(self, msg_id, record):
+        with self._lock:
+            self.state["messages"][msg_id] = record
+            if self._journal is None:
+                self._journal = open(self.journal_path, "a", encoding="utf-8")
+            self._journal.write(json.dumps({"id": msg_id, "record": record}) + "\n")
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+
+    def summarized_ids(self):
+        return {msg_id for msg_id, record in self.state["messages"].items() if "summary" in record}
+# --- End Checkpoint ---
+
+
+def list_all_message_ids(service, user_id, checkpoint):
+    """Pages through the query, checkpointing after every page."""
+    while not checkpoint.state["listing_complete"]:
+        kwargs = {"userId": user_id, "q": checkpoint.state["query"], "maxResults": LIST_PAGE_SIZE,
+                  "fields": LIST_IDS_FIELDS}
+        if checkpoint.state["next_page_token"]:
+            kwargs["pageToken"] = checkpoint.state["next_page_token"]
+        results = service.users().messages().list(**kwargs).execute()
+        page_ids = [msg_stub['id'] for msg_stub in results.get('messages', [])]
+        checkpoint.add_page(page_ids, results.get('nextPageToken'))
+        print(f"Listed {len(checkpoint.state['message_ids'])} messages so far.")
+    return checkpoint.state["message_ids"]
+
+
+def summarize_message(msg):
+    """Returns the digest record (metadata plus summary or error) for one full message."""
+    record = email_details_from_metadata(msg)
+    body = get_email_body(msg.get('payload', {})) or msg.get('snippet', '')
+    if not body:
+        record["summary"] = "(no text content)"
+        return record
+    summary_result = summarize_text_with_gemini(record["subject"], body)
+    if summary_result["status"] == "success":
+        record["summary"] = summary_result["summary"].strip()
+    else:
+        record["error"] = summary_result["error_message"]
+    return record
+
+
+def summarize_record(record):
+    """Returns the digest record for one message parsed by multi_tool_agent.ingest."""
+    digest_record = {
+        "id": record["id"],
+        "threadId": record.get("thread_id"),
+        "subject": record.get("subject") or "No Subject",
+        "from": record.get("from") or "Unknown Sender",
+        "date": record.get("date") or "No Date",
+        "labels": record.get("labels", []),
+    }
+    if "error" in record:
+        digest_record["error"] = f"Could not parse message: {record['error']}"
+        return digest_record
+    if not record.get("body", "").strip():
+        digest_record["summary"] = "(no text content)"
+        return digest_record
+    summary_result = summarize_text_with_gemini(digest_record["subject"], record["body"])
+    if summary_result["status"] == "success":
+        digest_record["summary"] = summary_result["summary"].strip()
+    else:
+        digest_record["error"] = summary_result["error_message"]
+    return digest_record
+
+
+class _SummarizeSink:
+    """Ingestion sink that starts summarizing each record as soon as it is parsed.
+
+    At most max_pending summaries are queued or running at once; write()
+    blocks past that, which holds back fetching. Each summary is recorded in
+    the checkpoint as soon as it finishes. Once stop() returns True, records
+    are dropped instead of summarized.
+    """
+
+    def __init__(self, executor, checkpoint, summarize, max_pending, stop, progress_every, total):
+        self.executor = executor
+        self.checkpoint = checkpoint
+        self.summarize = summarize
+        self.stop = stop
+        self.stopped = False
+        self.futures = []
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._progress_every = progress_every
+        self._total = total
+        self._recorded = 0
+        self._lock = threading.Lock()
+
+    def should_stop(self):
+        if not self.stopped and self.stop():
+            self.stopped = True
+        return self.stopped
+
+    def write(self, record):
+        if self.should_stop():
+            return
+        self._pending.acquire()
+        future = self.executor.submit(self.summarize, record)
+        future.add_done_callback(functools.partial(self._record, record["id"]))
+        self.futures.append(future)
+
+    def _record(self, msg_id, future):
+        self._pending.release()
+        if future.cancelled() or future.exception() is not None:
+            return  # Raised again by wait()
+        self.checkpoint.record_message(msg_id, future.result())
+        with self._lock:
+            self._recorded += 1
+            if self._recorded % self._progress_every == 0:
+                print(f"Summarized {self._recorded}/{self._total} remaining messages.")
+
+    def wait(self):
+        """Waits for every submitted summary, re-raising the first error."""
+        for future in self.futures:
+            future.result()
+
+
+def prioritize(service, user_id, message_ids, batch_size):
+    """Orders message IDs by triage priority, highest first, using cheap metadata fetches."""
+    scorer = get_triage_scorer()
+    scores = {}
+    for start in range(0, len(message_ids), batch_size):
+        batch_ids = message_ids[start:start + batch_size]
+        for email in fetch_listing_details(service, user_id, batch_ids):
+            scores[email["id"]] = scorer.score(email)
+    return sorted(message_ids, key=lambda msg_id: -scores.get(msg_id, 0.0))
+
+
+def run_digest(service, user_id, checkpoint, batch_size, concurrency, deadline, by_priority=True,
+               parse_workers=DEFAULT_PARSE_WORKERS):
+    """Fetches and summarizes every message not yet summarized in the checkpoint.
+
+    Messages are fetched batch_size at a time (one batched HTTP round trip)
+    and summarized with at most `concurrency` LLM calls in flight. Stops
+    starting new work once `deadline` (a time.monotonic() value) has passed.
+    With by_priority, the most important messages are summarized first, so
+    a deadline cuts off the least important ones. With parse_workers,
+    messages are fetched as format='raw' and parsed in that many processes
+    (see multi_tool_agent.ingest) instead of on this process's threads.
+    """
+    message_ids = list_all_message_ids(service, user_id, checkpoint)
+    done = checkpoint.summarized_ids()
+    todo = [msg_id for msg_id in message_ids if msg_id not in done]
+    print(f"{len(todo)} of {len(message_ids)} messages left to summarize.")
+    if by_priority and len(todo) > batch_size:
+        todo = prioritize(service, user_id, todo, batch_size)
+
+    def past_deadline():
+        return bool(deadline) and time.monotonic() > deadline
+
+    parse_pool_context = create_parse_pool(parse_workers) if parse_workers else nullcontext()
+    try:
+        with parse_pool_context as parse_pool, ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # One stream from fetching to summaries: batches are fetched and
+            # parsed while earlier messages are still being summarized.
+            sink = _SummarizeSink(executor, checkpoint, summarize_record if parse_pool else summarize_message,
+                                  max_pending=concurrency + batch_size, stop=past_deadline,
+                                  progress_every=batch_size, total=len(todo))
+            if parse_pool:
+                ingest_messages(service, user_id, todo, sink, batch_size, pool=parse_pool, stop=sink.should_stop)
+            else:
+                for start in range(0, len(todo), batch_size):
+                    if sink.should_stop():
+                        break
+                    batch_ids = todo[start:start + batch_size]
+                    messages = fetch_messages_batch(service, user_id, batch_ids, need=NEED_BODY)
+                    for msg_id in batch_ids:
+                        if msg_id in messages:
+                            sink.write(messages[msg_id])
+            sink.wait()
+        print(f"Summarized {len(checkpoint.summarized_ids())}/{len(message_ids)} messages.")
+        if sink.stopped:
+            print("Deadline reached; writing a partial digest. Rerun to resume.")
+            return False
+        return True
+    finally:
+        checkpoint.save()  # Fold this run's journal into the checkpoint file
+
+
+# --- Digest Rendering ---
+def group_digest(checkpoint):
+    """Groups digest records by sender, then by thread, in listing order."""
+    senders = {}
+    for msg_id in checkpoint.state["message_ids"]:
+        record = checkpoint.state["messages"].get(msg_id, {"id": msg_id, "from": "Unknown Sender"})
+        threads = senders.setdefault(record.get("from", "Unknown Sender"), {})
+        threads.setdefault(record.get("threadId") or msg_id, []).append(record)
+    return senders
+
+
+def render_markdown(grouped, user_id, complete):
+    lines = [f"# Daily Email Digest for {user_id} ({date.today().isoformat()})", ""]
+    if not complete:
+        lines += ["_Partial digest: some messages were not summarized yet._", ""]
+    for sender, threads in sorted(grouped.items(), key=lambda item: -sum(len(t) for t in item[1].values())):
+        lines.append(f"## {sender}")
+        for thread_records in threads.values():
+            lines.append(f"### {thread_records[0].get('subject', 'No Subject')}")
+            for record in thread_records:
+                summary = record.get("summary") or f"(not summarized: {record.get('error', 'pending')})"
+                lines.append(f"- **{record.get('date', 'No Date')}**: {summary}")
+            lines.append("")
+    return "\n".join(lines)
+
+
+def write_digest(checkpoint, output_dir, formats, user_id, complete):
+    os.makedirs(output_dir, exist_ok=True)
+    grouped = group_digest(checkpoint)
+    stem = os.path.join(output_dir, f"digest-{user_id.replace('@', '_at_')}-{date.today().isoformat()}")
+    written = []
+    if "md" in formats:
+        with open(f"{stem}.md", "w", encoding="utf-8") as digest_file:
+            digest_file.write(render_markdown(grouped, user_id, complete))
+        written.append(f"{stem}.md")
+    if "json" in formats:
+        with open(f"{stem}.json", "w", encoding="utf-8") as digest_file:
+            json.dump({"user_id": user_id, "date": date.today().isoformat(), "complete": complete,
+                       "senders": grouped}, digest_file, indent=2)
+        written.append(f"{stem}.json")
+    return written
+# --- End Digest Rendering ---
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize the last day of inbox mail into a digest.")
+    parser.add_argument("--user-id", default="me", help="Mailbox to digest (default: me).")
+    parser.add_argument("--query", default=DEFAULT_QUERY, help=f"Gmail search query (default: '{DEFAULT_QUERY}').")
+    parser.add_argument("--output-dir", default=DEFAULT_OUTPUT_DIR)
+    parser.add_argument("--format", default="md,json", help="Comma-separated output formats: md, json.")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Messages fetched per batch request.")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Maximum LLM calls in flight.")
+    parser.add_argument("--checkpoint", help="Checkpoint file (default: one per user and day in digest_checkpoints/).")
+    parser.add_argument("--deadline-minutes", type=float, help="Stop starting new work after this many minutes.")
+    parser.add_argument("--order", choices=("priority", "listing"), default="priority",
+                        help="Summarize the most important messages first (default) or in listing order.")
+    parser.add_argument("--parse-workers", type=int, default=DEFAULT_PARSE_WORKERS,
+                        help="Processes parsing raw messages (default: one per core; 0 parses in-process).")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    checkpoint_path = args.checkpoint or os.path.join(
+        DEFAULT_CHECKPOINT_DIR, f"{args.user_id.replace('@', '_at_')}-{date.today().isoformat()}.json"
+    )
+    service = get_gmail_service(args.user_id)
+    if not service:
+        print("Failed to get Gmail service. Check token.json and credentials.json.")
+        return 1
+
+    checkpoint = DigestCheckpoint(checkpoint_path, args.query, args.user_id)
+    deadline = time.monotonic() + args.deadline_minutes * 60 if args.deadline_minutes else None
+    complete = run_digest(service, args.user_id, checkpoint, args.batch_size, args.concurrency, deadline,
+                          by_priority=args.order == "priority", parse_workers=args.parse_workers)
+    formats = {fmt.strip() for fmt in args.format.split(",")}
+    for path in write_digest(checkpoint, args.output_dir, formats, args.user_id, complete):
+        print(f"Wrote {path}")
+    return 0 if complete else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1 +1,11 @@
-from . import agent
+import importlib
+
+
+def __getattr__(name):
+    # ADK finds the agent as multi_tool_agent.agent; importing it builds the
+    # agents and their clients, so it's only loaded on first access rather
+    # than by every import of a submodule (parser worker processes import
+    # multi_tool_agent.mime_parse and nothing else).
+    if name == "agent":
+        return importlib.import_module(".agent", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
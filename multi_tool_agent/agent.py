@@ -1,8 +1,10 @@
 from google.adk.agents import Agent
 from google.adk.runners import Runner
-from google.adk.sessions import InMemorySessionService
 from google.genai import types
 
+from .outbox import get_send_status, queue_reply
+from .sqlite_session_service import SqliteSessionService
+
 # Import the tools and service function from your quickstart file
 # from .quickstart import (
 from .gmail_agent_logic import (
@@ -14,7 +16,6 @@ from .gmail_agent_logic import (
     # search_emails_tool,   # Removed - Use function directly
     generate_reply_with_gemini, # Function for generating draft
     summarize_email_with_gemini, # Function for summarizing
-    send_reply,                 # Function for sending
     list_recent_emails,         # Function for listing
     search_emails              # Function for searching
 )
@@ -31,13 +32,14 @@ Available Tools:
 - search_emails: Use this to find emails matching specific criteria (sender, subject, keywords). Useful if the user asks for emails "from someone" or "about something".
 - summarize_email_with_gemini: Use this to fetch and summarize a specific email. You need the email_id.
 - generate_reply_with_gemini: Use this to generate a draft reply based on an original email's subject and body.
-- send_reply: Use this to send the generated reply. You need all the details like recipient ('to'), sender ('sender', usually 'me'), subject, body, thread_id, original_message_id, and references.
+- queue_reply: Use this to send the generated reply. It queues the reply for sending in the background and returns an outbox_id. You need all the details like recipient ('to'), sender ('sender', usually 'me'), subject, body, thread_id, original_message_id, and references.
+- get_send_status: Use this to check whether a queued reply has been sent, with the outbox_id from queue_reply (or empty for the latest reply).
 
 Workflow for Summarization:
 1. If the user asks to summarize an email and provides an email_id, use 'summarize_email_with_gemini' directly with that ID.
 2. If the user asks to summarize an email *without* providing an ID (e.g., "summarize the latest email", "summarize the email from John about the report"):
     a. First, use 'list_recent_emails' (for general requests like "latest") or 'search_emails' (for specific criteria like sender or subject) to find the relevant email(s).
-    b. Identify the `email_id` of the most relevant email from the results (usually the first one if asking for "latest"). If multiple relevant emails are found, you might need to ask the user for clarification or pick the most recent one.
+    b. Identify the `email_id` of the most relevant email from the results (the one with 'recency' 0 if asking for "latest"; results are ordered by priority, not date). If multiple relevant emails are found, you might need to ask the user for clarification or pick the most recent one.
     c. Once you have the `email_id`, use 'summarize_email_with_gemini' to get the summary.
 3. Present the summary to the user.
 
@@ -45,8 +47,8 @@ Workflow for Replying:
 1. To reply to an email, you first need its details. If you don't have them from a recent summarization, follow the Summarization Workflow steps 1 or 2 to get the email details (summary, subject, body, sender, thread_id, message_id, references) using 'summarize_email_with_gemini'.
 2. Use 'generate_reply_with_gemini' with the original subject and body obtained from the summary tool.
 3. Show the generated reply draft to the user and **ask for confirmation** before sending.
-4. If the user confirms, use the 'send_reply' tool with all the necessary information gathered from the summary tool and the generated reply body. Use 'me' as the user_id and sender.
-5. Inform the user whether the reply was sent successfully or if an error occurred.
+4. If the user confirms, use the 'queue_reply' tool with all the necessary information gathered from the summary tool and the generated reply body. Use 'me' as the user_id and sender.
+5. Tell the user the reply is queued for sending (or that it was already queued, if 'duplicate' is true), or that an error occurred. If they ask whether it went out, use 'get_send_status'.
 6. Handle errors gracefully by informing the user.
 """
 
@@ -57,7 +59,8 @@ agent_tools = [
     search_emails,              # Use function name directly
     summarize_email_with_gemini,# Use function name directly
     generate_reply_with_gemini, # Use function name directly
-    send_reply,                 # Use function name directly
+    queue_reply,                # Use function name directly
+    get_send_status,            # Use function name directly
 ]
 
 # Create the Agent instance
@@ -84,7 +87,12 @@ if __name__ == "__main__":
         print("Failed to authenticate Gmail service. Please check credentials.json and permissions.")
         print("Exiting.")
 
-    session_service = InMemorySessionService()
-    session = session_service.create_session(app_name="AI MAIL", user_id=1234, session_id=123)
+    # Sessions are persisted to SQLite (GMAIL_AGENT_SESSION_DB) so the
+    # conversation survives restarts; resume it if it already exists.
+    session_service = SqliteSessionService()
+    session = (
+        session_service.get_session(app_name="AI MAIL", user_id="1234", session_id="123")
+        or session_service.create_session(app_name="AI MAIL", user_id="1234", session_id="123")
+    )
     runner = Runner(agent=root_agent, app_name="AI MAIL", session_service=session_service)
 
@@ -1,99 +1,140 @@
+import asyncio
+from typing import AsyncGenerator
+
 from google.adk.agents import Agent, LlmAgent, BaseAgent
-from google.adk.runners import Runner
-from google.adk.sessions import InMemorySessionService
+from google.adk.agents.invocation_context import InvocationContext
+from google.adk.events import Event
 from google.genai import types
 
-# Import the tools and service function from your quickstart file
-from .quickstart import (
-    summarize_email_tool,
-    send_reply_tool,
+from .sqlite_session_service import SqliteSessionService
+from .instrumented_runner import InstrumentedRunner
+from .outbox import get_send_status, queue_reply
+from .routing import ROUTE_AGENT, ROUTE_TOOL, call_direct_tool, format_tool_result, route_message
+
+# Import the tools and service function from the Gmail logic module
+from .gmail_agent_logic import (
     get_gmail_service,
-    list_emails_tool,
-    search_emails_tool,
     generate_reply_with_gemini,
+    summarize_email_with_gemini,
+    list_recent_emails,
+    search_emails,
+    get_total_unread_count,
+    get_emails_received_today_count,
 )
 
+MODEL = "gemini-2.0-flash-lite-001"
+
 # --- Agent Definition ---
 
-# Define the instruction for the agent
-# This tells the LLM how to behave and use the tools.
-AGENT_INSTRUCTION = """
-You are a helpful email assistant. Your goal is to process user requests related to their Gmail inbox. You must delegate tasks to the appropriate sub-agent based on their description. Do not execute tools directly.
-
-Available Tools (handled by sub-agents):
-- list_recent_emails: Use this to get a list of the most recent emails (subject, sender, date, id). Useful if the user asks for "the latest email" or "recent emails". Delegate to inbox_search_agent.
-- search_emails: Use this to find emails matching specific criteria (sender, subject, keywords). Useful if the user asks for emails "from someone" or "about something". Delegate to inbox_search_agent.
-- summarize_email_with_gemini: Use this to fetch and summarize a specific email. You need the email_id. Delegate to email_summarizing_agent.
-- generate_reply_with_gemini: Use this to generate a draft reply based on an original email's subject and body. Delegate to email_reply_agent.
-- send_reply: Use this to send the generated reply. You need all the details like recipient ('to'), sender ('sender', usually 'me'), subject, body, thread_id, original_message_id, and references. Delegate to email_sending_agent.
-
-Workflow for Summarization:
-1. If the user asks to summarize an email and provides an email_id, delegate to 'email_summarizing_agent' with the 'summarize_email_with_gemini' tool and the ID.
-2. If the user asks to summarize an email *without* providing an ID (e.g., "summarize the latest email", "summarize the email from John about the report"):
-    a. First, delegate to 'inbox_search_agent' using 'list_recent_emails' (for general requests like "latest") or 'search_emails' (for specific criteria like sender or subject) to find the relevant email(s).
-    b. Identify the `email_id` of the most relevant email from the results. If multiple relevant emails are found, ask the user for clarification or pick the most recent one.
-    c. Once you have the `email_id`, delegate to 'email_summarizing_agent' with the 'summarize_email_with_gemini' tool to get the summary.
-3. Present the summary to the user.
-
-Workflow for Replying:
-1. To reply to an email, you first need its details. If you don't have them from a recent summarization, follow the Summarization Workflow steps 1 or 2 to get the email details (summary, subject, body, sender, thread_id, message_id, references) by delegating to the appropriate agents ('inbox_search_agent' then 'email_summarizing_agent').
-2. Delegate to 'email_reply_agent' using 'generate_reply_with_gemini' with the original subject and body obtained from the summary tool.
-3. Show the generated reply draft to the user and **ask for confirmation** before sending.
-4. If the user confirms, delegate to 'email_sending_agent' using the 'send_reply' tool with all the necessary information gathered from the summary tool and the generated reply body. Use 'me' as the user_id and sender.
-5. Inform the user whether the reply was sent successfully or if an error occurred.
-6. Handle errors gracefully by informing the user.
+# Each specialist only needs to know its own job; the coordinator only needs
+# to know who does what. Keeping these short keeps prompt tokens per hop low.
+SEARCH_INSTRUCTION = """
+Find emails for the user. Use list_recent_emails for "latest"/"recent" requests and search_emails with a Gmail query (e.g. 'from:a@b.com subject:report') for criteria. Use 'me' as user_id. Reply with subject, sender, date and id of each result.
 """
 
-# Create the list of tools for the agent
-# Ensure list_emails_tool and search_emails_tool are included
-agent_tools = [
-    list_emails_tool,
-    search_emails_tool,
-    summarize_email_tool,
-    generate_reply_with_gemini,
-    send_reply_tool,
-]
+SUMMARIZING_INSTRUCTION = """
+Summarize the email the user refers to with summarize_email_with_gemini (user_id 'me'). Take the email_id from the conversation. Reply with the summary.
+"""
+
+REPLY_INSTRUCTION = """
+Draft a reply with generate_reply_with_gemini, using the subject and body of the email summarized earlier in the conversation and the user's instructions. Show the draft and ask the user to confirm before sending.
+"""
+
+SENDING_INSTRUCTION = """
+The user confirmed sending the drafted reply. Call queue_reply with user_id and sender 'me', and to, subject, thread_id, original_message_id and references from the summarized email, and the confirmed draft as reply_body. Tell the user the reply is queued (or was already queued, if 'duplicate' is true). If asked whether a reply went out, call get_send_status.
+"""
+
+COORDINATOR_INSTRUCTION = """
+You route Gmail requests. Transfer to:
+- inbox_search_agent: list recent emails or search by sender/subject/keywords.
+- email_summarizing_agent: summarize an email (find it with inbox_search_agent first if there is no id).
+- email_reply_agent: draft a reply to a summarized email.
+- email_sending_agent: send a drafted reply after the user confirms, or check whether a sent reply went out.
+Answer greetings or unrelated messages briefly yourself.
+"""
 
 EmailRetrievalAgent = Agent(
-    model="gemini-2.0-flash-lite-001",
+    model=MODEL,
     name='inbox_search_agent',
-    description="An agent that helps with listing recent emails or searching the gmail inbox based on criteria.",
-    instruction=AGENT_INSTRUCTION,
-    tools=[list_emails_tool, search_emails_tool],
+    description="Lists recent emails or searches the Gmail inbox based on criteria.",
+    instruction=SEARCH_INSTRUCTION,
+    tools=[list_recent_emails, search_emails],
 )
 
 EmailProcessingAgent = Agent(
-    model="gemini-2.0-flash-lite-001",
+    model=MODEL,
     name='email_summarizing_agent',
-    description="An agent that helps with summarizing specific emails using their ID.",
-    instruction=AGENT_INSTRUCTION,
-    tools=[summarize_email_tool],
+    description="Summarizes a specific email by its ID.",
+    instruction=SUMMARIZING_INSTRUCTION,
+    tools=[summarize_email_with_gemini],
 )
 
 ReplyGenerationAgent = Agent(
-    model="gemini-2.0-flash-lite-001",
+    model=MODEL,
     name='email_reply_agent',
-    description="An agent that helps with generating draft replies to emails.",
-    instruction=AGENT_INSTRUCTION,
+    description="Generates draft replies to emails.",
+    instruction=REPLY_INSTRUCTION,
     tools=[generate_reply_with_gemini],
 )
 
 EmailSendingAgent = Agent(
-    model="gemini-2.0-flash-lite-001",
+    model=MODEL,
     name='email_sending_agent',
-    description="An agent that helps with sending email replies after they have been generated and confirmed.",
-    instruction=AGENT_INSTRUCTION,
-    tools=[send_reply_tool],
+    description="Queues confirmed email replies for sending and reports their delivery status.",
+    instruction=SENDING_INSTRUCTION,
+    tools=[queue_reply, get_send_status],
 )
 
-root_agent = LlmAgent(
-    model="gemini-2.0-flash-lite-001", 
+coordinator_agent = LlmAgent(
+    model=MODEL,
     name='email_coordinator_agent',
-    description="A coordinator agent that understands user requests about Gmail and delegates tasks like listing, searching, summarizing, generating replies, and sending emails to specialized sub-agents.",
-    instruction=AGENT_INSTRUCTION,
+    description="Understands Gmail requests and delegates them to specialized sub-agents.",
+    instruction=COORDINATOR_INSTRUCTION,
+    tools=[get_total_unread_count, get_emails_received_today_count],
     sub_agents=[EmailRetrievalAgent, EmailProcessingAgent, ReplyGenerationAgent, EmailSendingAgent],
 )
 
+
+class PreRoutingCoordinator(BaseAgent):
+    """Routes obvious requests without an LLM hop, falling back to the LLM coordinator.
+
+    Requests matched by routing.route_message are either answered by calling
+    the tool directly (no LLM at all) or handed straight to the right
+    specialist (skipping the coordinator's delegation hop).
+    """
+
+    coordinator: LlmAgent
+
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        text = ""
+        if ctx.user_content and ctx.user_content.parts:
+            text = " ".join(part.text for part in ctx.user_content.parts if part.text)
+        route = route_message(text)
+
+        if route and route.kind == ROUTE_TOOL:
+            result = await asyncio.to_thread(call_direct_tool, route)
+            yield Event(
+                invocation_id=ctx.invocation_id,
+                author=self.name,
+                branch=ctx.branch,
+                content=types.Content(role="model", parts=[types.Part(text=format_tool_result(route.name, result))]),
+            )
+            return
+
+        target = self.coordinator
+        if route and route.kind == ROUTE_AGENT:
+            target = self.coordinator.find_sub_agent(route.name) or self.coordinator
+        async for event in target.run_async(ctx):
+            yield event
+
+
+root_agent = PreRoutingCoordinator(
+    name='email_router',
+    description="Entry point that pre-routes Gmail requests before any LLM call.",
+    coordinator=coordinator_agent,
+    sub_agents=[coordinator_agent],
+)
+
 # --- Run Agent ---
 
 if __name__ == "__main__":
@@ -108,7 +149,16 @@ if __name__ == "__main__":
         print("Failed to authenticate Gmail service. Please check credentials.json and permissions.")
         print("Exiting.")
 
-    session_service = InMemorySessionService()
-    session = session_service.create_session(app_name="AI MAIL", user_id=1234, session_id=123)
-    runner = Runner(agent=root_agent, app_name="AI MAIL", session_service=session_service)
-
+    # Sessions are persisted to SQLite (GMAIL_AGENT_SESSION_DB) so the
+    # conversation survives restarts; resume it if it already exists.
+    session_service = SqliteSessionService()
+    session = (
+        session_service.get_session(app_name="AI MAIL", user_id="1234", session_id="123")
+        or session_service.create_session(app_name="AI MAIL", user_id="1234", session_id="123")
+    )
+    # Records LLM hops and per-hop latency; direct tool answers from the
+    # pre-router are not counted as hops.
+    runner = InstrumentedRunner(
+        agent=root_agent, app_name="AI MAIL", session_service=session_service,
+        non_llm_authors=[root_agent.name],
+    )
@@ -0,0 +1,61 @@
+import json
+import os
+import threading
+
+
+# --- Atomic File Writes ---
+# State files (checkpoints, journals, models, tokens) are written to a
+# temporary file, fsynced, and renamed over the old one, so after a crash or
+# power loss the file holds either the old or the new contents, never a torn
+# mix. The temporary name is unique per process and thread, so concurrent
+# writers don't clobber each other's half-written file.
+def atomic_write_text(path, text):
+    """Atomically and durably replaces the file at path with text (UTF-8)."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, "w", encoding="utf-8") as temp_file:
+            temp_file.write(text)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    _fsync_directory(directory or ".")
+
+
+def atomic_write_json(path, value, lines=False):
+    """Atomically and durably replaces the file at path with value as JSON.
+
+    Args:
+        path: The file to write.
+        value: A JSON-serializable value; with lines, an iterable of them.
+        lines: Write one JSON document per line (a JSON-lines file).
+    """
+    if lines:
+        text = "".join(json.dumps(item) + "\n" for item in value)
+    else:
+        text = json.dumps(value)
+    atomic_write_text(path, text)
+
+
+def _fsync_directory(directory):
+    # Makes the rename itself durable. Not possible on every platform (e.g.
+    # Windows can't open a directory), where the rename is left to the OS.
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+# --- End Atomic File Writes ---
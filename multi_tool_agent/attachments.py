@@ -0,0 +1,418 @@
+import base64
+import codecs
+import csv
+import mmap
+import os
+import re
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+
+import httplib2
+from google.auth.transport.requests import AuthorizedSession
+from googleapiclient.errors import HttpError
+
+from . import cassette
+from .gmail_agent_logic import (
+    find_attachments,
+    get_account_credentials,
+    get_gmail_service,
+    get_service_pool,
+    summarize_long_text_with_gemini,
+)
+from .projection import NEED_ATTACHMENTS, message_projection, wire_meter
+from .resilience import STATE_OPEN, CircuitOpenError, attachment_breaker, gmail_breaker
+
+# --- Attachment Configuration ---
+ATTACHMENT_URL = "https://gmail.googleapis.com/gmail/v1/users/{user_id}/messages/{message_id}/attachments/{attachment_id}"
+ATTACHMENT_METHOD_ID = "gmail.users.messages.attachments.get"
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+READ_CHUNK_BYTES = 1024 * 1024
+DOWNLOAD_TIMEOUT_SECONDS = 30  # Per connect/read; the whole download has the attachment breaker's deadline
+# Upper bound on extracted text kept per attachment; it is also the most the
+# chunked summarizer will ever see, so memory stays bounded for large files.
+MAX_EXTRACTED_CHARS = 200_000
+# Upper bound on one decompressed PDF content stream.
+MAX_PDF_STREAM_BYTES = 8 * 1024 * 1024
+MAX_CACHED_ATTACHMENTS = 32
+SPOOL_DIR = os.environ.get("GMAIL_AGENT_SPOOL_DIR") or None  # None -> system temp dir
+# --- End Attachment Configuration ---
+
+
+# --- Streaming Download ---
+class _Base64SpoolWriter:
+    """Decodes the base64url 'data' field of a streamed JSON body into a file.
+
+    The attachments.get response (requested with fields=data) is a tiny JSON
+    object wrapping one huge base64url string. Base64url never contains '"' or
+    '\\', so the string can be located and decoded chunk by chunk without ever
+    holding the whole payload in memory.
+    """
+
+    def __init__(self, spool):
+        self.spool = spool
+        self.state = "seek"
+        self.prefix = b""
+        self.pending = b""
+
+    def feed(self, chunk):
+        if self.state == "seek":
+            self.prefix += chunk
+            match = re.search(rb'"data"\s*:\s*"', self.prefix)
+            if not match:
+                self.prefix = self.prefix[-64:]
+                return
+            chunk = self.prefix[match.end():]
+            self.prefix = b""
+            self.state = "data"
+        if self.state == "data":
+            end = chunk.find(b'"')
+            if end != -1:
+                chunk = chunk[:end]
+                self.state = "done"
+            self._write(self.pending + chunk, final=self.state == "done")
+
+    def _write(self, data, final=False):
+        if final:
+            data += b"=" * (-len(data) % 4)
+            usable = len(data)
+        else:
+            # Only decode whole 4-character groups; carry the rest to the next chunk.
+            usable = len(data) - len(data) % 4
+        self.spool.write(base64.urlsafe_b64decode(data[:usable]))
+        self.pending = data[usable:]
+
+    def close(self):
+        if self.state != "done":
+            raise ValueError("Attachment response ended before the data field was complete.")
+
+
+def download_attachment(user_id, message_id, attachment):
+    """Streams one attachment into a spool file and returns the file's path.
+
+    Args:
+        user_id: The user's email address or 'me'.
+        message_id: The ID of the message the attachment belongs to.
+        attachment: An entry from find_attachments.
+
+    Returns:
+        The path of a temporary file holding the decoded attachment bytes. The
+        caller is responsible for deleting it.
+    """
+    spool = tempfile.NamedTemporaryFile(prefix="gmail-attachment-", suffix=".spool", dir=SPOOL_DIR, delete=False)
+    try:
+        with spool:
+            if "attachment_id" not in attachment:
+                # Small inline attachment: the data is already in the payload.
+                data = attachment.get("data", "")
+                spool.write(base64.urlsafe_b64decode(data + "=" * (-len(data) % 4)))
+            elif cassette.get_cassette():
+                # Recording/replaying: go through the API client so the
+                # download is captured in (or served from) the cassette.
+                data = get_gmail_service(user_id).users().messages().attachments().get(
+                    userId=user_id, messageId=message_id, id=attachment["attachment_id"], fields="data"
+                ).execute().get("data", "")
+                spool.write(base64.urlsafe_b64decode(data + "=" * (-len(data) % 4)))
+            else:
+                _stream_attachment(user_id, message_id, attachment["attachment_id"], spool)
+        return spool.name
+    except Exception:
+        os.unlink(spool.name)
+        raise
+def _stream_attachment(user_id, message_id, attachment_id, spool):
+    # Streamed outside the API client, so this gives the download what the
+    # client gives every other call: quota pacing, a breaker and deadline
+    # (attachment_breaker; it also fails fast while Gmail's is open), and
+    # wire metering. With a cassette active the download goes through the
+    # client instead (see download_attachment).
+    if gmail_breaker.state == STATE_OPEN:
+        raise CircuitOpenError("Gmail is temporarily unavailable; not downloading the attachment.")
+    get_service_pool().quota.charge(user_id, ATTACHMENT_METHOD_ID)
+    session = AuthorizedSession(get_account_credentials(user_id))
+    url = ATTACHMENT_URL.format(user_id=user_id, message_id=message_id, attachment_id=attachment_id)
+
+    def stream():
+        writer = _Base64SpoolWriter(spool)
+        received = 0
+        with session.get(url, params={"fields": "data"}, stream=True, timeout=DOWNLOAD_TIMEOUT_SECONDS) as response:
+            if response.status_code >= 400:
+                # Same error type as the API client's, so the breaker and callers treat it alike.
+                raise HttpError(httplib2.Response({"status": response.status_code}), response.content, uri=url)
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                received += len(chunk)
+                writer.feed(chunk)
+        writer.close()
+        return received
+
+    received = attachment_breaker.call(stream)
+    wire_meter.record(ATTACHMENT_METHOD_ID, len(url), received)
+# --- End Streaming Download ---
+
+
+# --- Text Extractors ---
+# Extractors receive the attachment as a read-only mmap and return text. Add
+# support for another format with @register_extractor.
+_extractors = []
+
+
+def register_extractor(mime_types=(), extensions=()):
+    """Registers a function(mapped, max_chars) -> str for MIME types / file extensions."""
+    def decorator(func):
+        _extractors.append((set(mime_types), {ext.lower() for ext in extensions}, func))
+        return func
+    return decorator
+
+
+def get_extractor(mime_type, filename):
+    extension = os.path.splitext(filename or "")[1].lower()
+    for mime_types, extensions, func in _extractors:
+        if mime_type in mime_types or extension in extensions:
+            return func
+    return None
+
+
+@register_extractor(
+    mime_types=("text/plain", "text/markdown", "text/html", "application/json", "message/rfc822"),
+    extensions=(".txt", ".md", ".log", ".json", ".html", ".htm", ".eml"),
+)
+def extract_plain_text(mapped, max_chars=MAX_EXTRACTED_CHARS):
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    parts = []
+    total = 0
+    for offset in range(0, len(mapped), READ_CHUNK_BYTES):
+        text = decoder.decode(mapped[offset:offset + READ_CHUNK_BYTES])
+        parts.append(text)
+        total += len(text)
+        if total >= max_chars:
+            break
+    return "".join(parts)[:max_chars]
+
+
+@register_extractor(mime_types=("text/csv", "text/tab-separated-values"), extensions=(".csv", ".tsv"))
+def extract_csv(mapped, max_chars=MAX_EXTRACTED_CHARS):
+    mapped.seek(0)
+    sample = mapped.read(4096).decode("utf-8", errors="replace")
+    mapped.seek(0)
+    delimiter = "\t" if sample.count("\t") > sample.count(",") else ","
+    lines = (line.decode("utf-8", errors="replace") for line in iter(mapped.readline, b""))
+    rows = []
+    total = 0
+    for row in csv.reader(lines, delimiter=delimiter):
+        line = " | ".join(cell.strip() for cell in row)
+        rows.append(line)
+        total += len(line) + 1
+        if total >= max_chars:
+            break
+    return "\n".join(rows)[:max_chars]
+
+
+_PDF_TEXT_BLOCK = re.compile(rb"\bBT\b(.*?)\bET\b", re.S)
+# A literal string, a number (kerning inside TJ arrays) or a line/position operator.
+_PDF_TEXT_TOKEN = re.compile(rb"\(((?:\\.|[^\\)])*)\)|(-?\d*\.?\d+)|(T\*|Td|TD|')", re.S)
+_PDF_ESCAPES = {b"n": b"\n", b"r": b"\r", b"t": b"\t", b"b": b"\b", b"f": b"\f"}
+
+
+def _unescape_pdf_string(raw):
+    def replace(match):
+        escaped = match.group(1)
+        if escaped[:1].isdigit():
+            return bytes([int(escaped, 8) & 0xFF])
+        return _PDF_ESCAPES.get(escaped, escaped)
+    return re.sub(rb"\\([0-7]{1,3}|.)", replace, raw, flags=re.S)
+
+
+@register_extractor(mime_types=("application/pdf",), extensions=(".pdf",))
+def extract_pdf_text(mapped, max_chars=MAX_EXTRACTED_CHARS):
+    """Pulls literal strings out of the text operators of each content stream.
+
+    This covers the common case of PDFs with simple (non-CID) fonts without a
+    third-party parser. Scanned or CID-encoded PDFs yield little or no text.
+    """
+    lines = []
+    total = 0
+    position = 0
+    while total < max_chars:
+        start = mapped.find(b"stream", position)
+        if start == -1:
+            break
+        position = start + len(b"stream")
+        if mapped[max(0, start - 3):start] == b"end":
+            continue
+        data_start = position + (2 if mapped[position:position + 2] == b"\r\n" else 1)
+        end = mapped.find(b"endstream", data_start)
+        if end == -1:
+            break
+        position = end + len(b"endstream")
+        dictionary = mapped[max(0, start - 512):start]
+        dictionary = dictionary[dictionary.rfind(b"<<"):]
+        if b"/Image" in dictionary or b"/FontFile" in dictionary:
+            continue
+        content = mapped[data_start:end]
+        if b"/FlateDecode" in dictionary:
+            try:
+                content = zlib.decompressobj().decompress(content, MAX_PDF_STREAM_BYTES)
+            except zlib.error:
+                continue
+        for block in _PDF_TEXT_BLOCK.finditer(content):
+            pieces = []
+            for token in _PDF_TEXT_TOKEN.finditer(block.group(1)):
+                string, number, operator = token.groups()
+                if string is not None:
+                    pieces.append(_unescape_pdf_string(string))
+                elif number is not None and float(number) <= -200:
+                    pieces.append(b" ")  # Large kerning gap inside a TJ array is a word break.
+                elif operator in (b"Td", b"TD"):
+                    pieces.append(b" ")
+                elif operator is not None:
+                    pieces.append(b"\n")
+            line = re.sub(r"[ \t]+", " ", b"".join(pieces).decode("latin-1")).strip()
+            if line:
+                lines.append(line)
+                total += len(line) + 1
+    return "\n".join(lines)[:max_chars]
+# --- End Text Extractors ---
+
+
+# --- Extracted Text Cache ---
+# Keyed by message ID and MIME part ID: Gmail hands out a different
+# attachmentId for the same attachment on every messages.get, so the part ID
+# is the stable identity of an attachment within a message.
+_text_cache = OrderedDict()
+_text_cache_lock = threading.Lock()
+
+
+def _cache_get(key):
+    with _text_cache_lock:
+        if key in _text_cache:
+            _text_cache.move_to_end(key)
+            return _text_cache[key]
+    return None
+
+
+def _cache_put(key, value):
+    with _text_cache_lock:
+        _text_cache[key] = value
+        _text_cache.move_to_end(key)
+        while len(_text_cache) > MAX_CACHED_ATTACHMENTS:
+            _text_cache.popitem(last=False)
+# --- End Extracted Text Cache ---
+
+
+def get_attachment_text(user_id, message_id, attachment):
+    """Returns the extracted text of an attachment, downloading it if not cached.
+
+    Raises:
+        ValueError: If there is no extractor for the attachment's type.
+    """
+    cache_key = (user_id, message_id, attachment.get("part_id") or attachment["filename"])
+    text = _cache_get(cache_key)
+    if text is not None:
+        return text
+
+    extractor = get_extractor(attachment["mime_type"], attachment["filename"])
+    if not extractor:
+        raise ValueError(f"Unsupported attachment type: {attachment['mime_type']} ({attachment['filename']}).")
+
+    spool_path = download_attachment(user_id, message_id, attachment)
+    try:
+        if os.path.getsize(spool_path) == 0:
+            text = ""
+        else:
+            with open(spool_path, "rb") as spool, mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                text = extractor(mapped)
+    finally:
+        os.unlink(spool_path)
+    _cache_put(cache_key, text)
+    return text
+
+
+def _get_message_attachments(service, user_id, email_id):
+    message = service.users().messages().get(
+        userId=user_id, id=email_id, **message_projection(NEED_ATTACHMENTS)
+    ).execute()
+    return find_attachments(message.get('payload', {}))
+
+
+# --- Added Function to List Attachments ---
+def list_email_attachments(user_id: str, email_id: str) -> dict:
+    """Lists the attachments of a specific email.
+
+    Args:
+        user_id: The user's email address or 'me'.
+        email_id: The ID of the email message.
+
+    Returns:
+        A dictionary containing the 'status' ('success' or 'error'),
+        and either 'attachments' (a list with 'filename', 'mime_type' and
+        'size') on success, or 'error_message' on failure.
+    """
+    service = get_gmail_service(user_id)
+    if not service:
+        return {"status": "error", "error_message": "Failed to get Gmail service."}
+    try:
+        attachments = _get_message_attachments(service, user_id, email_id)
+        return {
+            "status": "success",
+            "attachments": [
+                {key: attachment[key] for key in ("filename", "mime_type", "size")}
+                for attachment in attachments
+            ],
+        }
+    except HttpError as error:
+        return {"status": "error", "error_message": f"An API error occurred listing attachments: {error}"}
+    except Exception as e:
+        return {"status": "error", "error_message": f"An unexpected error occurred listing attachments: {e}"}
+# --- End Added Function to List Attachments ---
+
+
+# --- Added Function to Summarize Attachment ---
+def summarize_attachment(user_id: str, email_id: str, filename: str = "") -> dict:
+    """Extracts the text of an email attachment (plain text, CSV or PDF) and summarizes it.
+
+    Args:
+        user_id: The user's email address or 'me'.
+        email_id: The ID of the email message the attachment belongs to.
+        filename: The attachment's file name, or part of it. Leave empty to use
+            the first attachment with a supported type.
+
+    Returns:
+        A dictionary containing the 'status' ('success' or 'error'),
+        and either 'summary', 'filename' and 'extracted_chars' on success,
+        or 'error_message' on failure.
+    """
+    service = get_gmail_service(user_id)
+    if not service:
+        return {"status": "error", "error_message": "Failed to get Gmail service."}
+    try:
+        attachments = _get_message_attachments(service, user_id, email_id)
+        if not attachments:
+            return {"status": "error", "error_message": f"Email {email_id} has no attachments."}
+        if filename:
+            matches = [a for a in attachments if filename.lower() in a["filename"].lower()]
+        else:
+            matches = [a for a in attachments if get_extractor(a["mime_type"], a["filename"])]
+        if not matches:
+            names = ", ".join(a["filename"] for a in attachments)
+            return {"status": "error", "error_message": f"No matching attachment with a supported type. Attachments: {names}"}
+        attachment = matches[0]
+
+        text = get_attachment_text(user_id, email_id, attachment)
+        if not text.strip():
+            return {"status": "error", "error_message": f"Could not extract any text from {attachment['filename']}."}
+
+        summary_result = summarize_long_text_with_gemini(attachment["filename"], text)
+        if summary_result["status"] != "success":
+            return summary_result
+        return {
+            "status": "success",
+            "summary": summary_result["summary"],
+            "filename": attachment["filename"],
+            "extracted_chars": len(text),
+        }
+    except HttpError as error:
+        return {"status": "error", "error_message": f"An API error occurred fetching the attachment: {error}"}
+    except Exception as e:
+        error_type = type(e).__name__
+        return {"status": "error", "error_message": f"An unexpected error occurred summarizing the attachment: {error_type}: {e}"}
+# --- End Added Function to Summarize Attachment ---
@@ -0,0 +1,332 @@
+import base64
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import httplib2
+
+# --- Cassette Configuration ---
+# GMAIL_AGENT_CASSETTE_MODE: 'off' (default), 'record' or 'replay'.
+# GMAIL_AGENT_CASSETTE: cassette file. Defaults to a new timestamped file under
+#   cassettes/ when recording; required when replaying.
+# GMAIL_AGENT_REPLAY_SPEED: 'recorded' (sleep for each call's recorded
+#   duration; the gaps between calls are whatever the replaying app takes),
+#   'timeline' (also hold each call until its recorded offset from the start,
+#   reproducing the gaps and overlap between calls) or 'fast' (no delays).
+CASSETTE_MODE = os.environ.get("GMAIL_AGENT_CASSETTE_MODE", "off").lower()
+CASSETTE_PATH = os.environ.get("GMAIL_AGENT_CASSETTE")
+REPLAY_SPEED = os.environ.get("GMAIL_AGENT_REPLAY_SPEED", "recorded").lower()
+CASSETTE_DIR = "cassettes"
+
+MODE_OFF = "off"
+MODE_RECORD = "record"
+MODE_REPLAY = "replay"
+
+SPEED_RECORDED = "recorded"
+SPEED_TIMELINE = "timeline"
+SPEED_FAST = "fast"
+
+SCRUBBED = "<scrubbed>"
+_SECRET_HEADERS = {"authorization", "cookie", "set-cookie", "x-goog-api-key", "proxy-authorization"}
+_SECRET_PARAMS = {"key", "access_token", "oauth_token", "api_key"}
+_SECRET_JSON_KEYS = re.compile(
+    r'("(?:access_token|refresh_token|id_token|client_secret|api_key)"\s*:\s*)"[^"]*"'
+)
+_BATCH_CONTENT_ID = re.compile(r"Content-ID: <(?:response-)?([^+>]+)\+")
+# --- End Cassette Configuration ---
+
+
+# --- Scrubbing ---
+def scrub_uri(uri):
+    parts = urlsplit(uri)
+    query = [(key, SCRUBBED if key in _SECRET_PARAMS else value) for key, value in parse_qsl(parts.query, keep_blank_values=True)]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def scrub_headers(headers):
+    return {key: (SCRUBBED if key.lower() in _SECRET_HEADERS else value) for key, value in (headers or {}).items()}
+
+
+def scrub_text(text):
+    return _SECRET_JSON_KEYS.sub(lambda match: f'{match.group(1)}"{SCRUBBED}"', text)
+# --- End Scrubbing ---
+
+
+def _encode_body(body):
+    if body is None:
+        return None, None
+    if isinstance(body, str):
+        return scrub_text(body), "text"
+    try:
+        return scrub_text(body.decode("utf-8")), "text"
+    except UnicodeDecodeError:
+        return base64.b64encode(body).decode("ascii"), "base64"
+
+
+def _decode_body(text, encoding):
+    if text is None:
+        return b""
+    if encoding == "base64":
+        return base64.b64decode(text)
+    return text.encode("utf-8")
+
+
+def _prompt_key(args, kwargs):
+    payload = json.dumps([args, kwargs], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Cassette:
+    """A gzip-compressed JSON-lines file of recorded Gmail and Gemini interactions.
+
+    Each line holds one interaction: its kind ('gmail' or 'gemini'), the
+    offset from the start of recording, the call's duration, and the scrubbed
+    request and response. In replay mode, interactions are served in recorded
+    order per request key (HTTP method and URI for Gmail, prompt hash for
+    Gemini, falling back to recorded order).
+    """
+
+    def __init__(self, path, mode, speed=REPLAY_SPEED):
+        self.path = path
+        self.mode = mode
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._queues = defaultdict(deque)
+        self._gemini_order = deque()
+        if mode == MODE_RECORD:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = gzip.open(path, "at", encoding="utf-8")
+        elif mode == MODE_REPLAY:
+            self._load()
+
+    def _load(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as cassette_file:
+            for line in cassette_file:
+                interaction = json.loads(line)
+                if interaction["kind"] == "gmail":
+                    request = interaction["request"]
+                    self._queues[("gmail", request["method"], request["uri"])].append(interaction)
+                else:
+                    self._queues[("gemini", interaction["request"]["key"])].append(interaction)
+                    self._gemini_order.append(interaction)
+        print(f"Replaying cassette {self.path}.")
+
+    def record(self, kind, request, response, started, duration):
+        interaction = {
+            "kind": kind,
+            "t": round(started - self._started, 4),
+            "duration": round(duration, 4),
+            "request": request,
+            "response": response,
+        }
+        with self._lock:
+            self._file.write(json.dumps(interaction, separators=(",", ":")) + "\n")
+            self._file.flush()
+
+    def _take(self, key):
+        with self._lock:
+            queue = self._queues.get(key)
+            if not queue:
+                return None
+            interaction = queue.popleft()
+            if interaction["kind"] == "gemini":
+                self._gemini_order.remove(interaction)
+            return interaction
+
+    def take_gmail(self, method, uri):
+        interaction = self._take(("gmail", method, scrub_uri(uri)))
+        if interaction is None:
+            raise LookupError(f"No recorded Gmail interaction for {method} {scrub_uri(uri)}")
+        self._pace(interaction)
+        return interaction
+
+    def take_gemini(self, key):
+        interaction = self._take(("gemini", key))
+        if interaction is None:
+            # Prompts embedding volatile data (times, context) won't hash the
+            # same; fall back to the next unused Gemini call in recorded order.
+            with self._lock:
+                if not self._gemini_order:
+                    raise LookupError("No recorded Gemini interactions left in the cassette.")
+                interaction = self._gemini_order.popleft()
+                self._queues[("gemini", interaction["request"]["key"])].remove(interaction)
+        self._pace(interaction)
+        return interaction
+
+    def _pace(self, interaction):
+        if self.speed == SPEED_TIMELINE:
+            # Offsets count from when the cassette was opened, in both modes.
+            wait = interaction.get("t", 0) - (time.monotonic() - self._started)
+            if wait > 0:
+                time.sleep(wait)
+        if self.speed in (SPEED_RECORDED, SPEED_TIMELINE):
+            time.sleep(interaction.get("duration", 0))
+
+    def close(self):
+        """Finishes a recording (a gzip file is only readable to the end once closed)."""
+        if self.mode == MODE_RECORD:
+            with self._lock:
+                self._file.close()
+
+
+# --- Gmail HTTP Wrappers ---
+class RecordingHttp:
+    """Wraps an (authorized) httplib2-style object and records every request."""
+
+    def __init__(self, inner, cassette):
+        self._inner = inner
+        self._cassette = cassette
+
+    def __getattr__(self, name):
+        return getattr(self._inner, name)
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        started = time.monotonic()
+        response, content = self._inner.request(uri, method, body, headers, *args, **kwargs)
+        duration = time.monotonic() - started
+        request_body, request_encoding = _encode_body(body)
+        content_text, content_encoding = _encode_body(content)
+        self._cassette.record(
+            "gmail",
+            {"method": method, "uri": scrub_uri(uri), "headers": scrub_headers(headers),
+             "body": request_body, "encoding": request_encoding},
+            {"headers": scrub_headers(dict(response)), "content": content_text, "encoding": content_encoding},
+            started,
+            duration,
+        )
+        return response, content
+
+
+class ReplayHttp:
+    """httplib2-style object that answers requests from a cassette."""
+
+    def __init__(self, cassette):
+        self._cassette = cassette
+        self.credentials = None
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        interaction = self._cassette.take_gmail(method, uri)
+        recorded = interaction["response"]
+        content = _decode_body(recorded["content"], recorded["encoding"])
+        # Batch responses are matched to requests by a random Content-ID base
+        # chosen per batch; swap the recorded base for the current one.
+        if body and "multipart/mixed" in (headers or {}).get("content-type", ""):
+            current = _BATCH_CONTENT_ID.search(body if isinstance(body, str) else body.decode("utf-8", "replace"))
+            old = _BATCH_CONTENT_ID.search(interaction["request"].get("body") or "")
+            if current and old:
+                content = content.replace(old.group(1).encode(), current.group(1).encode())
+        return httplib2.Response(recorded["headers"]), content
+
+    def close(self):
+        pass
+# --- End Gmail HTTP Wrappers ---
+
+
+# --- Gemini Model Wrappers ---
+def _response_to_dict(response):
+    try:
+        return response.to_dict()
+    except Exception:
+        return {"text": getattr(response, "text", str(response))}
+
+
+class RecordingModel:
+    """Proxies a GenerativeModel and records every generate_content call."""
+
+    def __init__(self, model, cassette):
+        self._model = model
+        self._cassette = cassette
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+    def generate_content(self, *args, **kwargs):
+        started = time.monotonic()
+        response = self._model.generate_content(*args, **kwargs)
+        duration = time.monotonic() - started
+        self._cassette.record(
+            "gemini",
+            {"model": getattr(self._model, "model_name", None), "key": _prompt_key(args, kwargs),
+             "prompt": scrub_text(json.dumps([args, kwargs], default=str))},
+            _response_to_dict(response),
+            started,
+            duration,
+        )
+        return response
+
+
+class ReplayModel:
+    """Stands in for a GenerativeModel, serving generate_content from a cassette."""
+
+    def __init__(self, cassette, model_name=None):
+        self._cassette = cassette
+        self.model_name = model_name
+
+    def generate_content(self, *args, **kwargs):
+        from google.generativeai import protos
+        from google.generativeai.types import GenerateContentResponse
+
+        recorded = self._cassette.take_gemini(_prompt_key(args, kwargs))["response"]
+        if "candidates" not in recorded:
+            recorded = {"candidates": [{"content": {"role": "model", "parts": [{"text": recorded.get("text", "")}]}}]}
+        return GenerateContentResponse.from_response(protos.GenerateContentResponse(recorded))
+# --- End Gemini Model Wrappers ---
+
+
+# --- Module-Level Cassette ---
+_cassette = None
+_cassette_lock = threading.Lock()
+
+
+def get_cassette():
+    """Returns the process-wide cassette for the configured mode, or None when off."""
+    global _cassette
+    if CASSETTE_MODE not in (MODE_RECORD, MODE_REPLAY):
+        return None
+    with _cassette_lock:
+        if _cassette is None:
+            path = CASSETTE_PATH
+            if not path:
+                if CASSETTE_MODE == MODE_REPLAY:
+                    raise ValueError("GMAIL_AGENT_CASSETTE must name the cassette to replay.")
+                path = os.path.join(CASSETTE_DIR, time.strftime("%Y%m%d-%H%M%S") + ".jsonl.gz")
+            _cassette = Cassette(path, CASSETTE_MODE)
+        return _cassette
+
+
+def is_replaying():
+    return CASSETTE_MODE == MODE_REPLAY
+
+
+def wrap_http(http):
+    """Returns http wrapped for recording when record mode is on, else http unchanged."""
+    cassette = get_cassette()
+    if cassette and cassette.mode == MODE_RECORD:
+        return RecordingHttp(http, cassette)
+    return http
+
+
+def replay_http():
+    return ReplayHttp(get_cassette())
+
+
+def wrap_model(model, model_name=None):
+    """Returns the model wrapped for the active mode (a replay stand-in when replaying)."""
+    cassette = get_cassette()
+    if cassette is None:
+        return model
+    if cassette.mode == MODE_REPLAY:
+        return ReplayModel(cassette, model_name or getattr(model, "model_name", None))
+    if model is None:
+        return None
+    return RecordingModel(model, cassette)
+# --- End Module-Level Cassette ---
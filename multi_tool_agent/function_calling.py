@@ -0,0 +1,134 @@
+import inspect
+import re
+
+# --- Function Declaration Builder ---
+# Gemini native function calling needs an OpenAPI-style schema for every tool.
+# Rather than maintaining those by hand, derive them from the Python signatures
+# and Google-style docstrings already written for the tools in gmail_agent_logic.
+
+# Parameters filled in by the caller rather than the model (always 'me' here).
+HIDDEN_PARAMETERS = ("user_id",)
+
+_TYPE_NAMES = {
+    str: "STRING",
+    int: "INTEGER",
+    float: "NUMBER",
+    bool: "BOOLEAN",
+}
+
+
+def _parse_docstring(doc):
+    """Splits a Google-style docstring into a description and per-argument docs."""
+    doc = inspect.cleandoc(doc or "")
+    description_lines = []
+    arg_docs = {}
+    section = None
+    current_arg = None
+    for line in doc.splitlines():
+        stripped = line.strip()
+        if stripped in ("Args:", "Arguments:"):
+            section = "args"
+            continue
+        if stripped in ("Returns:", "Raises:", "Yields:"):
+            section = "other"
+            continue
+        if section is None:
+            if stripped:
+                description_lines.append(stripped)
+        elif section == "args" and stripped:
+            match = re.match(r"^(\w+)\s*(\(.*?\))?:\s*(.*)$", stripped)
+            if match and not line.startswith(" " * 8):
+                current_arg = match.group(1)
+                arg_docs[current_arg] = match.group(3)
+            elif current_arg:
+                arg_docs[current_arg] = f"{arg_docs[current_arg]} {stripped}".strip()
+    return " ".join(description_lines), arg_docs
+
+
+def build_function_declaration(func, hidden_parameters=HIDDEN_PARAMETERS):
+    """Builds a Gemini function declaration (as a dict) from a Python function.
+
+    Args:
+        func: The tool function. Its signature provides the parameter names,
+            types and defaults; its docstring provides the descriptions.
+        hidden_parameters: Parameter names the model should not be asked for.
+
+    Returns:
+        A dictionary with 'name', 'description' and 'parameters' keys, suitable
+        for the 'function_declarations' list of a Gemini tool.
+    """
+    description, arg_docs = _parse_docstring(func.__doc__)
+    properties = {}
+    required = []
+    for name, param in inspect.signature(func).parameters.items():
+        if name in hidden_parameters:
+            continue
+        type_name = _TYPE_NAMES.get(param.annotation, "STRING")
+        properties[name] = {"type": type_name}
+        if name in arg_docs:
+            properties[name]["description"] = arg_docs[name]
+        if param.default is inspect.Parameter.empty:
+            required.append(name)
+
+    declaration = {"name": func.__name__, "description": description}
+    if properties:
+        declaration["parameters"] = {
+            "type": "OBJECT",
+            "properties": properties,
+            "required": required,
+        }
+    return declaration
+
+
+def build_tool(functions, hidden_parameters=HIDDEN_PARAMETERS, declarations=()):
+    """Wraps the declarations for several functions into one Gemini tool dict.
+
+    Args:
+        functions: The tool functions to declare (see build_function_declaration).
+        hidden_parameters: Parameter names the model should not be asked for.
+        declarations: Ready-made declaration dicts to add, for calls that are
+            not backed by a tool function.
+    """
+    return {
+        "function_declarations": [
+            build_function_declaration(func, hidden_parameters) for func in functions
+        ] + list(declarations)
+    }
+# --- End Function Declaration Builder ---
+
+
+# --- Response Parsing ---
+def _to_python(value):
+    """Converts proto map/list composites returned by the SDK into plain Python."""
+    if hasattr(value, "items"):
+        return {key: _to_python(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)) or type(value).__name__ == "RepeatedComposite":
+        return [_to_python(item) for item in value]
+    if isinstance(value, float) and value.is_integer():
+        # Gemini returns every number as a float; tools expect ints for counts.
+        return int(value)
+    return value
+
+
+def extract_function_calls(response):
+    """Returns the function calls and any text from a generate_content response.
+
+    Args:
+        response: The response returned by GenerativeModel.generate_content.
+
+    Returns:
+        A tuple (calls, text) where 'calls' is a list of (name, args) tuples in
+        the order the model emitted them and 'text' is the concatenated text
+        parts (an empty string if the model only called functions).
+    """
+    calls = []
+    text_parts = []
+    for candidate in response.candidates[:1]:
+        for part in candidate.content.parts:
+            function_call = getattr(part, "function_call", None)
+            if function_call and function_call.name:
+                calls.append((function_call.name, _to_python(function_call.args) or {}))
+            elif getattr(part, "text", None):
+                text_parts.append(part.text)
+    return calls, "".join(text_parts).strip()
+# --- End Response Parsing ---
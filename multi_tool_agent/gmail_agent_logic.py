@@ -1,6 +1,10 @@
 import os.path
 import base64
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import os  # Added for environment variables
+import time
 import google.generativeai as genai  # Added for Gemini
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -15,9 +19,25 @@ from google.adk.tools import FunctionTool
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from . import cassette
+from .atomic_files import atomic_write_text
+from .profiling import turn_task
+from .projection import (
+    LABEL_UNREAD_FIELDS,
+    LIST_COUNT_FIELDS,
+    LIST_IDS_FIELDS,
+    NEED_BODY,
+    NEED_HEADERS,
+    PROFILE_ADDRESS_FIELDS,
+    message_projection,
+)
+from .resilience import GEMINI_DEADLINE_SECONDS, GMAIL_DEADLINE_SECONDS, guard_model, serve_stale_on_error, stale_cache
+from .service_pool import ServicePool
+from .shared_cache import get_shared_cache
+from .triage import get_triage_scorer
+
 # If modifying these scopes, delete the file token.json.
 # --- Modified Scopes ---
 SCOPES = ["https://www.googleapis.com/auth/gmail.modify"]  # Changed to allow sending/replyingE"
@@ -43,6 +63,9 @@ except ValueError as e:
 except Exception as e:
     print(f"An unexpected error occurred during Gemini configuration: {e}")
     gemini_model = None
+# Record or replay Gemini traffic when GMAIL_AGENT_CASSETTE_MODE is set, and
+# put every call behind the Gemini circuit breaker and deadline.
+gemini_model = guard_model(cassette.wrap_model(gemini_model, 'gemini-1.5-flash'))
 # --- End Gemini Configuration ---
 
 
@@ -86,7 +109,231 @@ def get_email_body(payload):
 # --- End Helper Function ---
 
 
+# --- Helper Function to Find Attachments ---
+def find_attachments(payload):
+    """Walks the email payload and returns the attachment parts.
+
+    Each entry has 'part_id', 'filename', 'mime_type', 'size', and either 'attachment_id'
+    (fetch with messages.attachments.get) or 'data' (small inline attachments
+    whose base64url content is already in the payload).
+    """
+    attachments = []
+    for part in payload.get("parts", []):
+        body = part.get("body", {})
+        if part.get("filename"):
+            attachment = {
+                "part_id": part.get("partId", ""),
+                "filename": part["filename"],
+                "mime_type": part.get("mimeType", "application/octet-stream"),
+                "size": body.get("size", 0),
+            }
+            if body.get("attachmentId"):
+                attachment["attachment_id"] = body["attachmentId"]
+            else:
+                attachment["data"] = body.get("data", "")
+            attachments.append(attachment)
+        if "parts" in part:
+            attachments.extend(find_attachments(part))
+    return attachments
+# --- End Helper Function ---
+
+
+# --- Batch Fetch Helpers ---
+# Gmail recommends at most 50 requests per batch; larger batches get rate limited.
+BATCH_SIZE = 50
+BATCH_RETRY_ROUNDS = 3
+BATCH_RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+LIST_METADATA_HEADERS = ['Subject', 'From', 'Date']
+
+
+def fetch_messages_batch(service, user_id, message_ids, need=NEED_HEADERS, metadata_headers=None):
+    """Fetches many messages using batched HTTP requests.
+
+    Args:
+        service: The Gmail API service.
+        user_id: The user's email address or 'me'.
+        message_ids: The IDs of the messages to fetch.
+        need: What the caller reads (a projection.NEED_* value); picks the
+            messages.get format and fields mask.
+        metadata_headers: Headers to include for NEED_HEADERS.
+
+    Returns:
+        A dictionary mapping message ID to the message resource. Messages that
+        still fail after retrying rate-limit/server errors are left out.
+    """
+    messages = {}
+    remaining = list(dict.fromkeys(message_ids))  # De-duplicate, keep order
+    projection = message_projection(need, metadata_headers)
+    for attempt in range(BATCH_RETRY_ROUNDS):
+        retry = []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                messages[request_id] = response
+            elif isinstance(exception, HttpError) and exception.resp.status in BATCH_RETRYABLE_STATUS_CODES:
+                retry.append(request_id)
+            else:
+                print(f"Error fetching message {request_id}: {exception}")
+
+        for start in range(0, len(remaining), BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=callback)
+            for msg_id in remaining[start:start + BATCH_SIZE]:
+                batch.add(service.users().messages().get(userId=user_id, id=msg_id, **projection), request_id=msg_id)
+            batch.execute()
+
+        if not retry:
+            break
+        remaining = retry
+        time.sleep(2 ** attempt)  # Back off before retrying throttled requests
+    else:
+        print(f"Giving up on {len(remaining)} messages after {BATCH_RETRY_ROUNDS} batch attempts.")
+    return messages
+
+
+def email_details_from_metadata(msg):
+    """Builds the listing dict ('id', 'threadId', 'subject', 'from', 'date', 'labels') for a message."""
+    payload = msg.get('payload', {})
+    headers = payload.get('headers', [])
+    subject = 'No Subject'
+    sender = 'Unknown Sender'
+    date = 'No Date'
+
+    for header in headers:
+        name = header['name'].lower()
+        if name == 'subject':
+            subject = header['value']
+        elif name == 'from':
+            sender = header['value']
+        elif name == 'date':
+            date = header['value']
+
+    return {
+        'id': msg.get('id'),
+        'threadId': msg.get('threadId'),
+        'subject': subject,
+        'from': sender,
+        'date': date,
+        'labels': msg.get('labelIds', []),
+    }
+
+
+def email_details_from_message(msg):
+    """Builds the reply-ready details of a message fetched with format='full'.
+
+    Returns a dict with 'id', 'subject', 'original_body', 'sender_email',
+    'thread_id', 'original_message_id' and 'references'.
+    """
+    payload = msg.get('payload', {})
+    subject = 'No Subject'
+    sender_email = ''
+    original_message_id = ''
+    references = ''
+    for header in payload.get('headers', []):
+        name = header['name'].lower()
+        if name == 'subject':
+            subject = header['value']
+        elif name == 'from':
+            if '<' in header['value'] and '>' in header['value']:
+                sender_email = header['value'][header['value'].find('<')+1:header['value'].find('>')]
+            else:
+                sender_email = header['value'] # Handle cases without <>
+        elif name == 'message-id':
+            original_message_id = header['value']
+        elif name == 'references':
+            references = header['value']
+
+    return {
+        'id': msg.get('id'),
+        'subject': subject,
+        'original_body': get_email_body(payload),
+        'sender_email': sender_email,
+        'thread_id': msg.get('threadId'),
+        'original_message_id': original_message_id,
+        'references': references,
+    }
+# --- End Batch Fetch Helpers ---
+
+
+# --- Message Caches ---
+# A message's content never changes (only its labels do), so the details
+# built from its body and its summary are cached per message: opening an
+# email and then summarizing it fetches it once. Details are kept in this
+# process and, like summaries and listing metadata, in the shared tier that
+# every worker process reads (see shared_cache.py). Listing metadata carries
+# labels, so it expires quickly and is dropped when the mail watcher sees
+# the message's labels change.
+MAX_CACHED_MESSAGE_DETAILS = 200
+DETAILS_TTL_SECONDS = 7 * 24 * 3600
+SUMMARY_TTL_SECONDS = 7 * 24 * 3600
+METADATA_TTL_SECONDS = 300
+SUMMARY_CACHE_TAG = 'gemini-1.5-flash'  # Part of summary keys: another model means new summaries
+_message_details_cache = OrderedDict()
+_message_details_lock = threading.Lock()
+
+
+def get_message_details(service, user_id, email_id):
+    """Returns email_details_from_message for a message, fetching its body only on a cache miss."""
+    key = (user_id, email_id)
+    with _message_details_lock:
+        details = _message_details_cache.get(key)
+        if details is not None:
+            _message_details_cache.move_to_end(key)
+            return details
+
+    def fetch_details():
+        message = service.users().messages().get(userId=user_id, id=email_id, **message_projection(NEED_BODY)).execute()
+        return email_details_from_message(message)
+
+    details = get_shared_cache().get_or_fill("details", user_id, (email_id,), fetch_details, DETAILS_TTL_SECONDS,
+                                             fill_seconds=GMAIL_DEADLINE_SECONDS)
+    with _message_details_lock:
+        _message_details_cache[key] = details
+        while len(_message_details_cache) > MAX_CACHED_MESSAGE_DETAILS:
+            _message_details_cache.popitem(last=False)
+    return details
+
+
+def fetch_listing_details(service, user_id, message_ids):
+    """Returns the listing dicts (see email_details_from_metadata) of messages, in order.
+
+    Only messages missing from the shared cache are fetched, in one batch.
+    """
+    shared = get_shared_cache()
+    cached = shared.get_many("metadata", user_id, [(msg_id,) for msg_id in message_ids])
+    details = {parts[0]: value for parts, value in cached.items()}
+    missing = [msg_id for msg_id in message_ids if msg_id not in details]
+    if missing:
+        fetched = fetch_messages_batch(service, user_id, missing, metadata_headers=LIST_METADATA_HEADERS)
+        fetched_details = {msg_id: email_details_from_metadata(msg) for msg_id, msg in fetched.items()}
+        shared.put_many("metadata", user_id, {(msg_id,): value for msg_id, value in fetched_details.items()},
+                        METADATA_TTL_SECONDS)
+        details.update(fetched_details)
+    return [details[msg_id] for msg_id in message_ids if msg_id in details]
+
+
+def invalidate_cached_message(user_id, email_id, deleted=False):
+    """Drops a message's cached listing metadata (its labels changed) and, once deleted, everything else."""
+    shared = get_shared_cache()
+    shared.delete("metadata", user_id, email_id)
+    if deleted:
+        with _message_details_lock:
+            _message_details_cache.pop((user_id, email_id), None)
+        shared.delete("details", user_id, email_id)
+        shared.delete("summary", user_id, email_id, SUMMARY_CACHE_TAG)
+
+
+def invalidate_cached_mailbox(user_id):
+    """Drops everything cached about an account, in every worker (e.g. after a history resync)."""
+    with _message_details_lock:
+        for key in [key for key in _message_details_cache if key[0] == user_id]:
+            del _message_details_cache[key]
+    stale_cache.invalidate_user(user_id)
+    get_shared_cache().invalidate_user(user_id)
+# --- End Message Caches ---
+
+
 # --- Added Function to List Recent Emails ---
+@serve_stale_on_error
 def list_recent_emails(user_id: str, max_results: int) -> dict:
     """Lists the most recent emails from the user's inbox.
 
@@ -98,53 +345,29 @@ def list_recent_emails(user_id: str, max_results: int) -> dict:
         A dictionary containing the 'status' ('success' or 'error'),
         and either 'emails' (a list of email details) on success,
         or 'error_message' on failure. Each email detail includes
-        'id', 'threadId', 'subject', 'from', and 'date'.
+        'id', 'threadId', 'subject', 'from', 'date', 'labels', 'priority'
+        (0-1) and 'recency' (0 = newest); emails are ordered by priority,
+        highest first.
     """
-    service = get_gmail_service()
+    service = get_gmail_service(user_id)
     if not service:
         return {"status": "error", "error_message": "Failed to get Gmail service."}
 
     try:
         # List messages
         results = service.users().messages().list(
-            userId=user_id, labelIds=['INBOX'], maxResults=max_results
+            userId=user_id, labelIds=['INBOX'], maxResults=max_results, fields=LIST_IDS_FIELDS
         ).execute()
         messages = results.get('messages', [])
 
         if not messages:
             return {"status": "success", "emails": []} # Return success with empty list
 
-        email_list = []
-        for msg_stub in messages:
-            msg_id = msg_stub['id']
-            # Fetch metadata for each message
-            msg = service.users().messages().get(
-                userId=user_id, id=msg_id, format='metadata',
-                metadataHeaders=['Subject', 'From', 'Date']
-            ).execute()
-
-            payload = msg.get('payload', {})
-            headers = payload.get('headers', [])
-            subject = 'No Subject'
-            sender = 'Unknown Sender'
-            date = 'No Date'
-
-            for header in headers:
-                name = header['name'].lower()
-                if name == 'subject':
-                    subject = header['value']
-                elif name == 'from':
-                    sender = header['value']
-                elif name == 'date':
-                    date = header['value']
-
-            email_list.append({
-                'id': msg_id,
-                'threadId': msg.get('threadId'),
-                'subject': subject,
-                'from': sender,
-                'date': date
-            })
+        # Fetch metadata for all uncached messages in one batched round trip
+        message_ids = [msg_stub['id'] for msg_stub in messages]
+        email_list = fetch_listing_details(service, user_id, message_ids)
+        # Most important first, by the local triage model
+        email_list = get_triage_scorer().rank(email_list)
 
         return {"status": "success", "emails": email_list}
 
@@ -156,6 +379,7 @@ def list_recent_emails(user_id: str, max_results: int) -> dict:
 
 
 # --- Summarization Function ---
+@serve_stale_on_error
 def summarize_email_with_gemini(user_id: str, email_id: str) -> dict:
     """Fetches a specific email by its ID and summarizes its content using an LLM.
        Requires Gmail service to be available via get_gmail_service().
@@ -166,66 +390,36 @@ def summarize_email_with_gemini(user_id: str, email_id: str) -> dict:
 
     Returns:
         A dictionary containing the 'status' ('success' or 'error'),
-        and either 'summary', 'subject', 'original_body', 'sender_email',
+        and either 'summary', 'id', 'subject', 'original_body', 'sender_email',
         'thread_id', 'original_message_id', 'references' on success,
         or 'error_message' on failure.
     """
-    service = get_gmail_service() # Get service when function is called
+    service = get_gmail_service(user_id) # Get service when function is called
     if not service:
         return {"status": "error", "error_message": "Failed to get Gmail service."}
     if not gemini_model:
         return {"status": "error", "error_message": "Gemini model not initialized."}
 
     try:
-        # Get the full email content
-        message = service.users().messages().get(userId=user_id, id=email_id, format='full').execute()
-        payload = message.get('payload', {})
-        thread_id = message.get('threadId') # Get thread ID
-
-        # Extract headers
-        headers = payload.get('headers', [])
-        subject = 'No Subject'
-        sender_email = ''
-        original_message_id = ''
-        references = ''
-        for header in headers:
-            name = header['name'].lower()
-            if name == 'subject':
-                subject = header['value']
-            elif name == 'from':
-                 if '<' in header['value'] and '>' in header['value']:
-                    sender_email = header['value'][header['value'].find('<')+1:header['value'].find('>')]
-                 else:
-                    sender_email = header['value'] # Handle cases without <>
-            elif name == 'message-id':
-                original_message_id = header['value']
-            elif name == 'references':
-                references = header['value']
-
-
-        # Extract body
-        email_body = get_email_body(payload)
+        # Get the email content (from the details cache when already loaded)
+        details = get_message_details(service, user_id, email_id)
+        subject = details['subject']
+        email_body = details['original_body']
 
         if not email_body:
             return {"status": "error", "error_message": "Could not extract email body."}
 
-        # Summarize using Gemini
-        prompt = f"Summarize the following email concisely:\\n\\nSubject: {subject}\\n\\nBody:\\n{email_body[:3000]}\\n\\nSummary:" # Limit body length
-        # --- ADDED DEBUG ---
-        # Print the first 500 chars of the prompt to check its content
-        # --- END ADDED DEBUG ---
-        response = gemini_model.generate_content(prompt)
+        # Summarize using Gemini (once per message across all workers)
+        summary_result = get_shared_cache().get_or_fill(
+            "summary", user_id, (email_id, SUMMARY_CACHE_TAG),
+            lambda: summarize_text_with_gemini(subject, email_body), SUMMARY_TTL_SECONDS,
+            cacheable=lambda result: result["status"] == "success", fill_seconds=GEMINI_DEADLINE_SECONDS,
+        )
+        if summary_result["status"] != "success":
+            return summary_result
 
-        return {
-            "status": "success",
-            "summary": response.text,
-            "subject": subject,
-            "original_body": email_body,
-            "sender_email": sender_email, # Add sender
-            "thread_id": thread_id, # Add thread ID
-            "original_message_id": original_message_id, # Add message ID
-            "references": references # Add references
-        }
+        get_triage_scorer().record_action(details, "summarized")
+        return {"status": "success", "summary": summary_result["summary"], **details}
 
     except HttpError as error:
         return {"status": "error", "error_message": f"An API error occurred fetching email {email_id}: {error}"}
@@ -236,6 +430,88 @@ def summarize_email_with_gemini(user_id: str, email_id: str) -> dict:
 # --- End Summarization Function ---
 
 
+# --- Text Summarization Helpers ---
+# Long inputs (attachments, long threads) are split into chunks, each chunk is
+# summarized, and the partial summaries are combined in a final call.
+SUMMARY_CHUNK_CHARS = 6000
+MAX_SUMMARY_CHUNKS = 20
+SUMMARY_CHUNK_WORKERS = 4
+
+
+def summarize_text_with_gemini(subject: str, text: str) -> dict:
+    """Summarizes a piece of text (an email body) with a single LLM call.
+
+    Args:
+        subject: The subject line shown to the model for context.
+        text: The text to summarize. Only the first 3000 characters are used.
+
+    Returns:
+        A dictionary containing the 'status' ('success' or 'error'),
+        and either 'summary' on success or 'error_message' on failure.
+    """
+    if not gemini_model:
+        return {"status": "error", "error_message": "Gemini model not initialized."}
+    try:
+        prompt = f"Summarize the following email concisely:\n\nSubject: {subject}\n\nBody:\n{text[:3000]}\n\nSummary:" # Limit body length
+        response = gemini_model.generate_content(prompt)
+        return {"status": "success", "summary": response.text}
+    except Exception as e:
+        error_type = type(e).__name__
+        return {"status": "error", "error_message": f"An unexpected error occurred during summarization: {error_type}: {e}"}
+
+
+def _split_text(text, chunk_chars):
+    """Splits text into chunks of at most chunk_chars, preferring paragraph breaks."""
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + chunk_chars)
+        if end < len(text):
+            paragraph_break = text.rfind("\n\n", start, end)
+            if paragraph_break > start + chunk_chars // 2:
+                end = paragraph_break
+        chunks.append(text[start:end])
+        start = end
+    return chunks
+
+
+def summarize_long_text_with_gemini(title: str, text: str, chunk_chars: int = SUMMARY_CHUNK_CHARS) -> dict:
+    """Summarizes text of any length by summarizing chunks and then combining them.
+
+    Args:
+        title: A title (subject line or file name) shown to the model for context.
+        text: The text to summarize.
+        chunk_chars: The maximum number of characters sent to the model per chunk.
+
+    Returns:
+        A dictionary containing the 'status' ('success' or 'error'),
+        and either 'summary' and 'chunks' on success or 'error_message' on failure.
+    """
+    if not gemini_model:
+        return {"status": "error", "error_message": "Gemini model not initialized."}
+    chunks = _split_text(text, chunk_chars)[:MAX_SUMMARY_CHUNKS]
+    if not chunks:
+        return {"status": "error", "error_message": "There is no text to summarize."}
+
+    def summarize_chunk(chunk):
+        prompt = f"Summarize this part of '{title}' concisely, keeping names, numbers and decisions:\n\n{chunk}\n\nSummary:"
+        return gemini_model.generate_content(prompt).text
+
+    try:
+        if len(chunks) == 1:
+            return {"status": "success", "summary": summarize_chunk(chunks[0]), "chunks": 1}
+        with ThreadPoolExecutor(max_workers=SUMMARY_CHUNK_WORKERS) as executor:
+            partial_summaries = list(executor.map(turn_task(summarize_chunk), chunks))
+        combined = "\n\n".join(f"Part {index + 1}: {summary}" for index, summary in enumerate(partial_summaries))
+        prompt = f"Combine these partial summaries of '{title}' into one concise summary:\n\n{combined}\n\nSummary:"
+        response = gemini_model.generate_content(prompt)
+        return {"status": "success", "summary": response.text, "chunks": len(chunks)}
+    except Exception as e:
+        error_type = type(e).__name__
+        return {"status": "error", "error_message": f"An unexpected error occurred during summarization: {error_type}: {e}"}
+# --- End Text Summarization Helpers ---
+
+
 # --- Added Function to Generate Reply ---
 def generate_reply_with_gemini(original_subject: str, original_body: str) -> dict:
     """Generates a draft reply email body using an LLM based on the original email.
@@ -276,7 +552,7 @@ def generate_reply_with_gemini(original_subject: str, original_body: str) -> dic
 
 
 # --- Added Function to Create Reply Message ---
-def create_reply_message(sender, to, subject, reply_body, thread_id, original_message_id, references):
+def create_reply_message(sender, to, subject, reply_body, thread_id, original_message_id, references, extra_headers=None):
     """Create a MIME message for replying to an email thread."""
     message = MIMEMultipart('related')
     message['to'] = to
@@ -286,6 +562,8 @@ def create_reply_message(sender, to, subject, reply_body, thread_id, original_me
     # Set threading headers
     message['In-Reply-To'] = original_message_id
     message['References'] = references if references else original_message_id
+    for name, value in (extra_headers or {}).items():
+        message[name] = value
 
     # Attach the reply body as plain text
     msg_text = MIMEText(reply_body, 'plain')
@@ -296,10 +574,68 @@ def create_reply_message(sender, to, subject, reply_body, thread_id, original_me
 # --- End Added Function to Create Reply Message ---
 
 
+# --- Sender Profile Cache ---
+# The authenticated address never changes for a token, so fetch it once per
+# user_id instead of calling getProfile before every send.
+_sender_address_cache = {}
+
+
+def get_sender_address(service, user_id='me'):
+    """Returns the email address of the authenticated user, cached per user_id."""
+    address = _sender_address_cache.get(user_id)
+    if address:
+        return address
+    profile = service.users().getProfile(userId=user_id, fields=PROFILE_ADDRESS_FIELDS).execute()
+    address = profile.get('emailAddress')
+    if address:
+        _sender_address_cache[user_id] = address
+    return address
+# --- End Sender Profile Cache ---
+
+
+# --- Added Function to Build Reply ---
+def build_reply(service, user_id, to, sender, subject, reply_body, thread_id, original_message_id, references, extra_headers=None):
+    """Resolves the sender and threading headers and builds the reply message dict.
+
+    Raises:
+        ValueError: If the sender address cannot be determined from the profile.
+    """
+    # Determine sender's actual email if 'me' is used
+    if sender.lower() == 'me':
+        actual_sender = get_sender_address(service, user_id)
+        if not actual_sender:
+            raise ValueError("Could not determine sender email address from profile.")
+    else:
+        actual_sender = sender
+
+    # Ensure subject starts with Re: if it's a reply
+    reply_subject = subject
+    if not subject.lower().startswith("re:"):
+        reply_subject = f"Re: {subject}"
+
+    # Construct references header
+    new_references = f"{references} {original_message_id}".strip() if references else original_message_id
+
+    return create_reply_message(
+        sender=actual_sender, # Use actual sender email
+        to=to,
+        subject=reply_subject, # Use adjusted subject
+        reply_body=reply_body,
+        thread_id=thread_id,
+        original_message_id=original_message_id,
+        references=new_references, # Use constructed references
+        extra_headers=extra_headers
+    )
+# --- End Added Function to Build Reply ---
+
+
 # --- Added Function to Send Reply ---
 def send_reply(user_id: str, to: str, sender: str, subject: str, reply_body: str, thread_id: str, original_message_id: str, references: str) -> dict:
-    """Creates and sends a reply email within a specific thread.
-       Requires Gmail service to be available via get_gmail_service().
+    """Sends a reply email within a specific thread and waits for it to go out.
+
+    The reply goes through the outbox (journaled, retried and deduplicated),
+    and this waits up to outbox.SEND_WAIT_SECONDS for it to be sent. Use
+    outbox.queue_reply to queue a reply without waiting.
 
     Args:
         user_id: The user's email address or 'me'.
@@ -314,50 +650,28 @@ def send_reply(user_id: str, to: str, sender: str, subject: str, reply_body: str
     Returns:
         A dictionary containing the 'status' ('success' or 'error'),
         and either 'message_id' on success or 'error_message' on failure.
+        If the reply is still queued when the wait runs out, the error also
+        carries its 'outbox_id' (it will keep being retried in the background).
     """
-    service = get_gmail_service() # Get service when function is called
-    if not service:
-        return {"status": "error", "error_message": "Failed to get Gmail service."}
-    try:
-        # Determine sender's actual email if 'me' is used
-        if sender.lower() == 'me':
-             profile = service.users().getProfile(userId='me').execute()
-             actual_sender = profile.get('emailAddress')
-             if not actual_sender:
-                 return {"status": "error", "error_message": "Could not determine sender email address from profile."}
-        else:
-            actual_sender = sender
-
-        # Ensure subject starts with Re: if it's a reply
-        reply_subject = subject
-        if not subject.lower().startswith("re:"):
-            reply_subject = f"Re: {subject}"
-
-        # Construct references header
-        new_references = f"{references} {original_message_id}".strip() if references else original_message_id
-
-        reply_message_dict = create_reply_message(
-            sender=actual_sender, # Use actual sender email
-            to=to,
-            subject=reply_subject, # Use adjusted subject
-            reply_body=reply_body,
-            thread_id=thread_id,
-            original_message_id=original_message_id,
-            references=new_references # Use constructed references
-        )
-        message = service.users().messages().send(userId=user_id, body=reply_message_dict).execute()
-        print(f"Reply sent successfully. Message ID: {message['id']}") # Keep console log for now
-        return {"status": "success", "message_id": message['id']}
-    except HttpError as error:
-        print(f"An error occurred sending the reply: {error}") # Keep console log
-        return {"status": "error", "error_message": f"An API error occurred sending the reply: {error}"}
-    except Exception as e:
-        print(f"An unexpected error occurred sending the reply: {e}") # Keep console log
-        return {"status": "error", "error_message": f"An unexpected error occurred sending the reply: {e}"}
+    from .outbox import STATUS_SENT, STATUS_FAILED, queue_reply, wait_for_send  # outbox imports this module
+    queued = queue_reply(user_id, to, sender, subject, reply_body, thread_id, original_message_id, references)
+    if queued["status"] != "success":
+        return queued
+    entry = wait_for_send(queued["outbox_id"])
+    if entry and entry.get("status") == STATUS_SENT:
+        return {"status": "success", "message_id": entry["message_id"]}
+    if entry and entry.get("status") == STATUS_FAILED:
+        return {"status": "error", "error_message": f"An error occurred sending the reply: {entry.get('error')}"}
+    return {
+        "status": "error",
+        "error_message": "The reply is queued but has not been sent yet; it will keep being retried.",
+        "outbox_id": queued["outbox_id"],
+    }
 # --- End Added Function to Send Reply ---
 
 
 # --- Added Function to Search Emails ---
+@serve_stale_on_error
 def search_emails(query: str, user_id: str) -> dict:
     """Searches for emails matching the given query.
 
@@ -370,53 +684,29 @@ def search_emails(query: str, user_id: str) -> dict:
         A dictionary containing the 'status' ('success' or 'error'),
         and either 'emails' (a list of matching email details) on success,
         or 'error_message' on failure. Each email detail includes
-        'id', 'threadId', 'subject', 'from', and 'date'.
+        'id', 'threadId', 'subject', 'from', 'date', 'labels', 'priority'
+        (0-1) and 'recency' (0 = newest); emails are ordered by priority,
+        highest first.
     """
-    service = get_gmail_service()
+    service = get_gmail_service(user_id)
     if not service:
         return {"status": "error", "error_message": "Failed to get Gmail service."}
 
     try:
         # Search messages using the query
         results = service.users().messages().list(
-            userId=user_id, q=query, maxResults=5
+            userId=user_id, q=query, maxResults=5, fields=LIST_IDS_FIELDS
         ).execute()
         messages = results.get('messages', [])
 
         if not messages:
             return {"status": "success", "emails": []} # Return success with empty list if no matches
 
-        email_list = []
-        for msg_stub in messages:
-            msg_id = msg_stub['id']
-            # Fetch metadata for each message
-            msg = service.users().messages().get(
-                userId=user_id, id=msg_id, format='metadata',
-                metadataHeaders=['Subject', 'From', 'Date']
-            ).execute()
-
-            payload = msg.get('payload', {})
-            headers = payload.get('headers', [])
-            subject = 'No Subject'
-            sender = 'Unknown Sender'
-            date = 'No Date'
-
-            for header in headers:
-                name = header['name'].lower()
-                if name == 'subject':
-                    subject = header['value']
-                elif name == 'from':
-                    sender = header['value']
-                elif name == 'date':
-                    date = header['value']
-
-            email_list.append({
-                'id': msg_id,
-                'threadId': msg.get('threadId'),
-                'subject': subject,
-                'from': sender,
-                'date': date
-            })
+        # Fetch metadata for all uncached messages in one batched round trip
+        message_ids = [msg_stub['id'] for msg_stub in messages]
+        email_list = fetch_listing_details(service, user_id, message_ids)
+        # Most important first, by the local triage model
+        email_list = get_triage_scorer().rank(email_list)
 
         return {"status": "success", "emails": email_list}
 
@@ -428,8 +718,8 @@ def search_emails(query: str, user_id: str) -> dict:
 
 
 # --- Authentication Function (Example - Adapt for Agent Context) ---
-def get_gmail_service():
-    """Authenticates and builds the Gmail API service."""
+def get_gmail_credentials():
+    """Loads (refreshing or re-authenticating if needed) the Gmail OAuth credentials."""
     creds = None
     if os.path.exists("token.json"):
         creds = Credentials.from_authorized_user_file("token.json", SCOPES)
@@ -445,17 +735,36 @@ def get_gmail_service():
                 "credentials.json", SCOPES
             )
             creds = flow.run_local_server(port=0)
-        with open("token.json", "w") as token:
-            token.write(creds.to_json())
+        atomic_write_text("token.json", creds.to_json())
+    return creds
+
+
+# --- Service Pool ---
+# One cached Gmail service per account (user_id). 'me' is the account in
+# token.json; other accounts use tokens/<email>.json (see service_pool.py).
+_service_pool = ServicePool(SCOPES, default_credentials_loader=get_gmail_credentials)
+
+
+def get_service_pool():
+    return _service_pool
+
+
+def get_gmail_service(user_id='me'):
+    """Returns the pooled Gmail API service for an account, building it on first use."""
     try:
-        service = build("gmail", "v1", credentials=creds)
-        print("Gmail service built successfully.")
-        return service
+        return _service_pool.get_service(user_id)
     except Exception as e:
-        print(f"Failed to build Gmail service: {e}")
+        print(f"Failed to build Gmail service for {user_id}: {e}")
         return None
 
+
+def get_account_credentials(user_id='me'):
+    """Returns the pooled OAuth credentials for an account."""
+    return _service_pool.get_credentials(user_id)
+# --- End Service Pool ---
+
 # --- Added Function to Get Unread Count ---
+@serve_stale_on_error
 def get_total_unread_count(user_id: str) -> dict:
     """Gets the total number of unread messages in the inbox.
 
@@ -466,12 +775,12 @@ def get_total_unread_count(user_id: str) -> dict:
         A dictionary containing the 'status' ('success' or 'error'),
         and either 'unread_count' on success or 'error_message' on failure.
     """
-    service = get_gmail_service()
+    service = get_gmail_service(user_id)
     if not service:
         return {"status": "error", "error_message": "Failed to get Gmail service."}
     try:
         # Get the INBOX label details
-        label_info = service.users().labels().get(userId=user_id, id='INBOX').execute()
+        label_info = service.users().labels().get(userId=user_id, id='INBOX', fields=LABEL_UNREAD_FIELDS).execute()
         unread_count = label_info.get('messagesUnread', 0)
         return {"status": "success", "unread_count": unread_count}
     except HttpError as error:
@@ -481,6 +790,7 @@ def get_total_unread_count(user_id: str) -> dict:
 # --- End Added Function ---
 
 # --- Added Function to Get Today's Email Count ---
+@serve_stale_on_error
 def get_emails_received_today_count(user_id: str) -> dict:
     """Gets the count of emails received in the inbox within the last 24 hours (approximates 'today').
 
@@ -491,14 +801,14 @@ def get_emails_received_today_count(user_id: str) -> dict:
         A dictionary containing the 'status' ('success' or 'error'),
         and either 'today_count' on success or 'error_message' on failure.
     """
-    service = get_gmail_service()
+    service = get_gmail_service(user_id)
     if not service:
         return {"status": "error", "error_message": "Failed to get Gmail service."}
     try:
         # Use a query to find messages newer than 1 day in the inbox
         # Note: 'newer_than:1d' typically covers the last 24 hours.
         query = "label:inbox newer_than:1d"
-        results = service.users().messages().list(userId=user_id, q=query).execute()
+        results = service.users().messages().list(userId=user_id, q=query, fields=LIST_COUNT_FIELDS).execute()
         messages = results.get('messages', [])
         # The result only contains message stubs, count them.
         today_count = len(messages)
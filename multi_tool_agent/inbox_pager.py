@@ -0,0 +1,235 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .gmail_agent_logic import fetch_listing_details, get_gmail_service, get_message_details
+from .mail_watcher import LabelChangeEvent, MailboxResyncEvent, MessageDeletedEvent, NewMessageEvent
+from .projection import LIST_IDS_FIELDS
+
+# --- Inbox Pager Configuration ---
+# One page is one messages.list call (IDs only) plus one batched metadata
+# fetch (of the messages not in the shared cache), so browsing costs a
+# bounded number of API calls per page no matter how large the mailbox is. Page tokens are remembered for every page seen,
+# so going back never re-walks the listing.
+INBOX_PAGE_SIZE = 50
+MAX_CACHED_PAGES = 40
+PREFETCH_WORKERS = 2
+# --- End Inbox Pager Configuration ---
+
+
+class InboxPager:
+    """Serves a mailbox listing one page at a time from cached page-token cursors.
+
+    Page tokens and page IDs are kept for every page reached; page metadata
+    is kept in a bounded LRU cache (opened messages go through the shared
+    message details cache). After a page is served, the next one is fetched
+    in the background so paging forward is instant.
+    """
+
+    def __init__(self, user_id='me', label_ids=('INBOX',), query=None, page_size=INBOX_PAGE_SIZE,
+                 max_cached_pages=MAX_CACHED_PAGES):
+        self.user_id = user_id
+        self.label_ids = list(label_ids)
+        self.query = query
+        self.page_size = page_size
+        self.max_cached_pages = max_cached_pages
+        self._lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="inbox-prefetch")
+        self.invalidate()
+
+    def invalidate(self):
+        """Forgets every cursor and page (e.g. after the mailbox changed)."""
+        with self._lock:
+            self._page_tokens = [None]  # _page_tokens[i] lists page i
+            self._page_ids = {}
+            self._pages = OrderedDict()
+            self._pending = {}
+            self._exhausted_at = None  # Index of the last page, once known
+            self._total_estimate = None
+            self._generation = getattr(self, "_generation", 0) + 1
+
+    def refresh(self):
+        """Drops cached pages and page IDs but keeps the page-token cursors.
+
+        For when messages entered or left the listing: a page is listed again
+        from its known token when next requested, instead of walking the
+        listing from the first page.
+        """
+        with self._lock:
+            self._page_ids = {}
+            self._pages = OrderedDict()
+            self._pending = {}
+            self._exhausted_at = None
+            self._total_estimate = None
+            self._generation += 1
+
+    def _page_of(self, message_id):
+        with self._lock:
+            for index, ids in self._page_ids.items():
+                if message_id in ids:
+                    return index
+        return None
+
+    def handle_mail_event(self, event):
+        """Keeps the cached listing in step with a MailEvent for this pager's account.
+
+        Only changes to which messages are listed (new or removed mail, the
+        pager's labels added or removed) refresh the listing; other label
+        changes just reload the metadata of the page showing that message.
+        """
+        if isinstance(event, MailboxResyncEvent):
+            self.invalidate()
+        elif isinstance(event, NewMessageEvent):
+            if self.query or all(label in event.label_ids for label in self.label_ids):
+                self.refresh()
+        elif isinstance(event, MessageDeletedEvent):
+            if self._page_of(event.message_id) is not None:
+                self.refresh()
+        elif isinstance(event, LabelChangeEvent):
+            if self.query or any(label in self.label_ids for label in event.added + event.removed):
+                self.refresh()
+                return
+            index = self._page_of(event.message_id)
+            if index is not None:
+                with self._lock:
+                    self._pages.pop(index, None)
+
+    # --- Cursors ---
+    def _list_ids(self, service, index):
+        """Lists the message IDs of page index (whose token must be known)."""
+        params = {
+            "userId": self.user_id,
+            "maxResults": self.page_size,
+            "fields": LIST_IDS_FIELDS,
+        }
+        if self.label_ids:
+            params["labelIds"] = self.label_ids
+        if self.query:
+            params["q"] = self.query
+        if self._page_tokens[index]:
+            params["pageToken"] = self._page_tokens[index]
+        results = service.users().messages().list(**params).execute()
+        ids = [msg["id"] for msg in results.get("messages", [])]
+        with self._lock:
+            self._page_ids[index] = ids
+            if self._total_estimate is None:
+                self._total_estimate = results.get("resultSizeEstimate")
+            next_token = results.get("nextPageToken")
+            if next_token and len(self._page_tokens) == index + 1:
+                self._page_tokens.append(next_token)
+            elif not next_token:
+                self._exhausted_at = index
+        return ids
+
+    def _ids_for_page(self, service, index):
+        """Walks forward from the last known cursor until page index's IDs are known."""
+        with self._lock:
+            if index in self._page_ids:
+                return self._page_ids[index]
+        while True:
+            with self._lock:
+                known = len(self._page_tokens) - 1
+                if self._exhausted_at is not None and index > self._exhausted_at:
+                    return None
+            step = min(index, known)
+            ids = self._list_ids(service, step)
+            if step == index:
+                return ids
+    # --- End Cursors ---
+
+    def _load_page(self, index, generation):
+        service = get_gmail_service(self.user_id)
+        if not service:
+            raise RuntimeError("Failed to get Gmail service.")
+        ids = self._ids_for_page(service, index)
+        if ids is None:
+            return None
+        emails = fetch_listing_details(service, self.user_id, ids)
+        with self._lock:
+            if generation == self._generation:
+                self._pages[index] = emails
+                while len(self._pages) > self.max_cached_pages:
+                    self._pages.popitem(last=False)
+        return emails
+
+    def _page_future(self, index):
+        """Returns the in-flight (or a new) load of page index; one load per page at a time."""
+        with self._lock:
+            future = self._pending.get(index)
+            if future is None:
+                generation = self._generation
+                future = self._executor.submit(self._load_page, index, generation)
+                self._pending[index] = future
+                future.add_done_callback(lambda _: self._forget_pending(index, future))
+            return future
+
+    def _forget_pending(self, index, future):
+        with self._lock:
+            if self._pending.get(index) is future:
+                del self._pending[index]
+
+    def get_page(self, index):
+        """Returns a dict describing page index (0-based).
+
+        Returns:
+            A dictionary containing the 'status' ('success' or 'error'), and
+            on success 'page', 'emails' (listing dicts as from
+            list_recent_emails), 'has_next' and 'total_estimate'; or
+            'error_message' on failure.
+        """
+        index = max(int(index), 0)
+        with self._lock:
+            emails = self._pages.get(index)
+            if emails is not None:
+                self._pages.move_to_end(index)
+        try:
+            if emails is None:
+                emails = self._page_future(index).result()
+        except Exception as e:
+            return {"status": "error", "error_message": f"An error occurred loading page {index + 1}: {e}"}
+        if emails is None:
+            return {"status": "error", "error_message": f"Page {index + 1} is past the end of the mailbox."}
+
+        with self._lock:
+            has_next = self._exhausted_at is None or index < self._exhausted_at
+            total_estimate = self._total_estimate
+            next_cached = (index + 1) in self._pages
+        if has_next and not next_cached:
+            self._page_future(index + 1)  # Prefetch; errors surface when it's requested
+        return {
+            "status": "success",
+            "page": index,
+            "emails": emails,
+            "has_next": has_next,
+            "total_estimate": total_estimate,
+        }
+
+    def get_message(self, email_id):
+        """Loads (once) the full details of a message for reading or replying.
+
+        Returns:
+            A dictionary containing the 'status' ('success' or 'error'), and
+            on success the fields of email_details_from_message; or
+            'error_message' on failure.
+        """
+        service = get_gmail_service(self.user_id)
+        if not service:
+            return {"status": "error", "error_message": "Failed to get Gmail service."}
+        try:
+            details = get_message_details(service, self.user_id, email_id)
+        except Exception as e:
+            return {"status": "error", "error_message": f"An error occurred loading email {email_id}: {e}"}
+        return {"status": "success", **details}
+
+
+_pagers = {}
+_pagers_lock = threading.Lock()
+
+
+def get_inbox_pager(user_id='me'):
+    """Returns the shared InboxPager for an account's inbox."""
+    with _pagers_lock:
+        pager = _pagers.get(user_id)
+        if pager is None:
+            pager = _pagers[user_id] = InboxPager(user_id)
+        return pager
@@ -0,0 +1,200 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+from .gmail_agent_logic import fetch_messages_batch, get_gmail_service
+from .mime_parse import parse_shared_chunk
+from .projection import LIST_IDS_FIELDS, NEED_RAW
+
+# --- Ingestion Configuration ---
+# Bulk jobs fetch messages as format='raw' (one base64url string per message,
+# no nested JSON payload to walk) in batched requests, and parse them with the
+# stdlib email parser in a process pool. Each fetched batch is copied once
+# into a shared memory block; workers read their messages straight from it, so
+# message bytes are never pickled. The next batch is fetched while workers
+# parse the previous ones. Workers come from a forkserver (spawn where that
+# isn't available), never a plain fork of this process: by the time a pool is
+# created the caller may already be running threads (fetchers, the summary
+# pool, the HTTP client's), and a forked child inherits their locks held.
+INGEST_BATCH_SIZE = 50
+PARSE_CHUNK_SIZE = 10  # Messages per worker task
+MAX_BATCHES_IN_FLIGHT = 4
+LIST_PAGE_SIZE = 500
+# --- End Ingestion Configuration ---
+
+
+def create_parse_pool(workers=None):
+    """Returns a ProcessPoolExecutor for parse_shared_chunk tasks.
+
+    Args:
+        workers: Parser processes (default: one per core).
+    """
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                               mp_context=multiprocessing.get_context(start_method))
+
+
+class JsonlSink:
+    """Streams records to a JSON-lines file as they are produced."""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "w", encoding="utf-8")
+        self.count = 0
+
+    def write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.count += 1
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def _pack_batch(messages):
+    """Copies a batch's base64url 'raw' texts into one shared memory block.
+
+    Returns:
+        (shm, entries) where entries are (offset, length, meta) tuples for
+        parse_shared_chunk, in batch order.
+    """
+    encoded = []
+    for msg in messages:
+        raw = msg.get("raw", "").encode("ascii")
+        meta = {key: msg.get(key) for key in ("id", "threadId", "labelIds", "internalDate", "sizeEstimate")}
+        encoded.append((raw, meta))
+    shm = SharedMemory(create=True, size=max(sum(len(raw) for raw, _ in encoded), 1))
+    entries = []
+    offset = 0
+    for raw, meta in encoded:
+        shm.buf[offset:offset + len(raw)] = raw
+        entries.append((offset, len(raw), meta))
+        offset += len(raw)
+    return shm, entries
+
+
+def _drain(in_flight, sink):
+    shm, futures = in_flight
+    written = 0
+    try:
+        for future in futures:
+            for record in future.result():
+                sink.write(record)
+                written += 1
+    finally:
+        shm.close()
+        shm.unlink()
+    return written
+
+
+def ingest_messages(service, user_id, message_ids, sink, batch_size=INGEST_BATCH_SIZE, workers=None, pool=None,
+                    stop=None):
+    """Fetches, parses and streams normalized records for many messages.
+
+    Args:
+        service: The Gmail API service.
+        user_id: The user's email address or 'me'.
+        message_ids: The IDs of the messages to ingest.
+        sink: An object with write(record); receives the records of
+            mime_parse.parse_raw_message in message_ids order.
+        batch_size: Messages per batched fetch.
+        workers: Parser processes (default: one per core).
+        pool: An existing pool from create_parse_pool to parse in (workers is
+            then ignored), so callers ingesting in rounds keep one warm pool.
+        stop: Optional callable checked before each batch is fetched; once it
+            returns True no more batches are fetched, and the ones already
+            fetched are still parsed and written.
+
+    Returns:
+        The number of records written.
+    """
+    if pool is None:
+        with create_parse_pool(workers) as own_pool:
+            return ingest_messages(service, user_id, message_ids, sink, batch_size, pool=own_pool, stop=stop)
+
+    written = 0
+    in_flight = deque()
+    try:
+        for start in range(0, len(message_ids), batch_size):
+            if stop and stop():
+                break
+            batch_ids = message_ids[start:start + batch_size]
+            fetched = fetch_messages_batch(service, user_id, batch_ids, need=NEED_RAW)
+            messages = [fetched[msg_id] for msg_id in batch_ids if msg_id in fetched]
+            if not messages:
+                continue
+            shm, entries = _pack_batch(messages)
+            futures = [
+                pool.submit(parse_shared_chunk, shm.name, entries[chunk:chunk + PARSE_CHUNK_SIZE])
+                for chunk in range(0, len(entries), PARSE_CHUNK_SIZE)
+            ]
+            in_flight.append((shm, futures))
+            while len(in_flight) >= MAX_BATCHES_IN_FLIGHT:
+                written += _drain(in_flight.popleft(), sink)
+        while in_flight:
+            written += _drain(in_flight.popleft(), sink)
+    finally:
+        # On errors, still release every shared memory block
+        for shm, futures in in_flight:
+            for future in futures:
+                future.cancel()
+            shm.close()
+            shm.unlink()
+    return written
+
+
+def list_message_ids(service, user_id, query, max_messages=None):
+    """Lists the IDs of all messages matching query (up to max_messages)."""
+    message_ids = []
+    page_token = None
+    while True:
+        results = service.users().messages().list(
+            userId=user_id, q=query, maxResults=LIST_PAGE_SIZE, pageToken=page_token,
+            fields=LIST_IDS_FIELDS,
+        ).execute()
+        message_ids.extend(msg["id"] for msg in results.get("messages", []))
+        page_token = results.get("nextPageToken")
+        if not page_token or (max_messages and len(message_ids) >= max_messages):
+            return message_ids[:max_messages] if max_messages else message_ids
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ingest messages into a JSON-lines file of normalized records.")
+    parser.add_argument("--user-id", default="me", help="Mailbox to ingest (default: me).")
+    parser.add_argument("--query", default="", help="Gmail search query (default: all mail).")
+    parser.add_argument("--max-messages", type=int, help="Stop after this many messages.")
+    parser.add_argument("--output", default="ingest.jsonl", help="Output JSON-lines file.")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE, help="Messages fetched per batch request.")
+    parser.add_argument("--workers", type=int, help="Parser processes (default: one per core).")
+    args = parser.parse_args(argv)
+
+    service = get_gmail_service(args.user_id)
+    if not service:
+        print("Failed to get Gmail service. Check token.json and credentials.json.")
+        return 1
+    message_ids = list_message_ids(service, args.user_id, args.query, args.max_messages)
+    print(f"Ingesting {len(message_ids)} messages...")
+    started = time.monotonic()
+    with JsonlSink(args.output) as sink:
+        written = ingest_messages(service, args.user_id, message_ids, sink, args.batch_size, args.workers)
+    elapsed = time.monotonic() - started
+    print(f"Wrote {written} records to {args.output} in {elapsed:.1f}s ({written / max(elapsed, 1e-9):.0f} msg/s).")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,51 @@
+import time
+
+from google.adk.runners import Runner
+
+# --- Hop Metrics ---
+# A "hop" is one model turn: an event whose content carries model text or a
+# function call. Tool results and events produced directly by the pre-router
+# (authors listed in non_llm_authors) are not hops.
+
+
+def _is_llm_hop(event, non_llm_authors):
+    if event.author == "user" or event.author in non_llm_authors or not event.content:
+        return False
+    return any(part.text or part.function_call for part in event.content.parts or [])
+
+
+class InstrumentedRunner(Runner):
+    """Runner that records LLM hop counts and per-hop latency for every invocation.
+
+    After each run, a dict with 'invocation_id', 'hops', 'hop_latencies'
+    (a list of (author, seconds) tuples) and 'total_seconds' is appended to
+    self.metrics and printed.
+    """
+
+    def __init__(self, *args, non_llm_authors=(), max_metrics=1000, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.non_llm_authors = set(non_llm_authors)
+        self.max_metrics = max_metrics
+        self.metrics = []
+
+    async def run_async(self, **kwargs):
+        started = time.perf_counter()
+        previous = started
+        record = {"invocation_id": None, "hops": 0, "hop_latencies": [], "total_seconds": 0.0}
+        try:
+            async for event in super().run_async(**kwargs):
+                now = time.perf_counter()
+                record["invocation_id"] = record["invocation_id"] or event.invocation_id
+                if not event.partial and _is_llm_hop(event, self.non_llm_authors):
+                    record["hops"] += 1
+                    record["hop_latencies"].append((event.author, round(now - previous, 3)))
+                if not event.partial:
+                    previous = now
+                yield event
+        finally:
+            record["total_seconds"] = round(time.perf_counter() - started, 3)
+            self.metrics.append(record)
+            del self.metrics[:-self.max_metrics]
+            print(f"[metrics] invocation {record['invocation_id']}: {record['hops']} LLM hops "
+                  f"in {record['total_seconds']}s {record['hop_latencies']}")
+# --- End Hop Metrics ---
@@ -0,0 +1,334 @@
+import base64
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from googleapiclient.errors import HttpError
+
+from .atomic_files import atomic_write_json
+from .gmail_agent_logic import get_gmail_service
+from .projection import WATCH_FIELDS
+
+# --- Mail Watcher Configuration ---
+# The watcher polls users.history.list (2 quota units, and usually an empty
+# response) instead of re-listing the mailbox (5 units per list plus 5 per
+# message fetched). The poll interval drops to MIN after any change and backs
+# off towards MAX while the mailbox is quiet. When Gmail push notifications
+# arrive (see handle_push_notification), the watcher polls immediately.
+WATCH_STATE_PATH = os.environ.get("GMAIL_AGENT_WATCH_STATE", "mail_watch_state.json")
+MIN_POLL_SECONDS = float(os.environ.get("GMAIL_AGENT_WATCH_MIN_SECONDS", "5"))
+MAX_POLL_SECONDS = float(os.environ.get("GMAIL_AGENT_WATCH_MAX_SECONDS", "120"))
+POLL_BACKOFF_FACTOR = 1.5
+# With push configured, polling is only a safety net.
+PUSH_MAX_POLL_SECONDS = 600
+HISTORY_TYPES = ["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"]
+HISTORY_FIELDS = (
+    "history(messagesAdded/message(id,threadId,labelIds),messagesDeleted/message(id,threadId),"
+    "labelsAdded(message(id,threadId),labelIds),labelsRemoved(message(id,threadId),labelIds)),"
+    "historyId,nextPageToken"
+)
+# --- End Mail Watcher Configuration ---
+
+
+# --- Mail Events ---
+class MailEvent:
+    """Base class of everything published on the mail event bus."""
+
+    def __init__(self, user_id, message_id=None, thread_id=None, history_id=None):
+        self.user_id = user_id
+        self.message_id = message_id
+        self.thread_id = thread_id
+        self.history_id = history_id
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.user_id!r}, {self.message_id!r})"
+
+
+class NewMessageEvent(MailEvent):
+    """A message was added to the mailbox."""
+
+    def __init__(self, user_id, message_id, thread_id=None, label_ids=(), history_id=None):
+        super().__init__(user_id, message_id, thread_id, history_id)
+        self.label_ids = list(label_ids)
+
+
+class LabelChangeEvent(MailEvent):
+    """Labels were added to or removed from a message (e.g. read/unread, archived)."""
+
+    def __init__(self, user_id, message_id, thread_id=None, added=(), removed=(), history_id=None):
+        super().__init__(user_id, message_id, thread_id, history_id)
+        self.added = list(added)
+        self.removed = list(removed)
+
+
+class MessageDeletedEvent(MailEvent):
+    """A message was permanently deleted."""
+
+
+class MailboxResyncEvent(MailEvent):
+    """The stored historyId expired; anything cached about the mailbox may be wrong."""
+
+
+class EventBus:
+    """In-process publish/subscribe for mail events.
+
+    Handlers run synchronously on the publishing (watcher) thread, so they
+    should be quick or hand work off to their own executor.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = []
+
+    def subscribe(self, event_type, handler):
+        """Calls handler(event) for every published event of event_type (or a subclass).
+
+        Returns:
+            A function that removes the subscription.
+        """
+        subscription = (event_type, handler)
+        with self._lock:
+            self._subscribers.append(subscription)
+
+        def unsubscribe():
+            with self._lock:
+                if subscription in self._subscribers:
+                    self._subscribers.remove(subscription)
+        return unsubscribe
+
+    def publish(self, event):
+        with self._lock:
+            handlers = [handler for event_type, handler in self._subscribers if isinstance(event, event_type)]
+        for handler in handlers:
+            try:
+                handler(event)
+            except Exception as e:
+                print(f"Error in mail event handler {handler!r} for {event!r}: {e}")
+
+
+mail_events = EventBus()
+# --- End Mail Events ---
+
+
+# --- History Checkpoint ---
+_state_lock = threading.Lock()
+
+
+def load_history_id(user_id, path=WATCH_STATE_PATH):
+    with _state_lock:
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as state_file:
+            return json.load(state_file).get(user_id)
+
+
+def save_history_id(user_id, history_id, path=WATCH_STATE_PATH):
+    with _state_lock:
+        state = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as state_file:
+                state = json.load(state_file)
+        state[user_id] = str(history_id)
+        atomic_write_json(path, state)  # A crash never leaves a torn state file
+# --- End History Checkpoint ---
+
+
+def events_from_history(user_id, history_records):
+    """Turns history.list records into MailEvents, in mailbox order."""
+    events = []
+    for record in history_records:
+        history_id = record.get("id")
+        for added in record.get("messagesAdded", []):
+            message = added.get("message", {})
+            events.append(NewMessageEvent(user_id, message.get("id"), message.get("threadId"),
+                                          message.get("labelIds", []), history_id))
+        for deleted in record.get("messagesDeleted", []):
+            message = deleted.get("message", {})
+            events.append(MessageDeletedEvent(user_id, message.get("id"), message.get("threadId"), history_id))
+        for change in record.get("labelsAdded", []):
+            message = change.get("message", {})
+            events.append(LabelChangeEvent(user_id, message.get("id"), message.get("threadId"),
+                                           added=change.get("labelIds", []), history_id=history_id))
+        for change in record.get("labelsRemoved", []):
+            message = change.get("message", {})
+            events.append(LabelChangeEvent(user_id, message.get("id"), message.get("threadId"),
+                                           removed=change.get("labelIds", []), history_id=history_id))
+    return events
+
+
+class MailWatcher:
+    """Polls one mailbox's history in the background and publishes MailEvents."""
+
+    def __init__(self, user_id='me', bus=mail_events, min_interval=MIN_POLL_SECONDS, max_interval=MAX_POLL_SECONDS):
+        self.user_id = user_id
+        self.bus = bus
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.push_enabled = False
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._history_id = load_history_id(user_id)
+
+    def _seed_history_id(self, service):
+        profile = service.users().getProfile(userId=self.user_id, fields="historyId").execute()
+        self._history_id = profile["historyId"]
+        save_history_id(self.user_id, self._history_id)
+
+    def poll_once(self):
+        """Fetches the changes since the stored historyId and publishes them.
+
+        Returns:
+            The number of events published.
+        """
+        service = get_gmail_service(self.user_id)
+        if not service:
+            raise RuntimeError("Failed to get Gmail service.")
+        if not self._history_id:
+            self._seed_history_id(service)
+            return 0
+
+        records = []
+        page_token = None
+        latest_history_id = self._history_id
+        try:
+            while True:
+                response = service.users().history().list(
+                    userId=self.user_id, startHistoryId=self._history_id, historyTypes=HISTORY_TYPES,
+                    pageToken=page_token, fields=HISTORY_FIELDS,
+                ).execute()
+                records.extend(response.get("history", []))
+                latest_history_id = response.get("historyId", latest_history_id)
+                page_token = response.get("nextPageToken")
+                if not page_token:
+                    break
+        except HttpError as error:
+            if error.resp.status != 404:
+                raise
+            # historyId too old (Gmail keeps about a week): start over from now.
+            print(f"Stored historyId for {self.user_id} expired; resynchronizing.")
+            self._seed_history_id(service)
+            self.bus.publish(MailboxResyncEvent(self.user_id, history_id=self._history_id))
+            return 1
+
+        events = events_from_history(self.user_id, records)
+        for event in events:
+            self.bus.publish(event)
+        if latest_history_id != self._history_id:
+            self._history_id = latest_history_id
+            save_history_id(self.user_id, latest_history_id)
+        return len(events)
+
+    def _next_interval(self, changed):
+        ceiling = PUSH_MAX_POLL_SECONDS if self.push_enabled else self.max_interval
+        if changed:
+            return self.min_interval
+        return min(self.interval * POLL_BACKOFF_FACTOR, ceiling)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                changed = self.poll_once() > 0
+            except Exception as e:
+                print(f"Error polling mail history for {self.user_id}: {e}")
+                changed = False
+            self.interval = self._next_interval(changed)
+            self._wake.wait(self.interval)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"mail-watcher-{self.user_id}", daemon=True)
+        self._thread.start()
+        print(f"Watching {self.user_id} for new mail.")
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self):
+        """Polls now instead of waiting out the current interval (used by push notifications)."""
+        self.interval = self.min_interval
+        self._wake.set()
+
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def get_mail_watcher(user_id='me'):
+    """Returns the (not yet started) shared watcher for an account."""
+    with _watchers_lock:
+        watcher = _watchers.get(user_id)
+        if watcher is None:
+            watcher = _watchers[user_id] = MailWatcher(user_id)
+        return watcher
+
+
+# --- Push Notifications ---
+# Gmail's users.watch publishes {"emailAddress", "historyId"} to a Cloud
+# Pub/Sub topic; a push subscription POSTs it to an endpoint wrapped in a
+# Pub/Sub envelope. The notification only says "something changed", so it
+# just wakes the account's watcher, which fetches the actual history.
+def start_gmail_watch(user_id, topic_name, label_ids=("INBOX",)):
+    """Asks Gmail to publish mailbox changes to a Pub/Sub topic (renew at least weekly)."""
+    service = get_gmail_service(user_id)
+    if not service:
+        raise RuntimeError("Failed to get Gmail service.")
+    response = service.users().watch(
+        userId=user_id, body={"topicName": topic_name, "labelIds": list(label_ids)}, fields=WATCH_FIELDS
+    ).execute()
+    get_mail_watcher(user_id).push_enabled = True
+    return response
+
+
+def handle_push_notification(envelope):
+    """Handles a Pub/Sub push envelope (or a bare {"emailAddress", "historyId"} dict).
+
+    Returns:
+        True if a watcher was woken.
+    """
+    payload = envelope
+    if "message" in envelope:
+        data = envelope["message"].get("data", "")
+        payload = json.loads(base64.b64decode(data + "=" * (-len(data) % 4)) or b"{}")
+    email_address = payload.get("emailAddress")
+    with _watchers_lock:
+        watcher = _watchers.get(email_address) or (_watchers.get("me") if len(_watchers) == 1 else None)
+    if not watcher:
+        return False
+    watcher.push_enabled = True
+    watcher.wake()
+    return True
+
+
+class _PushHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            handle_push_notification(json.loads(self.rfile.read(length) or b"{}"))
+            self.send_response(204)
+        except (ValueError, KeyError):
+            self.send_response(400)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_push_endpoint(host="127.0.0.1", port=8765):
+    """Runs a local HTTP endpoint that accepts Pub/Sub push POSTs, in a background thread.
+
+    Point a Pub/Sub push subscription (through a tunnel) or any local
+    notifier at it; each POST wakes the matching watcher.
+    """
+    server = ThreadingHTTPServer((host, port), _PushHandler)
+    threading.Thread(target=server.serve_forever, name="mail-push-endpoint", daemon=True).start()
+    print(f"Listening for mail push notifications on http://{host}:{port}/")
+    return server
+# --- End Push Notifications ---
@@ -0,0 +1,114 @@
+import base64
+import email
+import email.policy
+from multiprocessing.shared_memory import SharedMemory
+
+# --- Raw Message Parsing ---
+# Runs inside ingestion worker processes, which unpickle parse_shared_chunk
+# by importing this module. It only uses the standard library, and the
+# package __init__ loads the agents lazily, so this import adds nothing past
+# the stdlib (workers still import the caller's main module, as any
+# forkserver/spawn worker does).
+_HEADER_FIELDS = {
+    "subject": "Subject",
+    "from": "From",
+    "to": "To",
+    "cc": "Cc",
+    "date": "Date",
+    "message_id": "Message-ID",
+    "in_reply_to": "In-Reply-To",
+    "references": "References",
+}
+
+
+def parse_raw_message(raw_bytes, meta=None):
+    """Parses an RFC 822 message into a normalized record.
+
+    Args:
+        raw_bytes: The decoded message bytes (Gmail's format='raw', decoded).
+        meta: Optional Gmail fields to carry over ('id', 'threadId',
+            'labelIds', 'internalDate', 'sizeEstimate').
+
+    Returns:
+        A dict with 'id', 'thread_id', 'labels', 'internal_date',
+        'size_estimate', the header fields ('subject', 'from', 'to', 'cc',
+        'date', 'message_id', 'in_reply_to', 'references'), 'body' (plain
+        text, or HTML when there is no plain part) and 'attachments' (a list
+        of 'filename', 'mime_type' and approximate 'size').
+    """
+    meta = meta or {}
+    message = email.message_from_bytes(raw_bytes, policy=email.policy.default)
+    record = {
+        "id": meta.get("id"),
+        "thread_id": meta.get("threadId"),
+        "labels": meta.get("labelIds", []),
+        "internal_date": int(meta["internalDate"]) if meta.get("internalDate") else None,
+        "size_estimate": meta.get("sizeEstimate"),
+    }
+    for field, header in _HEADER_FIELDS.items():
+        try:
+            value = message.get(header)
+            record[field] = str(value) if value is not None else ""
+        except Exception:  # Malformed header
+            record[field] = ""
+
+    body = ""
+    try:
+        body_part = message.get_body(preferencelist=("plain", "html"))
+        if body_part is not None:
+            body = body_part.get_content()
+    except Exception:
+        payload = message.get_payload(decode=True)
+        body = payload.decode("utf-8", "replace") if isinstance(payload, bytes) else ""
+    record["body"] = body
+
+    attachments = []
+    for part in message.iter_attachments():
+        encoded = part.get_payload()
+        size = len(encoded) if isinstance(encoded, str) else 0
+        if part.get("Content-Transfer-Encoding", "").lower() == "base64":
+            size = size * 3 // 4
+        attachments.append({
+            "filename": part.get_filename() or "",
+            "mime_type": part.get_content_type(),
+            "size": size,
+        })
+    record["attachments"] = attachments
+    return record
+
+
+def _attach(name):
+    # Workers share the parent's resource tracker, which already tracks the
+    # block; attaching again is harmless and the parent unlinks it.
+    try:
+        return SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        return SharedMemory(name=name)
+
+
+def parse_shared_chunk(shm_name, entries):
+    """Worker entry point: parses messages whose base64url 'raw' text sits in shared memory.
+
+    Args:
+        shm_name: Name of the SharedMemory block written by the parent.
+        entries: A list of (offset, length, meta) tuples locating each
+            message's base64url text in the block.
+
+    Returns:
+        A list of normalized records (see parse_raw_message), in entry order.
+        A message that fails to parse yields a record with 'id' and 'error'.
+    """
+    shm = _attach(shm_name)
+    try:
+        records = []
+        for offset, length, meta in entries:
+            try:
+                encoded = bytes(shm.buf[offset:offset + length])
+                raw = base64.urlsafe_b64decode(encoded + b"=" * (-len(encoded) % 4))
+                records.append(parse_raw_message(raw, meta))
+            except Exception as e:
+                records.append({"id": meta.get("id"), "error": f"{type(e).__name__}: {e}"})
+        return records
+    finally:
+        shm.close()
+# --- End Raw Message Parsing ---
@@ -0,0 +1,349 @@
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import random
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+from .atomic_files import atomic_write_json
+from .gmail_agent_logic import build_reply, get_gmail_service
+from .projection import SENT_MESSAGE_FIELDS, THREAD_HEADERS_FIELDS
+from .triage import get_triage_scorer
+
+# --- Outbox Configuration ---
+OUTBOX_JOURNAL_PATH = os.environ.get("GMAIL_AGENT_OUTBOX_JOURNAL", "outbox_journal.jsonl")
+OUTBOX_WORKERS = int(os.environ.get("GMAIL_AGENT_OUTBOX_WORKERS", "4"))
+MAX_SEND_ATTEMPTS = 5
+RETRY_BASE_DELAY_SECONDS = 2.0
+RETRY_MAX_DELAY_SECONDS = 300.0
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# Header stamped on every outgoing reply so a retry can tell whether an earlier
+# attempt actually reached Gmail before the connection dropped.
+OUTBOX_ID_HEADER = "X-Gmail-Agent-Outbox-Id"
+# Rewrite the journal once it holds this many more records than live entries.
+JOURNAL_COMPACT_SLACK = 500
+# Finished (sent/failed) entries are dropped from the journal after this long.
+FINISHED_RETENTION_SECONDS = 7 * 24 * 3600
+# How long send_reply waits for the outbox to deliver before reporting the
+# reply as still queued. Covers a few quick retries, not the full backoff.
+SEND_WAIT_SECONDS = float(os.environ.get("GMAIL_AGENT_SEND_WAIT_SECONDS", "30"))
+
+STATUS_QUEUED = "queued"
+STATUS_SENDING = "sending"
+STATUS_RETRYING = "retrying"
+STATUS_SENT = "sent"
+STATUS_FAILED = "failed"
+PENDING_STATUSES = (STATUS_QUEUED, STATUS_SENDING, STATUS_RETRYING)
+FINISHED_STATUSES = (STATUS_SENT, STATUS_FAILED)
+# --- End Outbox Configuration ---
+
+
+def make_outbox_id(thread_id, reply_body):
+    """Derives the idempotency key for a reply from its thread and draft text."""
+    draft_hash = hashlib.sha256(reply_body.encode("utf-8")).hexdigest()
+    return f"{thread_id}-{draft_hash[:16]}"
+
+
+def _is_retryable(error):
+    """Rate limits, server errors and network failures are transient; bad requests are not."""
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUS_CODES
+    return not isinstance(error, ValueError)
+
+
+class Outbox:
+    """Durable queue of replies, drained by a background pool of sender threads.
+
+    Every state change is appended to a JSON-lines journal (and fsynced)
+    before it takes effect, so queued replies survive a crash or restart and
+    are picked up again when the outbox is next started.
+    """
+
+    def __init__(self, journal_path=OUTBOX_JOURNAL_PATH, workers=OUTBOX_WORKERS,
+                 max_attempts=MAX_SEND_ATTEMPTS):
+        self.journal_path = journal_path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._entries = {}
+        self._ready = []  # heap of (ready_at, sequence, outbox_id)
+        self._sequence = itertools.count()
+        lock = threading.RLock()
+        self._condition = threading.Condition(lock)  # Senders wait here for ready entries
+        self._finished = threading.Condition(lock)  # wait() callers wait here for sent/failed
+        self._threads = []
+        self._journal_records = 0
+        with self._condition:
+            self._load_journal()
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    # --- Journal ---
+    def _load_journal(self):
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, "r", encoding="utf-8") as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn final write from a crash; everything before it is intact.
+                    continue
+                self._journal_records += 1
+                entry = self._entries.setdefault(record["outbox_id"], {})
+                entry.update(record)
+
+        now = time.time()
+        for outbox_id, entry in list(self._entries.items()):
+            if entry.get("status") in PENDING_STATUSES:
+                # Interrupted sends are retried; the outbox header check in
+                # _deliver prevents a duplicate if the send had gone through.
+                self._schedule(outbox_id, time.monotonic())
+            elif now - entry.get("updated_at", now) > FINISHED_RETENTION_SECONDS:
+                del self._entries[outbox_id]
+        self._compact_journal()
+
+    def _append_journal(self, record):
+        self._journal.write(json.dumps(record) + "\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._journal_records += 1
+        if self._journal_records > len(self._entries) + JOURNAL_COMPACT_SLACK:
+            self._journal.close()
+            self._compact_journal()
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    def _compact_journal(self):
+        atomic_write_json(self.journal_path, self._entries.values(), lines=True)
+        self._journal_records = len(self._entries)
+
+    def _update(self, outbox_id, **changes):
+        """Journals and applies a change to an entry. Caller holds the condition lock."""
+        changes["updated_at"] = time.time()
+        self._append_journal({"outbox_id": outbox_id, **changes})
+        self._entries[outbox_id].update(changes)
+        if changes.get("status") in FINISHED_STATUSES:
+            self._finished.notify_all()
+    # --- End Journal ---
+
+    def _schedule(self, outbox_id, ready_at):
+        heapq.heappush(self._ready, (ready_at, next(self._sequence), outbox_id))
+        self._condition.notify()
+
+    def start(self):
+        """Starts the background sender threads (idempotent)."""
+        with self._condition:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"outbox-sender-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def enqueue(self, user_id, to, sender, subject, reply_body, thread_id, original_message_id, references):
+        """Journals a reply for sending and returns (entry, duplicate).
+
+        A reply with the same thread and draft text as an existing pending or
+        sent entry is not queued again; the existing entry is returned.
+        """
+        outbox_id = make_outbox_id(thread_id, reply_body)
+        with self._condition:
+            existing = self._entries.get(outbox_id)
+            if existing and existing.get("status") != STATUS_FAILED:
+                return dict(existing), True
+            now = time.time()
+            entry = {
+                "outbox_id": outbox_id,
+                "user_id": user_id,
+                "to": to,
+                "sender": sender,
+                "subject": subject,
+                "reply_body": reply_body,
+                "thread_id": thread_id,
+                "original_message_id": original_message_id,
+                "references": references,
+                "status": STATUS_QUEUED,
+                "attempts": 0,
+                "created_at": now,
+                "updated_at": now,
+            }
+            self._append_journal(entry)
+            self._entries[outbox_id] = entry
+            self._schedule(outbox_id, time.monotonic())
+            return dict(entry), False
+
+    def get_status(self, outbox_id=None):
+        """Returns a copy of an entry (the most recent one if no ID is given)."""
+        with self._condition:
+            if not outbox_id:
+                if not self._entries:
+                    return None
+                outbox_id = max(self._entries.values(), key=lambda e: e.get("created_at", 0))["outbox_id"]
+            entry = self._entries.get(outbox_id)
+            return dict(entry) if entry else None
+
+    def wait(self, outbox_id, timeout):
+        """Waits up to timeout seconds for an entry to be sent or fail, and returns a copy of it.
+
+        The returned entry may still be pending if the timeout ran out first;
+        None is returned for an unknown ID.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                entry = self._entries.get(outbox_id)
+                if not entry:
+                    return None
+                remaining = deadline - time.monotonic()
+                if entry.get("status") in FINISHED_STATUSES or remaining <= 0:
+                    return dict(entry)
+                self._finished.wait(remaining)
+
+    # --- Sender Pool ---
+    def _next_ready(self):
+        with self._condition:
+            while True:
+                if self._ready:
+                    ready_at, _, outbox_id = self._ready[0]
+                    delay = ready_at - time.monotonic()
+                    if delay <= 0:
+                        heapq.heappop(self._ready)
+                        entry = self._entries.get(outbox_id)
+                        if not entry or entry.get("status") not in PENDING_STATUSES:
+                            continue
+                        self._update(outbox_id, status=STATUS_SENDING, attempts=entry.get("attempts", 0) + 1)
+                        return dict(self._entries[outbox_id])
+                    self._condition.wait(delay)
+                else:
+                    self._condition.wait()
+
+    def _worker(self):
+        while True:
+            entry = self._next_ready()
+            outbox_id = entry["outbox_id"]
+            try:
+                message_id = self._deliver(entry)
+            except Exception as e:
+                with self._condition:
+                    if _is_retryable(e) and entry["attempts"] < self.max_attempts:
+                        delay = min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** (entry["attempts"] - 1))
+                        delay *= random.uniform(0.5, 1.5)  # Jitter so retries don't stampede.
+                        print(f"Outbox send {outbox_id} failed (attempt {entry['attempts']}), retrying in {delay:.1f}s: {e}")
+                        self._update(outbox_id, status=STATUS_RETRYING, error=str(e))
+                        self._schedule(outbox_id, time.monotonic() + delay)
+                    else:
+                        print(f"Outbox send {outbox_id} failed permanently: {e}")
+                        self._update(outbox_id, status=STATUS_FAILED, error=str(e))
+                continue
+            with self._condition:
+                self._update(outbox_id, status=STATUS_SENT, message_id=message_id, error=None)
+            print(f"Reply sent successfully. Message ID: {message_id}")
+
+    def _deliver(self, entry):
+        service = get_gmail_service(entry["user_id"])
+        if not service:
+            raise RuntimeError("Failed to get Gmail service.")
+        if entry["attempts"] > 1:
+            already_sent = self._find_sent_message(service, entry)
+            if already_sent:
+                return already_sent
+        message = build_reply(
+            service, entry["user_id"], entry["to"], entry["sender"], entry["subject"],
+            entry["reply_body"], entry["thread_id"], entry["original_message_id"], entry["references"],
+            extra_headers={OUTBOX_ID_HEADER: entry["outbox_id"]},
+        )
+        # Pooled services pace every request, this send included, to the
+        # account's Gmail quota (service_pool.QuotaTracker).
+        sent = service.users().messages().send(
+            userId=entry["user_id"], body=message, fields=SENT_MESSAGE_FIELDS
+        ).execute()
+        return sent["id"]
+
+    def _find_sent_message(self, service, entry):
+        """Returns the ID of a message in the thread carrying this entry's outbox header, if any."""
+        thread = service.users().threads().get(
+            userId=entry["user_id"], id=entry["thread_id"], format='metadata',
+            metadataHeaders=[OUTBOX_ID_HEADER], fields=THREAD_HEADERS_FIELDS
+        ).execute()
+        for message in thread.get('messages', []):
+            for header in message.get('payload', {}).get('headers', []):
+                if header['name'].lower() == OUTBOX_ID_HEADER.lower() and header['value'] == entry["outbox_id"]:
+                    return message['id']
+        return None
+    # --- End Sender Pool ---
+
+
+# --- Module-Level Outbox ---
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox():
+    """Returns the process-wide outbox, loading its journal and starting senders on first use."""
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = Outbox()
+            _outbox.start()
+        return _outbox
+
+
+def _public_entry(entry):
+    return {key: value for key, value in entry.items() if key != "reply_body"}
+
+
+def queue_reply(user_id: str, to: str, sender: str, subject: str, reply_body: str, thread_id: str, original_message_id: str, references: str) -> dict:
+    """Queues a reply for background sending and returns immediately.
+
+    Args:
+        user_id: The user's email address or 'me'.
+        to: The recipient's email address.
+        sender: The sender's email address (should be the authenticated user).
+        subject: The subject line for the reply email.
+        reply_body: The plain text content of the reply.
+        thread_id: The ID of the thread to reply within.
+        original_message_id: The Message-ID header of the message being replied to.
+        references: The References header content for threading.
+
+    Returns:
+        A dictionary containing the 'status' ('success' or 'error'),
+        and either 'outbox_id', 'send_status' and 'duplicate' on success
+        or 'error_message' on failure.
+    """
+    try:
+        entry, duplicate = get_outbox().enqueue(
+            user_id, to, sender, subject, reply_body, thread_id, original_message_id, references
+        )
+        if not duplicate:
+            get_triage_scorer().record_action({"sender_email": to, "thread_id": thread_id, "subject": subject}, "replied")
+        return {"status": "success", "outbox_id": entry["outbox_id"], "send_status": entry["status"], "duplicate": duplicate}
+    except Exception as e:
+        return {"status": "error", "error_message": f"An unexpected error occurred queueing the reply: {e}"}
+
+
+def wait_for_send(outbox_id, timeout=None):
+    """Waits for a queued reply to be sent or fail (SEND_WAIT_SECONDS by default); see Outbox.wait."""
+    return get_outbox().wait(outbox_id, SEND_WAIT_SECONDS if timeout is None else timeout)
+
+
+def get_send_status(outbox_id: str = "") -> dict:
+    """Gets the delivery status of a reply queued for sending.
+
+    Args:
+        outbox_id: The outbox ID returned when the reply was queued. Leave empty
+            for the most recently queued reply.
+
+    Returns:
+        A dictionary containing the 'status' ('success' or 'error'), and either
+        'entry' (with 'send_status', 'attempts', 'message_id' and 'error') on
+        success or 'error_message' on failure.
+    """
+    entry = get_outbox().get_status(outbox_id)
+    if not entry:
+        return {"status": "error", "error_message": "No queued reply found."}
+    entry = _public_entry(entry)
+    entry["send_status"] = entry.pop("status")
+    return {"status": "success", "entry": entry}
+# --- End Module-Level Outbox ---
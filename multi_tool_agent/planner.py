@@ -0,0 +1,104 @@
+import contextvars
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .profiling import turn_task
+
+# --- Plan Execution ---
+# A plan is a short list of tool calls emitted by the controller for one turn.
+# Steps that do not depend on each other (e.g. an unread count and a search)
+# run concurrently; a step that needs an earlier step's effect (e.g. drafting
+# a reply to the email that a previous step summarized) waits for it. Outputs
+# are always returned in plan order so the merged response reads naturally.
+
+DEFAULT_MAX_WORKERS = 4
+
+
+class PlanStep:
+    """One tool call in a plan."""
+
+    def __init__(self, index, name, args=None, depends_on=()):
+        self.index = index
+        self.name = name
+        self.args = args or {}
+        self.depends_on = set(depends_on)
+
+    def __repr__(self):
+        return f"PlanStep({self.index}, {self.name!r}, {self.args!r}, depends_on={sorted(self.depends_on)})"
+
+
+def build_plan(calls, reads_context=(), writes_context=()):
+    """Builds plan steps from (name, args) calls and infers their dependencies.
+
+    A step that reads the shared conversation context depends on every earlier
+    step that writes to it. Everything else is independent.
+
+    Args:
+        calls: A list of (name, args) tuples in the order the controller emitted them.
+        reads_context: A callable (name, args) -> bool, or a collection of names,
+            identifying steps that read the conversation context.
+        writes_context: Same as reads_context, for steps that update the context.
+
+    Returns:
+        A list of PlanStep objects.
+    """
+    reads = reads_context if callable(reads_context) else (lambda name, args: name in reads_context)
+    writes = writes_context if callable(writes_context) else (lambda name, args: name in writes_context)
+
+    steps = []
+    writers = []
+    for index, (name, args) in enumerate(calls):
+        depends_on = writers if reads(name, args) else ()
+        steps.append(PlanStep(index, name, args, depends_on))
+        if writes(name, args):
+            writers = writers + [index]
+    return steps
+
+
+def execute_plan(steps, run_step, max_workers=DEFAULT_MAX_WORKERS):
+    """Runs plan steps, executing every step whose dependencies are done concurrently.
+
+    Args:
+        steps: A list of PlanStep objects (as returned by build_plan).
+        run_step: A callable taking a PlanStep and returning its output. It is
+            called from worker threads.
+        max_workers: The maximum number of steps running at once.
+
+    Returns:
+        A list with the output of every step, in plan order. If a step raises,
+        its exception object is returned in its slot; steps depending on it
+        are still run so they can report their own error.
+    """
+    if not steps:
+        return []
+    if len(steps) == 1:
+        # Nothing to overlap; avoid the thread hand-off.
+        try:
+            return [run_step(steps[0])]
+        except Exception as e:
+            return [e]
+
+    outputs = {}
+    pending = {step.index: step for step in steps}
+    running = {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(steps))) as executor:
+        while pending or running:
+            for index, step in list(pending.items()):
+                if step.depends_on.issubset(outputs):
+                    # Each step runs in a copy of the caller's context (e.g. its wire
+                    # tally), on a thread sampled with the caller's profiled turn
+                    running[executor.submit(contextvars.copy_context().run, turn_task(run_step), step)] = index
+                    del pending[index]
+            if not running:
+                # Unsatisfiable dependency (should not happen with build_plan).
+                for index in pending:
+                    outputs[index] = RuntimeError(f"Plan step {index} has unresolved dependencies.")
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                try:
+                    outputs[index] = future.result()
+                except Exception as e:
+                    outputs[index] = e
+    return [outputs[step.index] for step in steps]
+# --- End Plan Execution ---
@@ -0,0 +1,213 @@
+import contextvars
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+# --- Profiler Configuration ---
+# GMAIL_AGENT_PROFILE=1 profiles a fraction (GMAIL_AGENT_PROFILE_SAMPLE_RATE)
+# of chat turns; a single turn can also be profiled on request (see
+# profile_turn). While a turn is profiled, a sampler thread records the stack
+# of the turn's thread, and of the worker threads running work for the turn
+# (plan steps, HTTP and Gemini calls; see turn_task) while they are busy,
+# every GMAIL_AGENT_PROFILE_INTERVAL_MS. Threads serving other users' turns
+# are never sampled. When profiling is off, profile_turn is a flag check
+# returning a shared no-op context.
+PROFILE_ENABLED = os.environ.get("GMAIL_AGENT_PROFILE", "0") == "1"
+PROFILE_SAMPLE_RATE = float(os.environ.get("GMAIL_AGENT_PROFILE_SAMPLE_RATE", "0.1"))
+PROFILE_INTERVAL_SECONDS = float(os.environ.get("GMAIL_AGENT_PROFILE_INTERVAL_MS", "5")) / 1000
+PROFILE_DIR = os.environ.get("GMAIL_AGENT_PROFILE_DIR", "profiles")
+PROFILE_TOP_N = int(os.environ.get("GMAIL_AGENT_PROFILE_TOP_N", "25"))
+
+# (file name, function) of leaf frames that mean a thread is parked, not working.
+IDLE_LEAF_FRAMES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+    ("selectors.py", "select"),
+    ("socketserver.py", "serve_forever"),
+    ("base_events.py", "_run_once"),
+}
+# --- End Profiler Configuration ---
+
+_NO_PROFILE = nullcontext()
+_frame_names = {}
+# The profiler of the turn the current context belongs to, if it is profiled.
+_current_profiler = contextvars.ContextVar("turn_profiler", default=None)
+
+
+def _frame_name(code):
+    name = _frame_names.get(code)
+    if name is None:
+        name = _frame_names[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    return name
+
+
+def _is_idle(frame):
+    code = frame.f_code
+    return (os.path.basename(code.co_filename), code.co_name) in IDLE_LEAF_FRAMES
+
+
+def _thread_cpu_seconds(ident):
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None  # Per-thread CPU clocks are unavailable on this platform
+
+
+class TurnProfiler:
+    """Samples wall-clock and CPU stacks while a block runs and writes the reports.
+
+    On exit, writes to output_dir:
+      <stem>.wall.folded / <stem>.cpu.folded: collapsed stacks ("a;b;c count",
+        the input format of flamegraph.pl and speedscope); wall counts are
+        samples, CPU counts are microseconds of thread CPU time.
+      <stem>.top.txt: the top_n functions by self and total time, both ways.
+    """
+
+    def __init__(self, label="turn", interval=PROFILE_INTERVAL_SECONDS, output_dir=PROFILE_DIR, top_n=PROFILE_TOP_N):
+        self.label = label
+        self.interval = interval
+        self.output_dir = output_dir
+        self.top_n = top_n
+        self.wall_stacks = Counter()
+        self.cpu_stacks = Counter()
+        self.paths = []
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = Counter()  # ident -> blocks attached (see attached)
+        self._last_cpu = {}
+
+    def __enter__(self):
+        self._target = threading.get_ident()
+        self._threads[self._target] += 1
+        self._token = _current_profiler.set(self)
+        self._started = time.perf_counter()
+        self._sampler = threading.Thread(target=self._sample_loop, name="turn-profiler", daemon=True)
+        self._sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._sampler.join()
+        _current_profiler.reset(self._token)
+        self.elapsed = time.perf_counter() - self._started
+        try:
+            self.write()
+        except OSError as e:
+            print(f"Error writing profile for {self.label}: {e}")
+        return False
+
+    @contextmanager
+    def attached(self):
+        """Samples the calling thread as part of this turn while the block runs."""
+        ident = threading.get_ident()
+        with self._lock:
+            if not self._threads[ident]:
+                # A pooled thread's CPU time from before it joined the turn isn't the turn's.
+                self._last_cpu.pop(ident, None)
+            self._threads[ident] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._threads[ident] -= 1
+                if not self._threads[ident]:
+                    del self._threads[ident]
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                sampled = []
+                for ident in self._threads:
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    cpu = _thread_cpu_seconds(ident)
+                    cpu_delta = cpu - self._last_cpu.get(ident, cpu) if cpu is not None else 0.0
+                    if cpu is not None:
+                        self._last_cpu[ident] = cpu
+                    sampled.append((ident, frame, cpu_delta))
+            for ident, frame, cpu_delta in sampled:
+                if ident != self._target and _is_idle(frame):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                folded = ";".join(reversed(stack))
+                self.wall_stacks[folded] += 1
+                if cpu_delta > 0:
+                    self.cpu_stacks[folded] += int(cpu_delta * 1_000_000)
+
+    @staticmethod
+    def _top_functions(stacks, top_n):
+        self_counts = Counter()
+        total_counts = Counter()
+        for folded, count in stacks.items():
+            frames = folded.split(";")
+            self_counts[frames[-1]] += count
+            for name in set(frames):
+                total_counts[name] += count
+        return self_counts.most_common(top_n), total_counts.most_common(top_n)
+
+    def report(self):
+        """Returns the top-N text report."""
+        lines = [f"Profile of {self.label}: {self.elapsed:.3f}s wall, "
+                 f"{sum(self.wall_stacks.values())} samples every {self.interval * 1000:.0f}ms", ""]
+        for title, stacks, unit, scale in (
+            ("Wall clock", self.wall_stacks, "ms", self.interval * 1000),
+            ("CPU", self.cpu_stacks, "ms", 0.001),
+        ):
+            top_self, top_total = self._top_functions(stacks, self.top_n)
+            for kind, rows in (("self", top_self), ("total", top_total)):
+                lines.append(f"{title}, top {self.top_n} by {kind} time:")
+                lines.extend(f"  {count * scale:10.1f} {unit}  {name}" for name, count in rows)
+                lines.append("")
+        return "\n".join(lines)
+
+    def write(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        stem = os.path.join(self.output_dir, f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{self.label}")
+        for suffix, stacks in ((".wall.folded", self.wall_stacks), (".cpu.folded", self.cpu_stacks)):
+            with open(stem + suffix, "w", encoding="utf-8") as folded_file:
+                folded_file.writelines(f"{folded} {count}\n" for folded, count in stacks.items())
+            self.paths.append(stem + suffix)
+        with open(stem + ".top.txt", "w", encoding="utf-8") as report_file:
+            report_file.write(self.report())
+        self.paths.append(stem + ".top.txt")
+        print(f"[profile] {self.label} took {self.elapsed:.3f}s; wrote {stem}.{{wall.folded,cpu.folded,top.txt}}")
+
+
+def turn_task(func):
+    """Wraps func so the thread running it is sampled with the caller's profiled turn.
+
+    Use it for work a turn hands to a worker thread; when the caller's turn
+    isn't profiled, func is returned unchanged.
+    """
+    profiler = _current_profiler.get()
+    if profiler is None:
+        return func
+
+    def run(*args, **kwargs):
+        with profiler.attached():
+            return func(*args, **kwargs)
+    return run
+
+
+def profile_turn(label="turn", force=False):
+    """Returns a context manager that profiles the enclosed turn when selected.
+
+    A turn is profiled when force is set (a per-request opt-in) or when
+    GMAIL_AGENT_PROFILE=1 and the turn falls in the sampled fraction.
+    Otherwise the shared no-op context is returned.
+    """
+    if not force and not (PROFILE_ENABLED and random.random() < PROFILE_SAMPLE_RATE):
+        return _NO_PROFILE
+    return TurnProfiler(label)
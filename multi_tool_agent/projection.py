@@ -0,0 +1,148 @@
+import contextvars
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+# --- Response Projections ---
+# Every Gmail call asks only for the fields its caller reads (a fields=
+# partial-response mask), and message fetches use the smallest format that
+# carries what the caller needs:
+#   minimal:  IDs and labels, no payload
+#   metadata: plus the named headers only
+#   full:     the parsed MIME tree (bodies, attachment parts)
+#   raw:      the whole RFC 822 message as one base64url string (bulk parsing)
+NEED_IDS = "ids"
+NEED_LABELS = "labels"
+NEED_HEADERS = "headers"
+NEED_BODY = "body"
+NEED_ATTACHMENTS = "attachments"
+NEED_RAW = "raw"
+
+# need -> (messages.get format, fields mask)
+MESSAGE_PROJECTIONS = {
+    NEED_IDS: ("minimal", "id,threadId"),
+    NEED_LABELS: ("minimal", "id,threadId,labelIds"),
+    NEED_HEADERS: ("metadata", "id,threadId,labelIds,payload/headers"),
+    # Nested parts can't be narrowed further: 'parts' is returned whole.
+    NEED_BODY: ("full", "id,threadId,labelIds,snippet,payload(mimeType,headers,body/data,parts)"),
+    NEED_ATTACHMENTS: ("full", "id,threadId,payload(partId,filename,mimeType,body,parts)"),
+    NEED_RAW: ("raw", "id,threadId,labelIds,internalDate,sizeEstimate,raw"),
+}
+
+# Masks for the other calls, by what their callers read.
+LIST_IDS_FIELDS = "messages/id,nextPageToken,resultSizeEstimate"
+LIST_COUNT_FIELDS = "messages/id"
+LABEL_UNREAD_FIELDS = "messagesUnread"
+PROFILE_ADDRESS_FIELDS = "emailAddress"
+SENT_MESSAGE_FIELDS = "id,threadId"
+THREAD_HEADERS_FIELDS = "messages(id,payload/headers)"
+WATCH_FIELDS = "historyId,expiration"
+
+
+def message_projection(need, metadata_headers=None):
+    """Returns the messages.get keyword arguments (format, fields, metadataHeaders) for a need.
+
+    Args:
+        need: One of the NEED_* values: what the caller reads from the message.
+        metadata_headers: The headers to return, for NEED_HEADERS.
+    """
+    fmt, fields = MESSAGE_PROJECTIONS[need]
+    kwargs = {"format": fmt, "fields": fields}
+    if fmt == "metadata" and metadata_headers:
+        kwargs["metadataHeaders"] = list(metadata_headers)
+    return kwargs
+# --- End Response Projections ---
+
+
+# --- Wire Accounting ---
+class WireTally:
+    """Calls and bytes per Gmail method.
+
+    Bytes sent are the request URI plus body; bytes received are response
+    bodies as handed to the client (after any gzip decoding, so an upper
+    bound on what crossed the network).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.methods = defaultdict(lambda: [0, 0, 0])  # method -> [calls, sent, received]
+
+    def add(self, method, sent, received):
+        with self._lock:
+            counts = self.methods[method]
+            counts[0] += 1
+            counts[1] += sent
+            counts[2] += received
+
+    def totals(self):
+        """Returns {method: {'calls', 'bytes_sent', 'bytes_received'}}."""
+        with self._lock:
+            return {
+                method: {"calls": calls, "bytes_sent": sent, "bytes_received": received}
+                for method, (calls, sent, received) in self.methods.items()
+            }
+
+    def summary(self):
+        totals = self.totals()
+        if not totals:
+            return "no Gmail calls"
+        calls = sum(counts["calls"] for counts in totals.values())
+        received = sum(counts["bytes_received"] for counts in totals.values())
+        by_method = ", ".join(
+            f"{method.rpartition('gmail.users.')[2]} x{counts['calls']} {counts['bytes_received'] / 1024:.1f} KB"
+            for method, counts in sorted(totals.items(), key=lambda item: -item[1]["bytes_received"])
+        )
+        return f"{calls} Gmail calls, {received / 1024:.1f} KB received ({by_method})"
+
+
+class WireMeter:
+    """Process-wide byte accounting, plus a tally for the current turn.
+
+    turn() scopes a tally with a context variable, so calls made on worker
+    threads count towards a turn as long as the work is submitted with the
+    turn's context (contextvars.copy_context().run).
+    """
+
+    def __init__(self):
+        self.process = WireTally()
+        self._turn = contextvars.ContextVar("wire_turn", default=None)
+
+    def record(self, method, sent, received):
+        self.process.add(method, sent, received)
+        turn = self._turn.get()
+        if turn is not None:
+            turn.add(method, sent, received)
+
+    @contextmanager
+    def turn(self):
+        tally = WireTally()
+        token = self._turn.set(tally)
+        try:
+            yield tally
+        finally:
+            self._turn.reset(token)
+
+
+wire_meter = WireMeter()
+
+
+class MeteredHttp:
+    """Wraps an httplib2-style object and records each request's size in wire_meter."""
+
+    def __init__(self, inner, method_id=None, meter=wire_meter):
+        self._inner = inner
+        self._method_id = method_id or "unknown"
+        self._meter = meter
+
+    def __getattr__(self, name):
+        return getattr(self._inner, name)
+
+    def request(self, uri, method="GET", body=None, *args, **kwargs):
+        response, content = self._inner.request(uri, method, body, *args, **kwargs)
+        method_name = self._method_id
+        if "/batch/" in uri:
+            # A batch goes through the http of its first request.
+            method_name += " (batch)"
+        self._meter.record(method_name, len(uri) + len(body or b""), len(content or b""))
+        return response, content
+# --- End Wire Accounting ---
@@ -0,0 +1,375 @@
+import functools
+import hashlib
+import inspect
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import datetime
+
+from .profiling import turn_task
+from .shared_cache import get_shared_cache
+
+# --- Resilience Configuration ---
+# Each external dependency (Gmail, Gemini) gets a circuit breaker and a
+# deadline. After BREAKER_FAILURE_THRESHOLD consecutive failures the breaker
+# opens and calls fail immediately; after BREAKER_RESET_SECONDS one trial call
+# is let through to see whether the dependency has recovered.
+GMAIL_DEADLINE_SECONDS = float(os.environ.get("GMAIL_AGENT_GMAIL_DEADLINE_SECONDS", "10"))
+GEMINI_DEADLINE_SECONDS = float(os.environ.get("GMAIL_AGENT_GEMINI_DEADLINE_SECONDS", "20"))
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("GMAIL_AGENT_BREAKER_FAILURES", "3"))
+BREAKER_RESET_SECONDS = float(os.environ.get("GMAIL_AGENT_BREAKER_RESET_SECONDS", "30"))
+# Each breaker runs its calls on its own threads, at most this many at once.
+# A call that blows its deadline keeps running in the background (a thread
+# can't be cancelled) and holds its slot until it returns; once every slot is
+# taken, new calls are rejected at once rather than queued behind them.
+MAX_CALLS_IN_FLIGHT = int(os.environ.get("GMAIL_AGENT_MAX_CALLS_IN_FLIGHT", "16"))
+# Streamed attachment downloads (attachments.py) can take far longer than an
+# API call, so they get their own breaker, deadline and slots instead of
+# holding Gmail's.
+ATTACHMENT_DEADLINE_SECONDS = float(os.environ.get("GMAIL_AGENT_ATTACHMENT_DEADLINE_SECONDS", "120"))
+MAX_DOWNLOADS_IN_FLIGHT = 4
+STALE_CACHE_MAX_ENTRIES = 256
+# Last good results are also kept in the shared cache tier, so a worker that
+# never saw a success can still serve one while a dependency is down.
+STALE_SHARED_TTL_SECONDS = 24 * 3600
+# An unchanged result is written to the shared tier again only after this
+# long, so the shared copy never expires while the tool keeps succeeding.
+STALE_SHARED_REWRITE_SECONDS = STALE_SHARED_TTL_SECONDS / 2
+REVALIDATE_WORKERS = 2
+# HTTP statuses that mean the dependency itself is unhealthy (as opposed to a
+# bad request such as an unknown message ID).
+DEPENDENCY_FAILURE_STATUSES = {429, 500, 502, 503, 504}
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+# --- End Resilience Configuration ---
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose circuit breaker is open."""
+
+
+class DependencyBusyError(CircuitOpenError):
+    """Raised instead of queueing a call when all of a dependency's call slots are taken."""
+
+
+class DeadlineExceededError(TimeoutError):
+    """Raised when a dependency call does not finish within its deadline."""
+
+
+class CircuitBreaker:
+    """Tracks the health of one dependency and fails fast while it is down."""
+
+    def __init__(self, name, deadline_seconds, failure_threshold=BREAKER_FAILURE_THRESHOLD,
+                 reset_seconds=BREAKER_RESET_SECONDS, max_calls_in_flight=MAX_CALLS_IN_FLIGHT):
+        self.name = name
+        self.deadline_seconds = deadline_seconds
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.max_calls_in_flight = max_calls_in_flight
+        # One slot per executor thread: holding a slot guarantees a free thread,
+        # so a call starts as soon as it is submitted.
+        self._slots = threading.BoundedSemaphore(max_calls_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_calls_in_flight,
+                                            thread_name_prefix=f"{name.lower()}-call")
+        self._lock = threading.Lock()
+        self._state = STATE_CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == STATE_OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                return STATE_HALF_OPEN
+            return self._state
+
+    def _before_call(self):
+        with self._lock:
+            if self._state == STATE_CLOSED:
+                return
+            retry_in = self.reset_seconds - (time.monotonic() - self._opened_at)
+            if retry_in > 0 or self._trial_in_flight:
+                raise CircuitOpenError(
+                    f"{self.name} is temporarily unavailable; retrying in {max(retry_in, 0):.0f}s."
+                )
+            # Half-open: let exactly one trial call through.
+            self._state = STATE_HALF_OPEN
+            self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            if self._state != STATE_CLOSED:
+                print(f"[breaker] {self.name} recovered; circuit closed.")
+            self._state = STATE_CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == STATE_HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != STATE_OPEN:
+                    print(f"[breaker] {self.name} failing; circuit opened for {self.reset_seconds:.0f}s.")
+                self._state = STATE_OPEN
+                self._opened_at = time.monotonic()
+
+    def call(self, func, *args, is_failure=None, **kwargs):
+        """Runs func under the breaker, raising DeadlineExceededError past the deadline.
+
+        The deadline counts from when func starts running. If max_calls_in_flight
+        calls are already running (typically ones that blew their deadline and
+        haven't returned yet), raises DependencyBusyError straight away; that
+        isn't counted as a failure of the dependency.
+
+        Args:
+            func: The dependency call.
+            is_failure: Optional predicate on func's return value; a True
+                result counts as a dependency failure (e.g. an HTTP 503
+                response) without raising.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise DependencyBusyError(
+                f"{self.name} is busy ({self.max_calls_in_flight} calls still in flight); try again shortly."
+            )
+        try:
+            self._before_call()
+        except CircuitOpenError:
+            self._slots.release()
+            raise
+        started = threading.Event()
+
+        def run():
+            started.set()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._slots.release()
+
+        future = self._executor.submit(turn_task(run))
+        started.wait()
+        try:
+            result = future.result(timeout=self.deadline_seconds)
+        except FutureTimeoutError:
+            self.record_failure()
+            raise DeadlineExceededError(f"{self.name} did not respond within {self.deadline_seconds:.0f}s.")
+        except Exception as e:
+            if _is_dependency_error(e):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        if is_failure and is_failure(result):
+            self.record_failure()
+        else:
+            self.record_success()
+        return result
+
+
+def _is_dependency_error(error):
+    status = getattr(getattr(error, "resp", None), "status", None) or getattr(error, "code", None)
+    if isinstance(status, int):
+        return status in DEPENDENCY_FAILURE_STATUSES
+    return True  # Network errors, timeouts and unexpected failures
+
+
+gmail_breaker = CircuitBreaker("Gmail", GMAIL_DEADLINE_SECONDS)
+gemini_breaker = CircuitBreaker("Gemini", GEMINI_DEADLINE_SECONDS)
+attachment_breaker = CircuitBreaker("Gmail attachments", ATTACHMENT_DEADLINE_SECONDS,
+                                    max_calls_in_flight=MAX_DOWNLOADS_IN_FLIGHT)
+
+
+# --- Guarded Clients ---
+class GuardedHttp:
+    """Wraps an httplib2-style object so every request goes through a breaker."""
+
+    def __init__(self, inner, breaker=gmail_breaker):
+        self._inner = inner
+        self._breaker = breaker
+
+    def __getattr__(self, name):
+        return getattr(self._inner, name)
+
+    def request(self, *args, **kwargs):
+        return self._breaker.call(
+            self._inner.request, *args,
+            is_failure=lambda result: int(result[0].status) in DEPENDENCY_FAILURE_STATUSES,
+            **kwargs,
+        )
+
+
+class GuardedModel:
+    """Wraps a GenerativeModel so generate_content goes through a breaker."""
+
+    def __init__(self, model, breaker=gemini_breaker):
+        self._model = model
+        self._breaker = breaker
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+    def generate_content(self, *args, **kwargs):
+        return self._breaker.call(self._model.generate_content, *args, **kwargs)
+
+
+def guard_model(model, breaker=gemini_breaker):
+    return GuardedModel(model, breaker) if model is not None else None
+# --- End Guarded Clients ---
+
+
+# --- Stale-While-Revalidate Cache ---
+class StaleCache:
+    """Remembers the last successful result per key so it can be served while a dependency is down.
+
+    Entries are kept per account: the shared tier stores them under the
+    account's user_id, so SharedCache.invalidate_user() makes them unreachable
+    in every worker, and invalidate_user() drops this worker's copies.
+    """
+
+    def __init__(self, max_entries=STALE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, stored_at, user_id, digest, shared_at)
+        self._refreshing = set()
+        self._executor = ThreadPoolExecutor(max_workers=REVALIDATE_WORKERS, thread_name_prefix="stale-revalidate")
+
+    @staticmethod
+    def _shared_key(key):
+        return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _digest(value):
+        encoded = json.dumps(value, default=str, sort_keys=True, separators=(",", ":")).encode("utf-8")
+        return hashlib.sha1(encoded).hexdigest()
+
+    def _store_locked(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key, user_id="me"):
+        """Returns (value, stored_at) for the key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+                return entry[:2]
+        shared = get_shared_cache().get("stale", user_id, self._shared_key(key))
+        if not shared:
+            return None
+        with self._lock:
+            # Already in the shared tier: no need to write it back on the next unchanged put.
+            self._store_locked(key, (shared["value"], shared["stored_at"], user_id,
+                                     self._digest(shared["value"]), shared["stored_at"]))
+        return shared["value"], shared["stored_at"]
+
+    def put(self, key, value, user_id="me"):
+        """Remembers a successful result.
+
+        The shared tier is only written when the result differs from the one
+        this worker last shared for the key, or that copy is more than
+        STALE_SHARED_REWRITE_SECONDS old, so a healthy call that returns the
+        same data as before costs no backend write.
+        """
+        stored_at = time.time()
+        digest = self._digest(value)
+        with self._lock:
+            previous = self._entries.get(key)
+            share = (previous is None or previous[3] != digest
+                     or stored_at - previous[4] >= STALE_SHARED_REWRITE_SECONDS)
+            shared_at = stored_at if share else previous[4]
+            self._store_locked(key, (value, stored_at, user_id, digest, shared_at))
+        if share:
+            get_shared_cache().put("stale", user_id, (self._shared_key(key),),
+                                   {"value": value, "stored_at": stored_at}, STALE_SHARED_TTL_SECONDS)
+
+    def invalidate(self, predicate=None):
+        """Drops every entry (or those whose key matches predicate)."""
+        with self._lock:
+            for key in [key for key in self._entries if predicate is None or predicate(key)]:
+                del self._entries[key]
+
+    def invalidate_user(self, user_id):
+        """Drops this worker's entries for an account (the shared tier is cleared by SharedCache.invalidate_user)."""
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[2] == user_id]:
+                del self._entries[key]
+
+    def revalidate(self, key, refresh, user_id="me"):
+        """Runs refresh() in the background (once per key at a time) and caches a success."""
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                result = refresh()
+                if result.get("status") == "success":
+                    self.put(key, result, user_id)
+            except Exception as e:
+                print(f"Background refresh of {key[0]} failed: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        self._executor.submit(run)
+
+
+stale_cache = StaleCache()
+
+
+def serve_stale_on_error(func):
+    """Decorates a tool returning a status dict to fall back to its last good result.
+
+    Successful results are remembered per tool and arguments. When a call
+    fails and an earlier result exists, that result is returned instead with
+    'stale': True, 'stale_as_of' (ISO timestamp) and 'stale_reason' added, and
+    a background refresh is started so the next call sees fresh data.
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = (func.__name__,) + tuple(sorted((name, repr(value)) for name, value in bound.arguments.items()))
+        user_id = str(bound.arguments.get("user_id", "me"))
+        result = func(*args, **kwargs)
+        if result.get("status") == "success":
+            stale_cache.put(key, result, user_id)
+            return result
+        cached = stale_cache.get(key, user_id)
+        if not cached:
+            return result
+        value, stored_at = cached
+        stale_cache.revalidate(key, lambda: func(*args, **kwargs), user_id)
+        return dict(
+            value,
+            stale=True,
+            stale_as_of=datetime.fromtimestamp(stored_at).isoformat(timespec="seconds"),
+            stale_reason=result.get("error_message", "Unknown error"),
+        )
+
+    return wrapper
+
+
+def stale_note(result):
+    """Returns a one-line notice for a stale result, or '' for a fresh one."""
+    if not result.get("stale"):
+        return ""
+    return f"(Showing saved results from {result['stale_as_of']}; live data is unavailable: {result['stale_reason']})"
+# --- End Stale-While-Revalidate Cache ---
+
+
+def dependency_status():
+    """Returns the breaker state of each dependency, e.g. for a status banner."""
+    return {breaker.name: breaker.state for breaker in (gmail_breaker, gemini_breaker, attachment_breaker)}
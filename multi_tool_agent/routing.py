@@ -0,0 +1,127 @@
+import re
+
+from .gmail_agent_logic import (
+    get_emails_received_today_count,
+    get_total_unread_count,
+    list_recent_emails,
+    search_emails,
+    summarize_email_with_gemini,
+)
+from .resilience import stale_note
+
+# --- Rule-Based Pre-Router ---
+# Obvious requests ("how many unread", "show my last 5 emails", "send it") do
+# not need an LLM to decide what to do. route_message matches them with cheap
+# regular expressions and says which tool to call directly, or which
+# specialist agent to hand the message to. Anything else returns None and
+# goes to the LLM coordinator.
+
+ROUTE_TOOL = "tool"
+ROUTE_AGENT = "agent"
+
+SEARCH_AGENT = "inbox_search_agent"
+SUMMARIZING_AGENT = "email_summarizing_agent"
+REPLY_AGENT = "email_reply_agent"
+SENDING_AGENT = "email_sending_agent"
+
+DIRECT_TOOLS = {
+    "list_recent_emails": list_recent_emails,
+    "search_emails": search_emails,
+    "summarize_email_with_gemini": summarize_email_with_gemini,
+    "get_total_unread_count": get_total_unread_count,
+    "get_emails_received_today_count": get_emails_received_today_count,
+}
+
+_COMPOUND = re.compile(r"\b(and then|and also|then)\b|,\s*and\b|\balso\b|[;?].+\S", re.I)
+_SEND = re.compile(r"^\W*(?:(?:yes|yep|yeah|ok(?:ay)?|sure|great|perfect)\W*)*(?:please\s+)?"
+                   r"(?:send(?: it| the reply| that)?|go ahead(?: and send(?: it)?)?)\W*(?:please|now)?\W*$", re.I)
+_DRAFT = re.compile(r"\b(draft|write|compose)\b.*\b(reply|response|answer)\b|\breply\b.*\bsaying\b", re.I)
+_SUMMARIZE = re.compile(r"\b(summari[sz]e|summary|tl;?dr)\b", re.I)
+_EMAIL_ID = re.compile(r"\b([0-9a-f]{16})\b", re.I)
+_UNREAD = re.compile(r"\bunread\b", re.I)
+_TODAY = re.compile(r"\b(today|last 24 hours|since yesterday)\b", re.I)
+_COUNT = re.compile(r"\b(how many|number of|count)\b", re.I)
+_LIST = re.compile(r"\b(show|list|get|see|what are|display)\b.*\b(last|latest|recent|newest)\b", re.I)
+_COUNT_WORD = re.compile(r"\b(\d{1,3})\b")
+_FROM_ADDRESS = re.compile(r"\bfrom\s+([\w.+-]+@[\w-]+(?:\.[\w-]+)+)", re.I)
+_FILTER_WORDS = re.compile(r"\b(from|about|regarding|subject|with|containing)\b", re.I)
+
+
+class Route:
+    """Where a message should go: a tool to call directly or an agent to run."""
+
+    def __init__(self, kind, name, args=None):
+        self.kind = kind
+        self.name = name
+        self.args = args or {}
+
+    def __repr__(self):
+        return f"Route({self.kind!r}, {self.name!r}, {self.args!r})"
+
+
+def route_message(text):
+    """Returns a Route for obvious requests, or None if the LLM should decide."""
+    text = (text or "").strip()
+    if not text or _COMPOUND.search(text):
+        return None  # Multi-part requests need planning
+
+    if _SEND.match(text):
+        return Route(ROUTE_AGENT, SENDING_AGENT)
+    if _DRAFT.search(text):
+        return Route(ROUTE_AGENT, REPLY_AGENT)
+    if _SUMMARIZE.search(text):
+        email_id = _EMAIL_ID.search(text)
+        if email_id:
+            return Route(ROUTE_TOOL, "summarize_email_with_gemini", {"email_id": email_id.group(1)})
+        return None  # Needs a lookup first; let the coordinator plan it
+    if _COUNT.search(text) and _UNREAD.search(text):
+        return Route(ROUTE_TOOL, "get_total_unread_count")
+    if _COUNT.search(text) and _TODAY.search(text):
+        return Route(ROUTE_TOOL, "get_emails_received_today_count")
+
+    sender = _FROM_ADDRESS.search(text)
+    if sender and not re.search(r"\b(about|regarding|subject|containing)\b", text, re.I):
+        return Route(ROUTE_TOOL, "search_emails", {"query": f"from:{sender.group(1)}"})
+    if _LIST.search(text) and not _FILTER_WORDS.search(text):
+        count = _COUNT_WORD.search(text)
+        return Route(ROUTE_TOOL, "list_recent_emails", {"max_results": int(count.group(1)) if count else 5})
+    if _FILTER_WORDS.search(text) and re.search(r"\b(find|search|look for)\b", text, re.I):
+        return Route(ROUTE_AGENT, SEARCH_AGENT)
+    return None
+
+
+def call_direct_tool(route, user_id='me'):
+    """Runs a ROUTE_TOOL route and returns the tool's result dict."""
+    func = DIRECT_TOOLS[route.name]
+    if route.name == "search_emails":
+        return func(query=route.args["query"], user_id=user_id)
+    return func(user_id=user_id, **route.args)
+
+
+def format_tool_result(name, result):
+    """Renders a direct tool result as the text shown to the user."""
+    if result.get("status") != "success":
+        return f"Sorry, that didn't work: {result.get('error_message', 'Unknown error')}"
+    note = stale_note(result)
+    if note:
+        return f"{_format_success(name, result)}\n\n{note}"
+    return _format_success(name, result)
+
+
+def _format_success(name, result):
+    if name in ("list_recent_emails", "search_emails"):
+        emails = result.get("emails", [])
+        if not emails:
+            return "No emails found."
+        return "\n\n".join(
+            f"{index}. {email.get('subject', 'N/A')} — {email.get('from', 'N/A')} ({email.get('date', 'N/A')}) [id: {email.get('id')}]"
+            for index, email in enumerate(emails, start=1)
+        )
+    if name == "get_total_unread_count":
+        return f"You have {result['unread_count']} unread emails in your inbox."
+    if name == "get_emails_received_today_count":
+        return f"You received approximately {result['today_count']} emails in the last 24 hours."
+    if name == "summarize_email_with_gemini":
+        return f"Summary of '{result.get('subject', 'No Subject')}':\n{result['summary']}"
+    return str(result)
+# --- End Rule-Based Pre-Router ---
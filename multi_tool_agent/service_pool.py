@@ -0,0 +1,310 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import google_auth_httplib2
+import httplib2
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from google_auth_oauthlib.flow import InstalledAppFlow
+from googleapiclient.discovery import build
+from googleapiclient.http import HttpRequest
+
+from . import cassette
+from .atomic_files import atomic_write_text
+from .projection import MeteredHttp
+from .resilience import GuardedHttp
+
+# --- Service Pool Configuration ---
+DEFAULT_ACCOUNT = "me"
+DEFAULT_TOKEN_PATH = "token.json"  # The default account keeps the original token location
+TOKEN_DIR = os.environ.get("GMAIL_AGENT_TOKEN_DIR", "tokens")
+MAX_POOLED_SERVICES = int(os.environ.get("GMAIL_AGENT_MAX_SERVICES", "64"))
+IDLE_EVICT_SECONDS = int(os.environ.get("GMAIL_AGENT_IDLE_EVICT_SECONDS", "1800"))
+# Credentials expiring within this window are refreshed in the background.
+REFRESH_AHEAD_SECONDS = 300
+REFRESH_INTERVAL_SECONDS = 60
+REFRESH_WORKERS = 8
+HTTP_TIMEOUT_SECONDS = 30
+
+# Gmail per-user quota: 250 units per second. Costs per method from the Gmail
+# API usage limits page; unknown methods are charged 5 units.
+USER_QUOTA_UNITS_PER_SECOND = 250
+DEFAULT_METHOD_COST = 5
+METHOD_QUOTA_COSTS = {
+    "gmail.users.getProfile": 1,
+    "gmail.users.labels.get": 1,
+    "gmail.users.labels.list": 1,
+    "gmail.users.history.list": 2,
+    "gmail.users.messages.list": 5,
+    "gmail.users.messages.get": 5,
+    "gmail.users.messages.attachments.get": 5,
+    "gmail.users.messages.modify": 5,
+    "gmail.users.threads.get": 10,
+    "gmail.users.messages.send": 100,
+    "gmail.users.watch": 100,
+}
+# --- End Service Pool Configuration ---
+
+
+class AccountNotAuthorizedError(Exception):
+    """Raised when no stored token exists for an account."""
+
+
+def token_path_for(account):
+    if account == DEFAULT_ACCOUNT:
+        return DEFAULT_TOKEN_PATH
+    safe_name = "".join(c if c.isalnum() or c in "@._-" else "_" for c in account)
+    return os.path.join(TOKEN_DIR, f"{safe_name}.json")
+
+
+# --- Quota Accounting ---
+class QuotaTracker:
+    """Per-account token bucket over Gmail quota units, with usage counters."""
+
+    def __init__(self, units_per_second=USER_QUOTA_UNITS_PER_SECOND):
+        self.units_per_second = units_per_second
+        self._lock = threading.Lock()
+        self._available = {}
+        self._updated = {}
+        self._used = defaultdict(lambda: defaultdict(int))
+
+    def charge(self, account, method_id):
+        """Records a call and blocks until the account has quota for it."""
+        cost = METHOD_QUOTA_COSTS.get(method_id, DEFAULT_METHOD_COST)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                available = self._available.get(account, self.units_per_second)
+                available = min(self.units_per_second,
+                                available + (now - self._updated.get(account, now)) * self.units_per_second)
+                self._updated[account] = now
+                if available >= cost:
+                    self._available[account] = available - cost
+                    self._used[account][method_id or "unknown"] += cost
+                    return cost
+                self._available[account] = available
+                wait_seconds = (cost - available) / self.units_per_second
+            time.sleep(wait_seconds)
+
+    def usage(self, account=None):
+        """Returns quota units used per method, for one account or all of them."""
+        with self._lock:
+            if account is not None:
+                return dict(self._used.get(account, {}))
+            return {name: dict(methods) for name, methods in self._used.items()}
+# --- End Quota Accounting ---
+
+
+class _ThreadConnections:
+    """httplib2-style object that gives each thread its own connection for one account.
+
+    httplib2.Http isn't thread safe, so threads can't share one; keeping one
+    per thread (instead of one per request) lets each thread's later
+    requests reuse its kept-alive TLS connection. Requests run on the
+    breaker's call threads (resilience.GuardedHttp), so this is one
+    connection per call thread and account.
+    """
+
+    def __init__(self, connect):
+        self._connect = connect
+        self._local = threading.local()
+
+    def _http(self):
+        http = getattr(self._local, "http", None)
+        if http is None:
+            http = self._local.http = self._connect()
+        return http
+
+    def __getattr__(self, name):
+        return getattr(self._http(), name)
+
+    def request(self, *args, **kwargs):
+        return self._http().request(*args, **kwargs)
+
+
+class _PooledAccount:
+    def __init__(self, account, credentials, service):
+        self.account = account
+        self.credentials = credentials
+        self.service = service
+        self.last_used = time.monotonic()
+
+
+class ServicePool:
+    """Caches one Gmail service per account, keyed by user_id.
+
+    Each service is built once and shared across threads: requests go out on
+    a connection per thread (httplib2 is not thread safe), kept open between
+    requests and authorized with the account's credentials. Idle services
+    (and their connections) are evicted
+    LRU-first, tokens are refreshed ahead of expiry by a background thread,
+    and every request is charged against the account's Gmail quota and
+    metered in projection.wire_meter.
+    """
+
+    def __init__(self, scopes, default_credentials_loader=None, max_services=MAX_POOLED_SERVICES,
+                 idle_evict_seconds=IDLE_EVICT_SECONDS):
+        self.scopes = scopes
+        self.default_credentials_loader = default_credentials_loader
+        self.max_services = max_services
+        self.idle_evict_seconds = idle_evict_seconds
+        self.quota = QuotaTracker()
+        self._accounts = OrderedDict()
+        self._lock = threading.Lock()
+        self._account_locks = defaultdict(threading.Lock)
+        self._refresher = None
+
+    # --- Credentials ---
+    def _load_credentials(self, account):
+        if account == DEFAULT_ACCOUNT and self.default_credentials_loader:
+            # Keeps the interactive first-run OAuth flow for the default account.
+            return self.default_credentials_loader()
+        path = token_path_for(account)
+        if not os.path.exists(path):
+            raise AccountNotAuthorizedError(
+                f"No token stored for {account}. Run: python -m multi_tool_agent.service_pool authorize {account}"
+            )
+        creds = Credentials.from_authorized_user_file(path, self.scopes)
+        if not creds.valid:
+            self._refresh(account, creds)
+        return creds
+
+    def _account_lock(self, account):
+        with self._lock:
+            return self._account_locks[account]
+
+    def _refresh(self, account, creds):
+        creds.refresh(Request())
+        atomic_write_text(token_path_for(account), creds.to_json())
+
+    def refresh_expiring(self, ahead_seconds=REFRESH_AHEAD_SECONDS):
+        """Refreshes, concurrently, every pooled credential close to expiry."""
+        with self._lock:
+            pooled = list(self._accounts.values())
+        # google-auth stores expiry as a naive UTC datetime.
+        cutoff = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(seconds=ahead_seconds)
+        expiring = [
+            entry for entry in pooled
+            if entry.credentials and entry.credentials.refresh_token and (
+                not entry.credentials.expiry or entry.credentials.expiry < cutoff
+                or not entry.credentials.valid
+            )
+        ]
+        if not expiring:
+            return 0
+
+        def refresh(entry):
+            with self._account_lock(entry.account):
+                try:
+                    self._refresh(entry.account, entry.credentials)
+                except Exception as e:
+                    print(f"Error refreshing token for {entry.account}: {e}")
+
+        with ThreadPoolExecutor(max_workers=min(REFRESH_WORKERS, len(expiring))) as executor:
+            list(executor.map(refresh, expiring))
+        return len(expiring)
+    # --- End Credentials ---
+
+    def _build_service(self, account, creds):
+        quota = self.quota
+        if cassette.is_replaying():
+            connections = cassette.replay_http()
+        else:
+            connections = _ThreadConnections(lambda: cassette.wrap_http(
+                google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT_SECONDS))
+            ))
+
+        def build_request(http, postproc, uri, method="GET", body=None, headers=None, methodId=None, resumable=None):
+            quota.charge(account, methodId)
+            # Deadline and circuit breaker around every Gmail request; bytes
+            # are metered outside them, on the caller's thread.
+            return HttpRequest(MeteredHttp(GuardedHttp(connections), methodId), postproc, uri, method=method, body=body,
+                               headers=headers, methodId=methodId, resumable=resumable)
+
+        return build("gmail", "v1", http=connections, requestBuilder=build_request)
+
+    def _get_entry(self, account):
+        account = account or DEFAULT_ACCOUNT
+        with self._lock:
+            entry = self._accounts.get(account)
+            if entry:
+                self._accounts.move_to_end(account)
+                entry.last_used = time.monotonic()
+                return entry
+        # Build outside the pool lock so one slow account doesn't block the rest;
+        # the per-account lock stops two threads building the same service.
+        with self._account_lock(account):
+            with self._lock:
+                entry = self._accounts.get(account)
+            if not entry:
+                # Replayed traffic comes from a cassette; no token is needed.
+                creds = None if cassette.is_replaying() else self._load_credentials(account)
+                entry = _PooledAccount(account, creds, self._build_service(account, creds))
+                print(f"Gmail service built successfully for {account}.")
+                with self._lock:
+                    self._accounts[account] = entry
+                    self._evict_locked()
+        self._start_refresher()
+        return entry
+
+    def get_service(self, account=DEFAULT_ACCOUNT):
+        return self._get_entry(account).service
+
+    def get_credentials(self, account=DEFAULT_ACCOUNT):
+        return self._get_entry(account).credentials
+
+    def _evict_locked(self):
+        now = time.monotonic()
+        for account, entry in list(self._accounts.items()):
+            if now - entry.last_used > self.idle_evict_seconds:
+                del self._accounts[account]
+                self._account_locks.pop(account, None)
+        while len(self._accounts) > self.max_services:
+            account, _ = self._accounts.popitem(last=False)
+            self._account_locks.pop(account, None)
+
+    def evict_idle(self):
+        with self._lock:
+            self._evict_locked()
+
+    def _start_refresher(self):
+        with self._lock:
+            if self._refresher:
+                return
+            self._refresher = threading.Thread(target=self._refresh_loop, name="gmail-token-refresher", daemon=True)
+            self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(REFRESH_INTERVAL_SECONDS)
+            try:
+                self.evict_idle()
+                self.refresh_expiring()
+            except Exception as e:
+                print(f"Error in token refresher: {e}")
+
+    def accounts(self):
+        with self._lock:
+            return list(self._accounts)
+
+
+def authorize_account(account, scopes, client_secrets="credentials.json"):
+    """Runs the OAuth flow for an account and stores its token in the token directory."""
+    flow = InstalledAppFlow.from_client_secrets_file(client_secrets, scopes)
+    creds = flow.run_local_server(port=0, login_hint=account)
+    path = token_path_for(account)
+    atomic_write_text(path, creds.to_json())
+    print(f"Stored token for {account} in {path}.")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "authorize":
+        print("Usage: python -m multi_tool_agent.service_pool authorize <email address>")
+        sys.exit(1)
+    from .gmail_agent_logic import SCOPES
+    authorize_account(sys.argv[2], SCOPES)
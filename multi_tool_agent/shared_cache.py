@@ -0,0 +1,433 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+
+# --- Shared Cache Configuration ---
+# A cache tier shared by every worker process of a deployment, behind the
+# in-process caches. GMAIL_AGENT_SHARED_CACHE selects the backend:
+#   off (default)  no shared tier; every process keeps only its own caches
+#   disk           files in GMAIL_AGENT_SHARED_CACHE_DIR (default: /dev/shm,
+#                  i.e. shared memory, when available): workers on one host
+#   redis://...    a Redis-compatible server: workers on any host
+# Keys carry CACHE_SCHEMA_VERSION (bump it when a cached value's shape
+# changes) and a per-account generation that invalidate_user() bumps, so old
+# entries are never read again and simply expire.
+SHARED_CACHE_URL = os.environ.get("GMAIL_AGENT_SHARED_CACHE", "off")
+SHARED_CACHE_DIR = os.environ.get("GMAIL_AGENT_SHARED_CACHE_DIR") or (
+    "/dev/shm/gmail-agent-cache" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "gmail-agent-cache")
+)
+CACHE_NAMESPACE = "gmail-agent"
+CACHE_SCHEMA_VERSION = 1
+# How long a worker trusts its copy of an account's generation.
+GENERATION_REFRESH_SECONDS = 2.0
+# Single-flight fill: the worker holding the fill lock fetches; the others
+# wait for its result for as long as the fill may take (get_or_fill's
+# fill_seconds, the deadline of the dependency it calls) plus
+# FILL_WAIT_MARGIN_SECONDS, then fetch themselves. The lock lives at least
+# that long too, and never less than FILL_LOCK_SECONDS.
+FILL_LOCK_SECONDS = 30
+DEFAULT_FILL_SECONDS = 10
+FILL_WAIT_MARGIN_SECONDS = 5
+FILL_POLL_SECONDS = 0.05
+# DiskBackend.incr's read-modify-write lock.
+COUNTER_LOCK_SECONDS = 5
+DISK_SWEEP_EVERY_WRITES = 1000
+# --- End Shared Cache Configuration ---
+
+
+# --- Backends ---
+# A backend stores bytes under string keys with an optional TTL in seconds:
+# get, get_many, set, set_many, add (set only if absent; the fill lock),
+# delete, delete_if (delete only if the value matches; releasing a lock) and
+# incr.
+class NullBackend:
+    """No shared tier: nothing is stored, and every fill lock is granted."""
+
+    def get(self, key):
+        return None
+
+    def get_many(self, keys):
+        return [None] * len(keys)
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def set_many(self, items, ttl=None):
+        pass
+
+    def add(self, key, value, ttl=None):
+        return True
+
+    def delete(self, key):
+        pass
+
+    def delete_if(self, key, value):
+        return False
+
+    def incr(self, key):
+        return 0
+
+
+class DiskBackend:
+    """One file per key in a directory shared by the workers of a host.
+
+    Writes go to a temporary file renamed into place, so readers never see a
+    torn entry; add() relies on O_EXCL file creation. Pointed at /dev/shm the
+    entries live in shared memory.
+    """
+
+    def __init__(self, directory=SHARED_CACHE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._writes = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    @staticmethod
+    def _encode(value, ttl):
+        expires = f"{time.time() + ttl:.3f}" if ttl else "0"
+        return expires.encode("ascii") + b"\n" + value
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as entry_file:
+                data = entry_file.read()
+        except FileNotFoundError:
+            return None
+        expires, _, value = data.partition(b"\n")
+        try:
+            expired = expires != b"0" and float(expires) < time.time()
+        except ValueError:
+            # A lock file add() has created but not written yet (or one left
+            # empty by a crash, which expires like a lock would).
+            try:
+                expired = time.time() - os.path.getmtime(path) > FILL_LOCK_SECONDS
+            except FileNotFoundError:
+                return None
+        return None if expired else value
+
+    def get(self, key):
+        return self._read(self._path(key))
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, ttl=None):
+        path = self._path(key)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as entry_file:
+            entry_file.write(self._encode(value, ttl))
+        os.replace(temp_path, path)
+        self._writes += 1
+        if self._writes % DISK_SWEEP_EVERY_WRITES == 0:
+            self.sweep()
+
+    def set_many(self, items, ttl=None):
+        for key, value in items:
+            self.set(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        path = self._path(key)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if self._read(path) is not None:
+                    return False
+                self._unlink(path)  # Expired (e.g. a lock whose holder died): take it over
+                continue
+            with os.fdopen(fd, "wb") as entry_file:
+                entry_file.write(self._encode(value, ttl))
+            return True
+        return False
+
+    def delete(self, key):
+        self._unlink(self._path(key))
+
+    def delete_if(self, key, value):
+        # Not atomic: another worker can only take the entry over between the
+        # read and the unlink if it expired in that instant.
+        if self.get(key) != value:
+            return False
+        self.delete(key)
+        return True
+
+    def incr(self, key):
+        lock_key = f"{key}:lock"
+        token = uuid.uuid4().hex.encode("ascii")
+        deadline = time.monotonic() + 2 * COUNTER_LOCK_SECONDS
+        while not self.add(lock_key, token, ttl=COUNTER_LOCK_SECONDS):
+            # A dead holder's lock expires after COUNTER_LOCK_SECONDS, so this
+            # only times out if something keeps taking it.
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Could not lock shared cache counter {key!r}.")
+            time.sleep(0.01)
+        try:
+            value = int(self.get(key) or 0) + 1
+            self.set(key, str(value).encode("ascii"))
+            return value
+        finally:
+            # Only release the lock if it is still ours (it may have expired
+            # and been taken over by another worker).
+            self.delete_if(lock_key, token)
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def sweep(self):
+        """Deletes expired entries (run every DISK_SWEEP_EVERY_WRITES writes)."""
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(".tmp") and self._read(path) is None:
+                self._unlink(path)
+
+
+# Deletes KEYS[1] only if it still holds ARGV[1], in one atomic step.
+REDIS_DELETE_IF_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class RedisBackend:
+    """Stores entries in a Redis-compatible server through a redis-py style client.
+
+    Any client with get, mget, set(ex=, nx=), pipeline, delete, eval and incr
+    works, e.g. redis.Redis or a local stand-in such as fakeredis.FakeRedis.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url):
+        try:
+            import redis
+        except ImportError as e:
+            raise ImportError("GMAIL_AGENT_SHARED_CACHE is a redis:// URL but the 'redis' package "
+                              "is not installed. Run: pip install redis") from e
+        return cls(redis.Redis.from_url(url))
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def get_many(self, keys):
+        return self.client.mget(keys) if keys else []
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, value, ex=int(ttl) if ttl else None)
+
+    def set_many(self, items, ttl=None):
+        pipeline = self.client.pipeline(transaction=False)  # One round trip
+        for key, value in items:
+            pipeline.set(key, value, ex=int(ttl) if ttl else None)
+        pipeline.execute()
+
+    def add(self, key, value, ttl=None):
+        return bool(self.client.set(key, value, ex=int(ttl) if ttl else None, nx=True))
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def delete_if(self, key, value):
+        return bool(self.client.eval(REDIS_DELETE_IF_SCRIPT, 1, key, value))
+
+    def incr(self, key):
+        return int(self.client.incr(key))
+
+
+def backend_from_url(url=SHARED_CACHE_URL):
+    """Builds the backend named by a GMAIL_AGENT_SHARED_CACHE value."""
+    if not url or url == "off":
+        return NullBackend()
+    if url == "disk":
+        return DiskBackend()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend.from_url(url)
+    raise ValueError(f"Unknown GMAIL_AGENT_SHARED_CACHE backend: {url!r} (use off, disk or a redis:// URL)")
+# --- End Backends ---
+
+
+class SharedCache:
+    """JSON values in a shared backend, with versioned keys and single-flight fills.
+
+    Backend errors never reach the caller: a failing backend behaves like an
+    empty cache, so the app keeps working (uncached) while it is down.
+    """
+
+    def __init__(self, backend, namespace=CACHE_NAMESPACE):
+        self.backend = backend
+        self.namespace = namespace
+        self.enabled = not isinstance(backend, NullBackend)
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.counters = Counter()
+        self._generations = {}  # user_id -> (generation, fetched_at)
+        self._lock = threading.Lock()
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+            return self.counters[name]
+
+    def _backend_call(self, operation, default, *args):
+        try:
+            return getattr(self.backend, operation)(*args)
+        except Exception as e:
+            errors = self._count("errors")
+            if errors == 1 or errors % 100 == 0:
+                print(f"Shared cache {operation} failed ({errors} errors so far), continuing uncached: {e}")
+            return default
+
+    # --- Keys ---
+    def _generation(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._generations.get(user_id)
+        if cached and now - cached[1] < GENERATION_REFRESH_SECONDS:
+            return cached[0]
+        raw = self._backend_call("get", None, f"{self.namespace}:generation:{user_id}")
+        generation = int(raw or 0)
+        with self._lock:
+            self._generations[user_id] = (generation, now)
+        return generation
+
+    def key(self, kind, user_id, *parts):
+        """Returns the versioned backend key of an entry."""
+        return ":".join((self.namespace, f"v{CACHE_SCHEMA_VERSION}", user_id, f"g{self._generation(user_id)}",
+                         kind, *map(str, parts)))
+    # --- End Keys ---
+
+    def get(self, kind, user_id, *parts):
+        """Returns the cached value, or None on a miss."""
+        if not self.enabled:
+            return None
+        raw = self._backend_call("get", None, self.key(kind, user_id, *parts))
+        self._count("hits" if raw is not None else "misses")
+        return json.loads(raw) if raw is not None else None
+
+    def get_many(self, kind, user_id, parts_list):
+        """Returns {parts: value} for the entries found, one backend round trip for all."""
+        if not self.enabled or not parts_list:
+            return {}
+        keys = [self.key(kind, user_id, *parts) for parts in parts_list]
+        raws = self._backend_call("get_many", [None] * len(keys), keys)
+        found = {parts: json.loads(raw) for parts, raw in zip(parts_list, raws) if raw is not None}
+        self._count("hits", len(found))
+        self._count("misses", len(keys) - len(found))
+        return found
+
+    @staticmethod
+    def _encode(value):
+        return json.dumps(value, default=str, separators=(",", ":")).encode("utf-8")
+
+    def put(self, kind, user_id, parts, value, ttl):
+        if self.enabled:
+            self._backend_call("set", None, self.key(kind, user_id, *parts), self._encode(value), ttl)
+
+    def put_many(self, kind, user_id, values, ttl):
+        """Stores {parts: value} entries in one backend round trip."""
+        if self.enabled and values:
+            items = [(self.key(kind, user_id, *parts), self._encode(value)) for parts, value in values.items()]
+            self._backend_call("set_many", None, items, ttl)
+
+    def delete(self, kind, user_id, *parts):
+        if self.enabled:
+            self._backend_call("delete", None, self.key(kind, user_id, *parts))
+
+    def get_or_fill(self, kind, user_id, parts, fill, ttl, cacheable=lambda value: True,
+                    fill_seconds=DEFAULT_FILL_SECONDS):
+        """Returns the cached value, or fill()'s result stored for the other workers.
+
+        Only one worker at a time runs fill() for a key: the others wait for
+        its result instead of fetching it too. Results for which
+        cacheable(value) is false are returned but not stored.
+
+        Args:
+            fill_seconds: The longest fill() can take, normally the deadline
+                of the dependency it calls. Waiting workers give up after
+                this (plus FILL_WAIT_MARGIN_SECONDS) and fetch themselves.
+        """
+        if not self.enabled:
+            return fill()
+        key = self.key(kind, user_id, *parts)
+        raw = self._backend_call("get", None, key)
+        if raw is not None:
+            self._count("hits")
+            return json.loads(raw)
+        self._count("misses")
+
+        lock_key = f"{key}:filling"
+        # Names this fill, so only it releases the lock: if the fill outlives
+        # the lock, another worker (or thread) may hold it by then.
+        lock_token = f"{self.worker_id}-{uuid.uuid4().hex[:8]}".encode("ascii")
+        wait_seconds = fill_seconds + FILL_WAIT_MARGIN_SECONDS
+        lock_seconds = max(FILL_LOCK_SECONDS, wait_seconds)
+        if not self._backend_call("add", True, lock_key, lock_token, lock_seconds):
+            deadline = time.monotonic() + wait_seconds
+            while time.monotonic() < deadline:
+                time.sleep(FILL_POLL_SECONDS)
+                raw = self._backend_call("get", None, key)
+                if raw is not None:
+                    self._count("waited_hits")
+                    return json.loads(raw)
+                if self._backend_call("get", None, lock_key) is None:
+                    break  # The filler gave up (e.g. its fetch failed)
+            self._count("wait_timeouts")
+            return fill()
+        try:
+            value = fill()
+            if cacheable(value):
+                self.put(kind, user_id, parts, value, ttl)
+                self._count("fills")
+            return value
+        finally:
+            self._backend_call("delete_if", False, lock_key, lock_token)
+
+    def invalidate_user(self, user_id):
+        """Makes every entry of an account unreachable, in every worker (within GENERATION_REFRESH_SECONDS)."""
+        if not self.enabled:
+            return
+        generation = self._backend_call("incr", None, f"{self.namespace}:generation:{user_id}")
+        with self._lock:
+            if generation is None:
+                self._generations.pop(user_id, None)
+            else:
+                self._generations[user_id] = (generation, time.monotonic())
+
+    def stats(self):
+        """Returns the hit/miss/fill counters and the hit rate of this worker."""
+        with self._lock:
+            counters = dict(self.counters)
+        lookups = counters.get("hits", 0) + counters.get("misses", 0)
+        counters["hit_rate"] = round((counters.get("hits", 0) + counters.get("waited_hits", 0)) / lookups, 3) if lookups else None
+        return counters
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_shared_cache():
+    """Returns the process-wide SharedCache for GMAIL_AGENT_SHARED_CACHE."""
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            try:
+                backend = backend_from_url(SHARED_CACHE_URL)
+            except Exception as e:
+                print(f"Error setting up the shared cache, continuing without it: {e}")
+                backend = NullBackend()
+            _shared_cache = SharedCache(backend)
+        return _shared_cache
@@ -0,0 +1,366 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from google.adk.events import Event
+from google.adk.sessions import BaseSessionService, Session, State
+from google.adk.sessions.base_session_service import GetSessionConfig, ListEventsResponse, ListSessionsResponse
+from google.genai import types
+
+# --- Session Store Configuration ---
+SESSION_DB_PATH = os.environ.get("GMAIL_AGENT_SESSION_DB", "agent_sessions.db")
+SESSION_TTL_SECONDS = int(os.environ.get("GMAIL_AGENT_SESSION_TTL_SECONDS", str(7 * 24 * 3600)))
+# Events handed to the runner by get_session when no config is given. Older
+# turns are still available through list_events/iter_events.
+DEFAULT_RECENT_EVENTS = 50
+# Once a session's log holds COMPACT_THRESHOLD events, everything but the
+# newest COMPACT_KEEP_RECENT is folded into the session's snapshot.
+COMPACT_THRESHOLD = 200
+COMPACT_KEEP_RECENT = 50
+SNAPSHOT_MAX_LINES = 100
+SNAPSHOT_LINE_CHARS = 300
+SNAPSHOT_AUTHOR = "conversation_snapshot"
+EVICT_INTERVAL_SECONDS = 300
+EVENTS_PAGE_SIZE = 100
+# --- End Session Store Configuration ---
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    app_name TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    create_time REAL NOT NULL,
+    update_time REAL NOT NULL,
+    PRIMARY KEY (app_name, user_id, id)
+);
+CREATE INDEX IF NOT EXISTS sessions_update_time ON sessions (update_time);
+CREATE TABLE IF NOT EXISTS events (
+    app_name TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (app_name, user_id, session_id, seq)
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    app_name TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    compacted_events INTEGER NOT NULL,
+    lines TEXT NOT NULL,
+    PRIMARY KEY (app_name, user_id, session_id)
+);
+CREATE TABLE IF NOT EXISTS app_states (
+    app_name TEXT PRIMARY KEY,
+    state TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_states (
+    app_name TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (app_name, user_id)
+);
+"""
+
+
+def _split_state(state):
+    """Splits a state dict into (app, user, session) parts; temp: keys are dropped."""
+    app_state, user_state, session_state = {}, {}, {}
+    for key, value in (state or {}).items():
+        if key.startswith(State.APP_PREFIX):
+            app_state[key[len(State.APP_PREFIX):]] = value
+        elif key.startswith(State.USER_PREFIX):
+            user_state[key[len(State.USER_PREFIX):]] = value
+        elif not key.startswith(State.TEMP_PREFIX):
+            session_state[key] = value
+    return app_state, user_state, session_state
+
+
+def _event_line(event):
+    """One-line rendering of an event for the compacted snapshot."""
+    pieces = []
+    if event.content and event.content.parts:
+        for part in event.content.parts:
+            if part.text:
+                pieces.append(part.text.strip())
+            elif part.function_call:
+                pieces.append(f"[called {part.function_call.name}]")
+            elif part.function_response:
+                pieces.append(f"[{part.function_response.name} returned]")
+    text = " ".join(piece for piece in pieces if piece)
+    if not text:
+        return None
+    return f"{event.author}: {text[:SNAPSHOT_LINE_CHARS]}"
+
+
+class SqliteSessionService(BaseSessionService):
+    """ADK session service persisting sessions to SQLite.
+
+    Events are appended to a log table instead of living in memory. get_session
+    only loads the newest events (or what GetSessionConfig asks for); older
+    turns are periodically compacted into a per-session snapshot, which is
+    handed to the runner as a single leading event. Sessions idle for longer
+    than the TTL are deleted.
+    """
+
+    def __init__(self, db_path=SESSION_DB_PATH, ttl_seconds=SESSION_TTL_SECONDS,
+                 recent_events=DEFAULT_RECENT_EVENTS):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.recent_events = recent_events
+        self._local = threading.local()
+        self._last_eviction = 0.0
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        # sqlite3 connections can't be shared across threads; keep one per thread.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # --- State Helpers ---
+    def _load_shared_state(self, conn, app_name, user_id):
+        merged = {}
+        row = conn.execute("SELECT state FROM app_states WHERE app_name = ?", (app_name,)).fetchone()
+        for key, value in json.loads(row[0] if row else "{}").items():
+            merged[State.APP_PREFIX + key] = value
+        row = conn.execute(
+            "SELECT state FROM user_states WHERE app_name = ? AND user_id = ?", (app_name, user_id)
+        ).fetchone()
+        for key, value in json.loads(row[0] if row else "{}").items():
+            merged[State.USER_PREFIX + key] = value
+        return merged
+
+    def _merge_shared_state(self, conn, app_name, user_id, app_delta, user_delta):
+        if app_delta:
+            row = conn.execute("SELECT state FROM app_states WHERE app_name = ?", (app_name,)).fetchone()
+            state = json.loads(row[0]) if row else {}
+            state.update(app_delta)
+            conn.execute("INSERT OR REPLACE INTO app_states (app_name, state) VALUES (?, ?)",
+                         (app_name, json.dumps(state)))
+        if user_delta:
+            row = conn.execute(
+                "SELECT state FROM user_states WHERE app_name = ? AND user_id = ?", (app_name, user_id)
+            ).fetchone()
+            state = json.loads(row[0]) if row else {}
+            state.update(user_delta)
+            conn.execute("INSERT OR REPLACE INTO user_states (app_name, user_id, state) VALUES (?, ?, ?)",
+                         (app_name, user_id, json.dumps(state)))
+    # --- End State Helpers ---
+
+    def create_session(self, *, app_name, user_id, state=None, session_id=None):
+        user_id = str(user_id)
+        session_id = str(session_id) if session_id is not None else str(uuid.uuid4())
+        app_delta, user_delta, session_state = _split_state(state)
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT INTO sessions (app_name, user_id, id, state, create_time, update_time) VALUES (?, ?, ?, ?, ?, ?)",
+                (app_name, user_id, session_id, json.dumps(session_state), now, now),
+            )
+            self._merge_shared_state(conn, app_name, user_id, app_delta, user_delta)
+            merged_state = {**session_state, **self._load_shared_state(conn, app_name, user_id)}
+        self.evict_expired()
+        return Session(app_name=app_name, user_id=user_id, id=session_id, state=merged_state,
+                       events=[], last_update_time=now)
+
+    def get_session(self, *, app_name, user_id, session_id, config: GetSessionConfig = None):
+        user_id = str(user_id)
+        session_id = str(session_id)
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT state, update_time FROM sessions WHERE app_name = ? AND user_id = ? AND id = ?",
+            (app_name, user_id, session_id),
+        ).fetchone()
+        if not row:
+            return None
+        if self.ttl_seconds and time.time() - row[1] > self.ttl_seconds:
+            self.delete_session(app_name=app_name, user_id=user_id, session_id=session_id)
+            return None
+
+        limit = self.recent_events
+        after_timestamp = None
+        if config:
+            if config.num_recent_events is not None:
+                limit = config.num_recent_events
+            after_timestamp = config.after_timestamp
+
+        query = "SELECT data FROM events WHERE app_name = ? AND user_id = ? AND session_id = ?"
+        params = [app_name, user_id, session_id]
+        if after_timestamp:
+            query += " AND timestamp >= ?"
+            params.append(after_timestamp)
+        query += " ORDER BY seq DESC LIMIT ?"
+        params.append(limit if limit is not None else -1)
+        rows = conn.execute(query, params).fetchall()
+        events = [Event.model_validate_json(data) for (data,) in reversed(rows)]
+
+        snapshot = self._snapshot_event(conn, app_name, user_id, session_id)
+        if snapshot and not after_timestamp:
+            events.insert(0, snapshot)
+
+        state = {**json.loads(row[0]), **self._load_shared_state(conn, app_name, user_id)}
+        return Session(app_name=app_name, user_id=user_id, id=session_id, state=state,
+                       events=events, last_update_time=row[1])
+
+    def _snapshot_event(self, conn, app_name, user_id, session_id):
+        row = conn.execute(
+            "SELECT compacted_events, lines FROM snapshots WHERE app_name = ? AND user_id = ? AND session_id = ?",
+            (app_name, user_id, session_id),
+        ).fetchone()
+        if not row:
+            return None
+        text = f"Summary of the {row[0]} earlier events in this conversation:\n" + "\n".join(json.loads(row[1]))
+        return Event(author=SNAPSHOT_AUTHOR, invocation_id="snapshot",
+                     content=types.Content(role="user", parts=[types.Part(text=text)]))
+
+    def list_sessions(self, *, app_name, user_id):
+        user_id = str(user_id)
+        rows = self._connect().execute(
+            "SELECT id, update_time FROM sessions WHERE app_name = ? AND user_id = ? ORDER BY update_time DESC",
+            (app_name, user_id),
+        ).fetchall()
+        sessions = [
+            Session(app_name=app_name, user_id=user_id, id=session_id, state={}, events=[], last_update_time=update_time)
+            for session_id, update_time in rows
+        ]
+        return ListSessionsResponse(sessions=sessions)
+
+    def delete_session(self, *, app_name, user_id, session_id):
+        user_id = str(user_id)
+        session_id = str(session_id)
+        conn = self._connect()
+        with conn:
+            for table, column in (("events", "session_id"), ("snapshots", "session_id"), ("sessions", "id")):
+                conn.execute(f"DELETE FROM {table} WHERE app_name = ? AND user_id = ? AND {column} = ?",
+                             (app_name, user_id, session_id))
+
+    def iter_events(self, *, app_name, user_id, session_id, page_size=EVENTS_PAGE_SIZE):
+        """Yields every stored (non-compacted) event of a session, one page at a time."""
+        user_id = str(user_id)
+        session_id = str(session_id)
+        last_seq = -1
+        while True:
+            rows = self._connect().execute(
+                "SELECT seq, data FROM events WHERE app_name = ? AND user_id = ? AND session_id = ? AND seq > ? "
+                "ORDER BY seq LIMIT ?",
+                (app_name, user_id, session_id, last_seq, page_size),
+            ).fetchall()
+            for seq, data in rows:
+                last_seq = seq
+                yield Event.model_validate_json(data)
+            if len(rows) < page_size:
+                return
+
+    def list_events(self, *, app_name, user_id, session_id):
+        return ListEventsResponse(events=list(self.iter_events(app_name=app_name, user_id=user_id, session_id=session_id)))
+
+    def append_event(self, session, event):
+        if event.partial:
+            return event
+        # Updates the in-memory session (state delta + events list) the runner holds.
+        super().append_event(session=session, event=event)
+        # Keep the runner's copy as small as what get_session would load.
+        if self.recent_events and len(session.events) > self.recent_events * 2:
+            del session.events[:-self.recent_events]
+
+        app_delta, user_delta, session_delta = ({}, {}, {})
+        if event.actions and event.actions.state_delta:
+            app_delta, user_delta, session_delta = _split_state(event.actions.state_delta)
+
+        conn = self._connect()
+        with conn:
+            # Take the write lock before reading seq, so concurrent appends to
+            # one session (other threads or processes) can't pick the same one.
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT state FROM sessions WHERE app_name = ? AND user_id = ? AND id = ?",
+                (session.app_name, session.user_id, session.id),
+            ).fetchone()
+            if not row:
+                raise ValueError(f"Session {session.id} not found.")
+            stored_state = json.loads(row[0])
+            stored_state.update(session_delta)
+            live_events, next_seq = conn.execute(
+                "SELECT COUNT(*), COALESCE(MAX(seq), -1) + 1 FROM events "
+                "WHERE app_name = ? AND user_id = ? AND session_id = ?",
+                (session.app_name, session.user_id, session.id),
+            ).fetchone()
+            conn.execute(
+                "INSERT INTO events (app_name, user_id, session_id, seq, timestamp, data) VALUES (?, ?, ?, ?, ?, ?)",
+                (session.app_name, session.user_id, session.id, next_seq, event.timestamp,
+                 event.model_dump_json(exclude_none=True)),
+            )
+            conn.execute(
+                "UPDATE sessions SET state = ?, update_time = ? WHERE app_name = ? AND user_id = ? AND id = ?",
+                (json.dumps(stored_state), event.timestamp, session.app_name, session.user_id, session.id),
+            )
+            self._merge_shared_state(conn, session.app_name, session.user_id, app_delta, user_delta)
+        session.last_update_time = event.timestamp
+
+        # seq keeps counting past compactions; the threshold is on the events still in the log.
+        if live_events + 1 >= COMPACT_THRESHOLD:
+            self.compact(app_name=session.app_name, user_id=session.user_id, session_id=session.id)
+        return event
+
+    def compact(self, *, app_name, user_id, session_id, keep_recent=COMPACT_KEEP_RECENT):
+        """Folds all but the newest keep_recent events into the session snapshot."""
+        conn = self._connect()
+        with conn:
+            # Locked from the read on, so two workers can't fold the same events twice.
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT seq, data FROM events WHERE app_name = ? AND user_id = ? AND session_id = ? "
+                "ORDER BY seq DESC LIMIT -1 OFFSET ?",
+                (app_name, user_id, session_id, keep_recent),
+            ).fetchall()
+            if not rows:
+                return 0
+            rows.reverse()
+            snapshot = conn.execute(
+                "SELECT compacted_events, lines FROM snapshots WHERE app_name = ? AND user_id = ? AND session_id = ?",
+                (app_name, user_id, session_id),
+            ).fetchone()
+            compacted, lines = (snapshot[0], json.loads(snapshot[1])) if snapshot else (0, [])
+            for _, data in rows:
+                line = _event_line(Event.model_validate_json(data))
+                if line:
+                    lines.append(line)
+            lines = lines[-SNAPSHOT_MAX_LINES:]
+            conn.execute(
+                "INSERT OR REPLACE INTO snapshots (app_name, user_id, session_id, compacted_events, lines) VALUES (?, ?, ?, ?, ?)",
+                (app_name, user_id, session_id, compacted + len(rows), json.dumps(lines)),
+            )
+            conn.execute(
+                "DELETE FROM events WHERE app_name = ? AND user_id = ? AND session_id = ? AND seq <= ?",
+                (app_name, user_id, session_id, rows[-1][0]),
+            )
+        return len(rows)
+
+    def evict_expired(self, force=False):
+        """Deletes sessions idle for longer than the TTL (at most every EVICT_INTERVAL_SECONDS)."""
+        now = time.time()
+        if not self.ttl_seconds or (not force and now - self._last_eviction < EVICT_INTERVAL_SECONDS):
+            return 0
+        self._last_eviction = now
+        conn = self._connect()
+        with conn:
+            expired = conn.execute(
+                "SELECT app_name, user_id, id FROM sessions WHERE update_time < ?", (now - self.ttl_seconds,)
+            ).fetchall()
+            for app_name, user_id, session_id in expired:
+                for table, column in (("events", "session_id"), ("snapshots", "session_id"), ("sessions", "id")):
+                    conn.execute(f"DELETE FROM {table} WHERE app_name = ? AND user_id = ? AND {column} = ?",
+                                 (app_name, user_id, session_id))
+        return len(expired)
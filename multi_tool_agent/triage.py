@@ -0,0 +1,278 @@
+import atexit
+import functools
+import itertools
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parseaddr
+
+from .atomic_files import atomic_write_json
+
+# --- Triage Configuration ---
+# A small online logistic regression over sparse features: who sent the
+# message, how often the user engages with/replies to that sender, its labels,
+# whether the user has replied in the thread, and subject keywords. It learns
+# from what the user does (opens, summarizes, replies, stars, trashes,
+# ignores) and costs a handful of dict lookups per message to score.
+TRIAGE_MODEL_PATH = os.environ.get("GMAIL_AGENT_TRIAGE_MODEL", "triage_model.json")
+LEARNING_RATE = 0.2
+SAVE_EVERY_UPDATES = 25
+MAX_SUBJECT_KEYWORDS = 12
+MAX_TRACKED_THREADS = 5000
+MAX_TRACKED_MESSAGES = 2000
+# Every new sender, domain and subject word adds a weight (and every sender a
+# statistics entry), so both are capped: the ones learned from least recently
+# are dropped first. The prior weights are never dropped.
+MAX_LEARNED_WEIGHTS = 20000
+MAX_TRACKED_SENDERS = 5000
+# Shown messages the user hasn't acted on after this long count as ignored.
+IGNORE_AFTER_SECONDS = 600
+
+# action -> (target, sample weight)
+ACTION_TARGETS = {
+    "replied": (1.0, 1.0),
+    "starred": (1.0, 1.0),
+    "summarized": (1.0, 0.6),
+    "opened": (1.0, 0.3),
+    "ignored": (0.0, 0.2),
+    "trashed": (0.0, 1.0),
+}
+ENGAGED_ACTIONS = {"replied", "starred", "summarized", "opened"}
+
+# Starting weights so a fresh model is already sensible; learning adjusts them.
+PRIOR_WEIGHTS = {
+    "label:IMPORTANT": 1.0,
+    "label:STARRED": 1.5,
+    "label:CATEGORY_PERSONAL": 0.5,
+    "label:CATEGORY_PROMOTIONS": -1.5,
+    "label:CATEGORY_SOCIAL": -0.8,
+    "label:CATEGORY_UPDATES": -0.5,
+    "label:CATEGORY_FORUMS": -0.5,
+    "thread_participated": 1.5,
+    "sender_reply_rate": 2.0,
+    "sender_engagement": 1.0,
+    "noreply_sender": -1.5,
+    "kw:urgent": 1.0,
+    "kw:asap": 1.0,
+    "kw:action": 0.5,
+    "kw:deadline": 0.8,
+    "kw:re": 0.4,
+    "kw:newsletter": -1.0,
+    "kw:receipt": -0.8,
+    "kw:unsubscribe": -1.0,
+    "kw:sale": -0.8,
+    "kw:offer": -0.6,
+    "kw:digest": -0.6,
+}
+_SUBJECT_SEPARATORS = str.maketrans({c: " " for c in "!\"#$%&'()*+,./:;<=>?@[\\]^_`{|}~-"})
+# --- End Triage Configuration ---
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_sender(from_header):
+    return (parseaddr(from_header)[1] or from_header).lower()
+
+
+def _sender_address(email):
+    if email.get("sender_email"):
+        return email["sender_email"].lower()
+    return _parse_sender(email.get("from", ""))
+
+
+class TriageScorer:
+    """Scores messages by how likely the user is to act on them (0-1)."""
+
+    def __init__(self, path=TRIAGE_MODEL_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.weights = OrderedDict(PRIOR_WEIGHTS)  # Least recently learned from first
+        self.senders = OrderedDict()  # address -> [seen, engaged, replied], least recently seen first
+        self.threads = OrderedDict()  # thread IDs the user replied in
+        self._messages = OrderedDict()  # message ID -> email dict, to learn from ID-only actions
+        self._impressions = OrderedDict()  # message ID -> time shown
+        self._unsaved_updates = 0
+        self._load()
+
+    # --- Persistence ---
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as model_file:
+                saved = json.load(model_file)
+        except (OSError, ValueError) as e:
+            print(f"Error loading triage model {self.path}, starting fresh: {e}")
+            return
+        self.weights.update(saved.get("weights", {}))
+        self.senders = OrderedDict(saved.get("senders", {}))
+        self.threads = OrderedDict.fromkeys(saved.get("threads", []))
+        self._prune_locked()
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            state = {"weights": self.weights, "senders": self.senders, "threads": list(self.threads)}
+            self._unsaved_updates = 0
+            atomic_write_json(self.path, state)  # A crash never leaves a torn model
+    # --- End Persistence ---
+
+    def features(self, email):
+        """Returns the (name, value) features of a listing or details dict."""
+        sender = _sender_address(email)
+        seen, engaged, replied = self.senders.get(sender, (0, 0, 0))
+        features = [
+            ("bias", 1.0),
+            (f"sender:{sender}", 1.0),
+            (f"domain:{sender.rpartition('@')[2]}", 1.0),
+            ("sender_reply_rate", min(replied / (seen + 1), 1.0)),
+            ("sender_engagement", min(engaged / (seen + 1), 1.0)),
+        ]
+        if not seen:
+            features.append(("new_sender", 1.0))
+        if "noreply" in sender or "no-reply" in sender:
+            features.append(("noreply_sender", 1.0))
+        for label in email.get("labels") or ():
+            features.append((f"label:{label}", 1.0))
+        if (email.get("threadId") or email.get("thread_id")) in self.threads:
+            features.append(("thread_participated", 1.0))
+        words = email.get("subject", "").lower().translate(_SUBJECT_SEPARATORS).split()
+        features.extend((f"kw:{word}", 1.0) for word in dict.fromkeys(words[:MAX_SUBJECT_KEYWORDS]))
+        return features
+
+    def score(self, email):
+        weights = self.weights
+        z = sum(weights.get(name, 0.0) * value for name, value in self.features(email))
+        return 1.0 / (1.0 + math.exp(-max(min(z, 30.0), -30.0)))
+
+    def rank(self, emails, record_impressions=True):
+        """Returns emails sorted by priority (highest first), each with a 'priority' score.
+
+        emails are expected newest first (Gmail's listing order); each result
+        also gets its position there as 'recency' (0 = newest), and ties keep
+        that order. When record_impressions is set, the messages count as
+        shown to the user: if none of them is acted on, they are learned from
+        as ignored.
+        """
+        scored = [dict(email, priority=round(self.score(email), 3), recency=position)
+                  for position, email in enumerate(emails)]
+        scored.sort(key=lambda email: -email["priority"])
+        if record_impressions:
+            self.record_impressions(scored)
+        return scored
+
+    def _sender_counts_locked(self, email):
+        sender = _sender_address(email)
+        counts = self.senders.get(sender)
+        if counts is None:
+            counts = self.senders[sender] = [0, 0, 0]
+        else:
+            self.senders.move_to_end(sender)
+        return counts
+
+    def _prune_locked(self):
+        while len(self.senders) > MAX_TRACKED_SENDERS:
+            self.senders.popitem(last=False)
+        excess = len(self.weights) - len(PRIOR_WEIGHTS) - MAX_LEARNED_WEIGHTS
+        if excess > 0:
+            # Prior weights are never moved to the end, so they stay at the front.
+            learned = (name for name in self.weights if name not in PRIOR_WEIGHTS)
+            for name in list(itertools.islice(learned, excess)):
+                del self.weights[name]
+
+    def _remember(self, email):
+        message_id = email.get("id")
+        if message_id:
+            self._messages[message_id] = email
+            self._messages.move_to_end(message_id)
+            while len(self._messages) > MAX_TRACKED_MESSAGES:
+                self._messages.popitem(last=False)
+
+    def record_impressions(self, emails):
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for email in emails:
+                self._remember(email)
+                if email.get("id") and email["id"] not in self._impressions:
+                    self._impressions[email["id"]] = now
+                    self._sender_counts_locked(email)[0] += 1
+            self._prune_locked()
+            while self._impressions:
+                message_id, shown_at = next(iter(self._impressions.items()))
+                if now - shown_at < IGNORE_AFTER_SECONDS:
+                    break
+                del self._impressions[message_id]
+                expired.append(message_id)
+        for message_id in expired:
+            self.record_action(message_id, "ignored")
+
+    def record_action(self, email_or_id, action):
+        """Learns from one user action on a message (see ACTION_TARGETS).
+
+        Args:
+            email_or_id: A listing/details dict, or the ID of a message that
+                was recently scored.
+            action: 'replied', 'starred', 'summarized', 'opened', 'ignored'
+                or 'trashed'.
+        """
+        target, sample_weight = ACTION_TARGETS[action]
+        with self._lock:
+            email = email_or_id if isinstance(email_or_id, dict) else self._messages.get(email_or_id)
+            if not email:
+                return
+            self._remember(email)
+            if action != "ignored":
+                self._impressions.pop(email.get("id"), None)
+            # SGD step on the log loss
+            features = self.features(email)
+            z = sum(self.weights.get(name, 0.0) * value for name, value in features)
+            error = target - 1.0 / (1.0 + math.exp(-max(min(z, 30.0), -30.0)))
+            step = LEARNING_RATE * sample_weight * error
+            for name, value in features:
+                self.weights[name] = self.weights.get(name, 0.0) + step * value
+                if name not in PRIOR_WEIGHTS:
+                    self.weights.move_to_end(name)
+            counts = self._sender_counts_locked(email)
+            if action in ENGAGED_ACTIONS:
+                counts[1] += 1
+            if action == "replied":
+                counts[2] += 1
+                thread_id = email.get("threadId") or email.get("thread_id")
+                if thread_id:
+                    self.threads[thread_id] = None
+                    while len(self.threads) > MAX_TRACKED_THREADS:
+                        self.threads.popitem(last=False)
+            self._prune_locked()
+            self._unsaved_updates += 1
+            should_save = self._unsaved_updates >= SAVE_EVERY_UPDATES
+        if should_save:
+            self.save()
+
+    def learn_from_mail_event(self, event):
+        """Mail watcher hook: learns from label changes the user made in Gmail itself."""
+        added = set(getattr(event, "added", ()))
+        removed = set(getattr(event, "removed", ()))
+        if "TRASH" in added:
+            self.record_action(event.message_id, "trashed")
+        elif added & {"STARRED", "IMPORTANT"}:
+            self.record_action(event.message_id, "starred")
+        elif "UNREAD" in removed:
+            self.record_action(event.message_id, "opened")
+
+
+_scorer = None
+_scorer_lock = threading.Lock()
+
+
+def get_triage_scorer():
+    """Returns the process-wide TriageScorer (saved on exit)."""
+    global _scorer
+    with _scorer_lock:
+        if _scorer is None:
+            _scorer = TriageScorer()
+            atexit.register(_scorer.save)
+        return _scorer
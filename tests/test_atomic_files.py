@@ -0,0 +1,42 @@
+import json
+import os
+
+import pytest
+
+from multi_tool_agent import atomic_files
+from multi_tool_agent.atomic_files import atomic_write_json, atomic_write_text
+
+
+def test_writes_json_creating_the_directory(tmp_path):
+    path = tmp_path / "state" / "model.json"
+    atomic_write_json(str(path), {"weights": {"bias": 1.0}})
+    assert json.loads(path.read_text()) == {"weights": {"bias": 1.0}}
+
+
+def test_writes_json_lines(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    atomic_write_json(str(path), ({"id": i} for i in range(3)), lines=True)
+    assert [json.loads(line) for line in path.read_text().splitlines()] == [{"id": 0}, {"id": 1}, {"id": 2}]
+
+
+def test_replaces_existing_contents(tmp_path):
+    path = tmp_path / "token.json"
+    atomic_write_text(str(path), "old")
+    atomic_write_text(str(path), "new")
+    assert path.read_text() == "new"
+    assert os.listdir(tmp_path) == ["token.json"]
+
+
+def test_failed_write_keeps_the_old_file_and_no_temp_file(tmp_path, monkeypatch):
+    path = tmp_path / "checkpoint.json"
+    atomic_write_json(str(path), {"version": 1})
+
+    def failing_replace(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(atomic_files.os, "replace", failing_replace)
+    with pytest.raises(OSError):
+        atomic_write_json(str(path), {"version": 2})
+
+    assert json.loads(path.read_text()) == {"version": 1}
+    assert os.listdir(tmp_path) == ["checkpoint.json"]
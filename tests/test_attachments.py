@@ -0,0 +1,182 @@
+import base64
+import io
+import json
+import os
+import random
+import time
+from types import SimpleNamespace
+
+import pytest
+from googleapiclient.errors import HttpError
+
+from multi_tool_agent import attachments
+from multi_tool_agent.attachments import _Base64SpoolWriter, download_attachment
+from multi_tool_agent.projection import wire_meter
+from multi_tool_agent.resilience import (
+    STATE_CLOSED,
+    STATE_OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    DeadlineExceededError,
+)
+from multi_tool_agent.service_pool import QuotaTracker
+
+
+def response_body(payload, padded=True, spacing=""):
+    data = base64.urlsafe_b64encode(payload).decode("ascii")
+    if not padded:
+        data = data.rstrip("=")
+    return ('{"size": %d,%s"data"%s:%s"%s"}' % (len(payload), spacing, spacing, spacing, data)).encode("ascii")
+
+
+def stream(body, chunk_size):
+    spool = io.BytesIO()
+    writer = _Base64SpoolWriter(spool)
+    for start in range(0, len(body), chunk_size):
+        writer.feed(body[start:start + chunk_size])
+    writer.close()
+    return spool.getvalue()
+
+
+@pytest.mark.parametrize("length", [0, 1, 2, 3, 4, 5, 255, 1000])
+@pytest.mark.parametrize("padded", [True, False])
+def test_decodes_across_every_chunk_boundary(length, padded):
+    # Random bytes exercise the url-safe '-' and '_' characters too.
+    payload = random.Random(length).randbytes(length)
+    body = response_body(payload, padded=padded)
+    for chunk_size in range(1, 14):
+        assert stream(body, chunk_size) == payload, chunk_size
+
+
+def test_handles_whitespace_around_the_data_key():
+    payload = b"hello attachment"
+    assert stream(response_body(payload, spacing=" \n "), 3) == payload
+
+
+def test_finds_the_data_field_after_a_long_prefix():
+    payload = b"report contents"
+    body = json.dumps({"attachmentId": "x" * 500, "size": len(payload),
+                       "data": base64.urlsafe_b64encode(payload).decode("ascii")}).encode("ascii")
+    assert stream(body, 7) == payload
+
+
+def test_close_raises_when_the_data_field_is_cut_off():
+    body = response_body(b"truncated payload")
+    writer = _Base64SpoolWriter(io.BytesIO())
+    writer.feed(body[:-5])
+    with pytest.raises(ValueError):
+        writer.close()
+
+
+def test_close_raises_when_there_is_no_data_field():
+    writer = _Base64SpoolWriter(io.BytesIO())
+    writer.feed(b'{"size": 0}')
+    with pytest.raises(ValueError):
+        writer.close()
+
+
+class FakeResponse:
+    def __init__(self, status_code, body, delay=0.0):
+        self.status_code = status_code
+        self.content = body
+        self._body = body
+        self._delay = delay
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self._body), 7):
+            time.sleep(self._delay)
+            yield self._body[start:start + 7]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+@pytest.fixture
+def gmail_download(monkeypatch):
+    """Streams attachments.get from a fake session; returns the knobs and what was requested."""
+    fake = SimpleNamespace(status_code=200, body=response_body(b"quarterly numbers"), delay=0.0, requests=[],
+                           quota=QuotaTracker(),
+                           breaker=CircuitBreaker("Test attachments", 1.0, failure_threshold=2, reset_seconds=60))
+
+    class FakeSession:
+        def __init__(self, credentials):
+            pass
+
+        def get(self, url, **kwargs):
+            fake.requests.append(url)
+            return FakeResponse(fake.status_code, fake.body, fake.delay)
+
+    monkeypatch.setattr(attachments, "AuthorizedSession", FakeSession)
+    monkeypatch.setattr(attachments, "get_account_credentials", lambda user_id: None)
+    monkeypatch.setattr(attachments, "get_service_pool", lambda: SimpleNamespace(quota=fake.quota))
+    monkeypatch.setattr(attachments, "attachment_breaker", fake.breaker)
+    monkeypatch.setattr(attachments, "gmail_breaker", SimpleNamespace(state=STATE_CLOSED))
+    return fake
+
+
+ATTACHMENT = {"attachment_id": "att-1", "filename": "report.txt", "mime_type": "text/plain"}
+
+
+def spool_files():
+    return {name for name in os.listdir(attachments.SPOOL_DIR or attachments.tempfile.gettempdir())
+            if name.startswith("gmail-attachment-")}
+
+
+def test_streamed_download_is_charged_metered_and_decoded(gmail_download):
+    with wire_meter.turn() as tally:
+        path = download_attachment("me", "msg-1", ATTACHMENT)
+    try:
+        with open(path, "rb") as spool:
+            assert spool.read() == b"quarterly numbers"
+    finally:
+        os.unlink(path)
+
+    assert gmail_download.quota.usage("me") == {"gmail.users.messages.attachments.get": 5}
+    assert tally.totals()["gmail.users.messages.attachments.get"]["bytes_received"] == len(gmail_download.body)
+
+
+def test_a_missing_attachment_is_an_api_error_not_an_outage(gmail_download):
+    gmail_download.status_code = 404
+    before = spool_files()
+
+    for _ in range(3):
+        with pytest.raises(HttpError):
+            download_attachment("me", "msg-1", ATTACHMENT)
+
+    assert gmail_download.breaker.state == STATE_CLOSED
+    assert spool_files() == before
+
+
+def test_server_errors_open_the_download_breaker(gmail_download):
+    gmail_download.status_code = 503
+    for _ in range(2):
+        with pytest.raises(HttpError):
+            download_attachment("me", "msg-1", ATTACHMENT)
+
+    with pytest.raises(CircuitOpenError):
+        download_attachment("me", "msg-1", ATTACHMENT)
+    assert len(gmail_download.requests) == 2
+
+
+def test_a_slow_download_hits_the_deadline(gmail_download):
+    gmail_download.breaker.deadline_seconds = 0.05
+    gmail_download.delay = 0.02
+    before = spool_files()
+
+    with pytest.raises(DeadlineExceededError):
+        download_attachment("me", "msg-1", ATTACHMENT)
+
+    assert spool_files() == before
+
+
+def test_downloads_fail_fast_while_gmail_is_down(gmail_download, monkeypatch):
+    monkeypatch.setattr(attachments, "gmail_breaker", SimpleNamespace(state=STATE_OPEN))
+
+    with pytest.raises(CircuitOpenError):
+        download_attachment("me", "msg-1", ATTACHMENT)
+
+    assert gmail_download.requests == []
+    assert gmail_download.quota.usage("me") == {}
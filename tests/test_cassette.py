@@ -0,0 +1,154 @@
+import json
+import time
+
+import httplib2
+import pytest
+
+from multi_tool_agent import cassette
+from multi_tool_agent.cassette import (
+    MODE_RECORD,
+    MODE_REPLAY,
+    SCRUBBED,
+    Cassette,
+    RecordingHttp,
+    ReplayHttp,
+    scrub_headers,
+    scrub_text,
+    scrub_uri,
+)
+
+
+def test_scrub_uri_hides_secret_query_parameters():
+    uri = scrub_uri("https://gmail.googleapis.com/gmail/v1/users/me/messages?q=from%3Aboss&key=AIza123&access_token=ya29")
+
+    assert "AIza123" not in uri and "ya29" not in uri
+    assert "q=from%3Aboss" in uri
+    assert uri.count("%3Cscrubbed%3E") == 2
+
+
+def test_scrub_headers_hides_credentials_in_any_case():
+    headers = scrub_headers({"Authorization": "Bearer ya29", "X-Goog-Api-Key": "AIza123", "content-type": "text/plain"})
+
+    assert headers == {"Authorization": SCRUBBED, "X-Goog-Api-Key": SCRUBBED, "content-type": "text/plain"}
+    assert scrub_headers(None) == {}
+
+
+def test_scrub_text_hides_tokens_in_json():
+    text = json.dumps({"access_token": "ya29", "refresh_token": "1//abc", "expires_in": 3599, "user": "me"})
+
+    scrubbed = json.loads(scrub_text(text))
+
+    assert scrubbed == {"access_token": SCRUBBED, "refresh_token": SCRUBBED, "expires_in": 3599, "user": "me"}
+
+
+class FakeHttp:
+    def __init__(self, content):
+        self.content = content
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        return httplib2.Response({"status": 200, "set-cookie": "session=secret"}), self.content
+
+
+def record(path, *interactions):
+    recording = Cassette(str(path), MODE_RECORD)
+    for uri, method, body, headers, content in interactions:
+        RecordingHttp(FakeHttp(content), recording).request(uri, method, body, headers)
+    recording.close()
+
+
+def test_recorded_gmail_traffic_is_scrubbed_and_replayed(tmp_path):
+    path = tmp_path / "session.jsonl.gz"
+    uri = "https://gmail.googleapis.com/gmail/v1/users/me/profile?key=AIza123"
+    record(path,
+           (uri, "GET", None, {"Authorization": "Bearer ya29"}, b'{"emailAddress": "me@example.com"}'),
+           ("https://oauth2.googleapis.com/token", "POST", "grant_type=refresh_token", {},
+            b'{"access_token": "ya29.new"}'),
+           (uri, "GET", None, {}, b"\x89PNG\x00\xff"))  # Binary content is kept as base64
+
+    raw = path.read_bytes()
+    assert b"AIza123" not in raw and b"ya29" not in raw and b"secret" not in raw
+
+    replay = ReplayHttp(Cassette(str(path), MODE_REPLAY, speed="fast"))
+    response, content = replay.request(uri.replace("AIza123", "other-key"), "GET")
+    assert response.status == 200 and json.loads(content) == {"emailAddress": "me@example.com"}
+    assert replay.request(uri, "GET")[1] == b"\x89PNG\x00\xff"  # Same request: the next recording
+    with pytest.raises(LookupError):
+        replay.request(uri, "GET")
+
+
+def batch_body(base):
+    return (f"--batch\r\nContent-Type: application/http\r\nContent-ID: <{base}+1>\r\n\r\n"
+            f"GET /gmail/v1/users/me/messages/m1\r\n--batch--")
+
+
+def batch_response(base):
+    return (f"--batch\r\nContent-Type: application/http\r\nContent-ID: <response-{base}+1>\r\n\r\n"
+            f"HTTP/1.1 200 OK\r\n\r\n{{\"id\": \"m1\"}}\r\n--batch--").encode()
+
+
+def test_replayed_batch_responses_carry_the_current_content_id(tmp_path):
+    path = tmp_path / "batch.jsonl.gz"
+    uri = "https://gmail.googleapis.com/batch/gmail/v1"
+    headers = {"content-type": 'multipart/mixed; boundary="batch"'}
+    record(path, (uri, "POST", batch_body("recorded-base"), headers, batch_response("recorded-base")))
+
+    replay = ReplayHttp(Cassette(str(path), MODE_REPLAY, speed="fast"))
+    _, content = replay.request(uri, "POST", batch_body("current-base"), headers)
+
+    assert b"<response-current-base+1>" in content
+    assert b"recorded-base" not in content
+
+
+def gemini_cassette(tmp_path, speed="fast"):
+    path = tmp_path / "gemini.jsonl.gz"
+    recording = Cassette(str(path), MODE_RECORD)
+    for index, key in enumerate(["k1", "k2", "k3"]):
+        recording.record("gemini", {"key": key}, {"text": f"answer {key}"}, recording._started + index * 0.1, 0.05)
+    recording.close()
+    return Cassette(str(path), MODE_REPLAY, speed=speed)
+
+
+def test_gemini_calls_match_by_prompt_and_fall_back_to_recorded_order(tmp_path):
+    replay = gemini_cassette(tmp_path)
+
+    assert replay.take_gemini("k2")["response"]["text"] == "answer k2"
+    # A prompt that doesn't hash the same (e.g. it embeds the time) takes the next unused call.
+    assert replay.take_gemini("changed prompt")["response"]["text"] == "answer k1"
+    assert replay.take_gemini("k3")["response"]["text"] == "answer k3"
+    with pytest.raises(LookupError):
+        replay.take_gemini("k1")
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(cassette.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def test_recorded_speed_replays_each_call_duration_only(tmp_path, sleeps):
+    replay = gemini_cassette(tmp_path, speed="recorded")
+
+    for key in ["k1", "k2", "k3"]:
+        replay.take_gemini(key)
+
+    assert sleeps == [0.05, 0.05, 0.05]
+
+
+def test_timeline_speed_also_holds_calls_until_their_recorded_offset(tmp_path, sleeps):
+    replay = gemini_cassette(tmp_path, speed="timeline")
+    replay._started = time.monotonic()
+
+    replay.take_gemini("k1")
+    replay.take_gemini("k3")  # Recorded 0.2s into the session
+
+    assert sleeps[0] == 0.05
+    assert 0.15 < sleeps[1] <= 0.2 and sleeps[2] == 0.05
+
+
+def test_fast_speed_never_sleeps(tmp_path, sleeps):
+    replay = gemini_cassette(tmp_path)
+
+    replay.take_gemini("k1")
+
+    assert sleeps == []
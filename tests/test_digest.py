@@ -0,0 +1,80 @@
+import time
+from contextlib import nullcontext
+
+import pytest
+
+import digest
+from digest import DigestCheckpoint, run_digest
+
+IDS = [f"m{i}" for i in range(7)]
+
+
+@pytest.fixture
+def checkpoint(tmp_path, monkeypatch):
+    checkpoint = DigestCheckpoint(str(tmp_path / "checkpoint.json"), "label:inbox", "me")
+    checkpoint.add_page(IDS, None)
+    monkeypatch.setattr(digest, "summarize_text_with_gemini",
+                        lambda title, body: {"status": "success", "summary": f"about {title}"})
+    return checkpoint
+
+
+@pytest.fixture
+def ingest_calls(monkeypatch):
+    calls = []
+
+    def ingest_messages(service, user_id, message_ids, sink, batch_size, pool, stop):
+        calls.append(list(message_ids))
+        for start in range(0, len(message_ids), batch_size):
+            if stop():
+                break
+            for msg_id in message_ids[start:start + batch_size]:
+                sink.write({"id": msg_id, "subject": f"subject {msg_id}", "body": "text"})
+
+    monkeypatch.setattr(digest, "create_parse_pool", lambda workers: nullcontext("pool"))
+    monkeypatch.setattr(digest, "ingest_messages", ingest_messages)
+    return calls
+
+
+def test_streams_every_message_through_one_ingest_call(checkpoint, ingest_calls):
+    complete = run_digest(None, "me", checkpoint, batch_size=3, concurrency=2, deadline=None,
+                          by_priority=False, parse_workers=2)
+
+    assert complete
+    assert ingest_calls == [IDS]
+    assert checkpoint.summarized_ids() == set(IDS)
+    assert checkpoint.state["messages"]["m4"]["summary"] == "about subject m4"
+
+
+def test_resumes_with_only_the_messages_left(checkpoint, ingest_calls):
+    checkpoint.record_message("m0", {"id": "m0", "summary": "done"})
+
+    run_digest(None, "me", checkpoint, batch_size=3, concurrency=2, deadline=None,
+               by_priority=False, parse_workers=2)
+
+    assert ingest_calls == [IDS[1:]]
+    assert checkpoint.state["messages"]["m0"]["summary"] == "done"
+
+
+def test_stops_at_the_deadline_with_a_partial_digest(checkpoint, ingest_calls):
+    complete = run_digest(None, "me", checkpoint, batch_size=3, concurrency=2, deadline=time.monotonic() - 1,
+                          by_priority=False, parse_workers=2)
+
+    assert not complete
+    assert checkpoint.summarized_ids() == set()
+
+
+def test_summaries_are_checkpointed_before_the_run_ends(checkpoint, monkeypatch):
+    seen_by_last_fetch = []
+
+    def fetch_messages_batch(service, user_id, batch_ids, need):
+        seen_by_last_fetch[:] = [len(checkpoint.summarized_ids())]
+        time.sleep(0.2)  # Earlier summaries finish while this batch is fetched
+        return {msg_id: {"id": msg_id, "payload": {}, "snippet": "text"} for msg_id in batch_ids}
+
+    monkeypatch.setattr(digest, "fetch_messages_batch", fetch_messages_batch)
+    monkeypatch.setattr(digest, "summarize_message", lambda msg: {"id": msg["id"], "summary": "s"})
+
+    assert run_digest(None, "me", checkpoint, batch_size=3, concurrency=2, deadline=None,
+                      by_priority=False, parse_workers=0)
+    assert seen_by_last_fetch[0] > 0
+    assert checkpoint.summarized_ids() == set(IDS)
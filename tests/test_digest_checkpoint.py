@@ -0,0 +1,62 @@
+import json
+import os
+
+from digest import DigestCheckpoint
+
+QUERY = "label:inbox newer_than:1d"
+
+
+def make_checkpoint(tmp_path, query=QUERY):
+    return DigestCheckpoint(str(tmp_path / "checkpoint.json"), query, "me")
+
+
+def test_record_message_appends_to_the_journal_without_rewriting_the_file(tmp_path):
+    checkpoint = make_checkpoint(tmp_path)
+    checkpoint.add_page(["a", "b"], None)
+    saved = os.path.getmtime(checkpoint.path), os.path.getsize(checkpoint.path)
+
+    checkpoint.record_message("a", {"id": "a", "summary": "first"})
+    checkpoint.record_message("b", {"id": "b", "summary": "second"})
+
+    assert (os.path.getmtime(checkpoint.path), os.path.getsize(checkpoint.path)) == saved
+    with open(checkpoint.journal_path, encoding="utf-8") as journal:
+        assert [json.loads(line)["id"] for line in journal] == ["a", "b"]
+
+
+def test_save_folds_the_journal_into_the_file(tmp_path):
+    checkpoint = make_checkpoint(tmp_path)
+    checkpoint.add_page(["a"], None)
+    checkpoint.record_message("a", {"id": "a", "summary": "first"})
+    checkpoint.save()
+
+    assert not os.path.exists(checkpoint.journal_path)
+    with open(checkpoint.path, encoding="utf-8") as checkpoint_file:
+        assert json.load(checkpoint_file)["messages"]["a"]["summary"] == "first"
+
+
+def test_resume_replays_the_journal_after_a_crash(tmp_path):
+    checkpoint = make_checkpoint(tmp_path)
+    checkpoint.add_page(["a", "b", "c"], None)
+    checkpoint.record_message("a", {"id": "a", "summary": "first"})
+    checkpoint.record_message("b", {"id": "b", "error": "Gemini unavailable"})
+    with open(checkpoint.journal_path, "a", encoding="utf-8") as journal:
+        journal.write('{"id": "c", "rec')  # Torn write
+
+    resumed = make_checkpoint(tmp_path)
+
+    assert resumed.summarized_ids() == {"a"}
+    assert resumed.state["messages"]["b"]["error"] == "Gemini unavailable"
+    assert "c" not in resumed.state["messages"]
+    # Replayed records are compacted straight away, so new appends start a clean journal.
+    assert not os.path.exists(resumed.journal_path)
+
+
+def test_journal_of_a_different_query_is_discarded(tmp_path):
+    checkpoint = make_checkpoint(tmp_path)
+    checkpoint.add_page(["a"], None)
+    checkpoint.record_message("a", {"id": "a", "summary": "first"})
+
+    restarted = make_checkpoint(tmp_path, query="label:inbox newer_than:2d")
+
+    assert restarted.state["messages"] == {}
+    assert not os.path.exists(restarted.journal_path)
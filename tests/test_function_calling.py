@@ -0,0 +1,130 @@
+from types import SimpleNamespace
+
+from multi_tool_agent.function_calling import (
+    _parse_docstring,
+    build_function_declaration,
+    build_tool,
+    extract_function_calls,
+)
+from multi_tool_agent.gmail_agent_logic import list_recent_emails, search_emails
+
+
+def schedule_meeting(user_id: str, title: str, attendees: int, hours: float, remote: bool = False, notes="") -> dict:
+    """Schedules a meeting on the user's calendar.
+       Sends invitations to the attendees.
+
+    Args:
+        user_id: The user's email address or 'me'.
+        title: The meeting title.
+        attendees: How many people are invited. Counts the organizer
+            as well.
+        hours (float): The meeting length.
+        remote: Whether the meeting is online.
+        notes: Free-form notes.
+
+    Returns:
+        A dictionary containing the 'status'.
+    """
+
+
+def ping() -> dict:
+    """Checks that the service is up."""
+
+
+def test_parse_docstring_splits_description_and_arguments():
+    description, arg_docs = _parse_docstring(schedule_meeting.__doc__)
+
+    assert description == "Schedules a meeting on the user's calendar. Sends invitations to the attendees."
+    assert arg_docs["attendees"] == "How many people are invited. Counts the organizer as well."
+    assert arg_docs["hours"] == "The meeting length."
+    assert "Returns" not in " ".join(arg_docs.values())
+
+
+def test_declaration_maps_types_and_marks_defaults_optional():
+    declaration = build_function_declaration(schedule_meeting)
+    properties = declaration["parameters"]["properties"]
+
+    assert declaration["name"] == "schedule_meeting"
+    assert {name: prop["type"] for name, prop in properties.items()} == {
+        "title": "STRING",
+        "attendees": "INTEGER",
+        "hours": "NUMBER",
+        "remote": "BOOLEAN",
+        "notes": "STRING",  # Unannotated parameters default to strings
+    }
+    assert declaration["parameters"]["required"] == ["title", "attendees", "hours"]
+    assert properties["remote"]["description"] == "Whether the meeting is online."
+
+
+def test_declaration_hides_user_id():
+    declaration = build_function_declaration(list_recent_emails)
+
+    assert list(declaration["parameters"]["properties"]) == ["max_results"]
+    assert declaration["parameters"]["required"] == ["max_results"]
+    assert "user_id" not in build_function_declaration(schedule_meeting)["parameters"]["properties"]
+
+
+def test_declaration_reads_through_tool_decorators():
+    declaration = build_function_declaration(search_emails)
+
+    assert declaration["name"] == "search_emails"
+    assert list(declaration["parameters"]["properties"]) == ["query"]
+
+
+def test_a_function_without_parameters_has_no_parameter_schema():
+    assert build_function_declaration(ping) == {"name": "ping", "description": "Checks that the service is up."}
+
+
+def test_build_tool_appends_ready_made_declarations():
+    extra = {"name": "send_drafted_reply", "description": "Sends the draft."}
+
+    tool = build_tool([ping, schedule_meeting], declarations=[extra])
+
+    assert [d["name"] for d in tool["function_declarations"]] == ["ping", "schedule_meeting", "send_drafted_reply"]
+
+
+def call_part(name, args):
+    return SimpleNamespace(function_call=SimpleNamespace(name=name, args=args), text="")
+
+
+def text_part(text):
+    return SimpleNamespace(function_call=None, text=text)
+
+
+def response_with(*candidates):
+    return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=parts)) for parts in candidates])
+
+
+def test_extracts_several_calls_in_order_with_their_text():
+    response = response_with([
+        text_part("Checking both. "),
+        call_part("get_total_unread_count", {}),
+        call_part("list_recent_emails", {"max_results": 3.0}),
+        call_part("search_emails", {"query": "from:boss", "filters": {"limit": 2.0, "labels": ["INBOX"]}}),
+        text_part("Done."),
+    ])
+
+    calls, text = extract_function_calls(response)
+
+    assert calls == [
+        ("get_total_unread_count", {}),
+        ("list_recent_emails", {"max_results": 3}),
+        ("search_emails", {"query": "from:boss", "filters": {"limit": 2, "labels": ["INBOX"]}}),
+    ]
+    assert isinstance(calls[1][1]["max_results"], int)
+    assert text == "Checking both. Done."
+
+
+def test_extracts_only_the_first_candidate_and_skips_nameless_calls():
+    response = response_with(
+        [call_part("", {}), text_part("Hello!")],
+        [call_part("get_total_unread_count", {})],
+    )
+
+    assert extract_function_calls(response) == ([], "Hello!")
+
+
+def test_keeps_fractional_numbers_and_missing_args():
+    response = response_with([call_part("schedule_meeting", {"hours": 1.5}), call_part("ping", None)])
+
+    assert extract_function_calls(response)[0] == [("schedule_meeting", {"hours": 1.5}), ("ping", {})]
@@ -0,0 +1,158 @@
+import pytest
+
+from multi_tool_agent import inbox_pager
+from multi_tool_agent.inbox_pager import InboxPager
+from multi_tool_agent.mail_watcher import (
+    LabelChangeEvent,
+    MailboxResyncEvent,
+    MessageDeletedEvent,
+    NewMessageEvent,
+)
+
+PAGE_SIZE = 2
+
+
+class FakeGmail:
+    """messages.list over a fixed list of IDs, with page tokens of the form 'p<index>'."""
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.list_calls = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def list(self, userId, maxResults, fields, labelIds=None, q=None, pageToken=None):
+        self.list_calls.append(pageToken)
+        index = int(pageToken[1:]) if pageToken else 0
+        start = index * maxResults
+        page = {"messages": [{"id": msg_id} for msg_id in self.ids[start:start + maxResults]],
+                "resultSizeEstimate": len(self.ids)}
+        if start + maxResults < len(self.ids):
+            page["nextPageToken"] = f"p{index + 1}"
+        return FakeRequest(page)
+
+
+class FakeRequest:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        return self.result
+
+
+@pytest.fixture
+def gmail(monkeypatch):
+    service = FakeGmail([f"m{i}" for i in range(7)])
+    metadata_fetches = []
+
+    def fetch_listing_details(service, user_id, ids):
+        metadata_fetches.append(list(ids))
+        return [{"id": msg_id, "labels": ["INBOX"]} for msg_id in ids]
+
+    monkeypatch.setattr(inbox_pager, "get_gmail_service", lambda user_id: service)
+    monkeypatch.setattr(inbox_pager, "fetch_listing_details", fetch_listing_details)
+    service.metadata_fetches = metadata_fetches
+    return service
+
+
+def settle(pager):
+    """Waits for background prefetches, so call counts are deterministic."""
+    while True:
+        with pager._lock:
+            pending = list(pager._pending.values())
+        if not pending:
+            return
+        for future in pending:
+            future.result()
+
+
+def browse_to(pager, index):
+    for page in range(index + 1):
+        assert pager.get_page(page)["status"] == "success"
+        settle(pager)
+
+
+def make_pager():
+    return InboxPager("me", page_size=PAGE_SIZE)
+
+
+def test_unrelated_label_change_only_reloads_that_pages_metadata(gmail):
+    pager = make_pager()
+    browse_to(pager, 2)
+    list_calls, fetches = len(gmail.list_calls), len(gmail.metadata_fetches)
+
+    pager.handle_mail_event(LabelChangeEvent("me", "m2", removed=["UNREAD"]))
+    assert [email["id"] for email in pager.get_page(1)["emails"]] == ["m2", "m3"]
+
+    assert len(gmail.list_calls) == list_calls
+    assert gmail.metadata_fetches[fetches:] == [["m2", "m3"]]
+    # Other pages are still served from the cache.
+    assert pager.get_page(0)["emails"] and len(gmail.metadata_fetches) == fetches + 1
+
+
+def test_label_change_on_an_unseen_message_is_ignored(gmail):
+    pager = make_pager()
+    browse_to(pager, 0)
+    fetches = len(gmail.metadata_fetches)
+    pager.handle_mail_event(LabelChangeEvent("me", "elsewhere", added=["STARRED"]))
+    pager.get_page(0)
+    assert len(gmail.metadata_fetches) == fetches
+
+
+def test_new_mail_outside_the_inbox_keeps_the_cache(gmail):
+    pager = make_pager()
+    browse_to(pager, 1)
+    list_calls = len(gmail.list_calls)
+    pager.handle_mail_event(NewMessageEvent("me", "sent-1", label_ids=["SENT"]))
+    pager.get_page(1)
+    assert len(gmail.list_calls) == list_calls
+
+
+def test_new_inbox_mail_relists_from_known_page_tokens(gmail):
+    pager = make_pager()
+    browse_to(pager, 2)
+    gmail.list_calls.clear()
+
+    pager.handle_mail_event(NewMessageEvent("me", "m-new", label_ids=["INBOX", "UNREAD"]))
+    pager.get_page(2)
+
+    # Page 2 is listed straight from its token rather than by walking from page 0.
+    assert gmail.list_calls[0] == "p2"
+
+
+def test_archiving_refreshes_the_listing(gmail):
+    pager = make_pager()
+    browse_to(pager, 0)
+    gmail.list_calls.clear()
+    pager.handle_mail_event(LabelChangeEvent("me", "m0", removed=["INBOX"]))
+    pager.get_page(0)
+    assert gmail.list_calls[0] is None
+
+
+def test_deletion_refreshes_only_when_the_message_is_listed(gmail):
+    pager = make_pager()
+    browse_to(pager, 0)
+    gmail.list_calls.clear()
+
+    pager.handle_mail_event(MessageDeletedEvent("me", "not-listed"))
+    pager.get_page(0)
+    assert gmail.list_calls == []
+
+    pager.handle_mail_event(MessageDeletedEvent("me", "m1"))
+    pager.get_page(0)
+    assert gmail.list_calls[0] is None
+
+
+def test_resync_forgets_every_cursor(gmail):
+    pager = make_pager()
+    browse_to(pager, 2)
+    gmail.list_calls.clear()
+
+    pager.handle_mail_event(MailboxResyncEvent("me"))
+    pager.get_page(2)
+
+    assert gmail.list_calls[:3] == [None, "p1", "p2"]
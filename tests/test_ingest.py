@@ -0,0 +1,156 @@
+import base64
+from email.message import EmailMessage
+from multiprocessing.shared_memory import SharedMemory
+
+import pytest
+
+from multi_tool_agent import ingest
+from multi_tool_agent.ingest import _pack_batch, create_parse_pool, ingest_messages
+from multi_tool_agent.mime_parse import parse_raw_message, parse_shared_chunk
+
+
+def plain_message():
+    message = EmailMessage()
+    message["Subject"] = "Quarterly report"
+    message["From"] = "Alice <alice@example.com>"
+    message["To"] = "me@example.com"
+    message["Date"] = "Mon, 19 Oct 2026 09:00:00 +0000"
+    message["Message-ID"] = "<report@example.com>"
+    message.set_content("The numbers are in.\nRevenue is up 4%.\n")
+    return message
+
+
+def message_with_attachment():
+    message = EmailMessage()
+    message["Subject"] = "Re: Photos"
+    message["From"] = "bob@example.com"
+    message["In-Reply-To"] = "<photos@example.com>"
+    message["References"] = "<photos@example.com>"
+    message.set_content("Attached.")
+    message.add_attachment(b"\x89PNG" + bytes(300), maintype="image", subtype="png", filename="beach.png")
+    return message
+
+
+def html_only_message():
+    message = EmailMessage()
+    message["Subject"] = "Newsletter"
+    message.set_content("<p>Hello <b>there</b></p>", subtype="html")
+    return message
+
+
+def gmail_raw(message, padded=True):
+    encoded = base64.urlsafe_b64encode(message.as_bytes()).decode("ascii")
+    return encoded if padded else encoded.rstrip("=")
+
+
+def fetched(msg_id, message, padded=True):
+    return {"id": msg_id, "threadId": f"t-{msg_id}", "labelIds": ["INBOX"], "internalDate": "1760864400000",
+            "sizeEstimate": 1234, "raw": gmail_raw(message, padded)}
+
+
+def test_parse_raw_message_normalizes_headers_body_and_attachments():
+    record = parse_raw_message(message_with_attachment().as_bytes(), {"id": "m2", "threadId": "t2"})
+
+    assert record["id"] == "m2" and record["thread_id"] == "t2"
+    assert record["subject"] == "Re: Photos" and record["in_reply_to"] == "<photos@example.com>"
+    assert record["body"].strip() == "Attached."
+    [attachment] = record["attachments"]
+    assert (attachment["filename"], attachment["mime_type"]) == ("beach.png", "image/png")
+    assert 304 <= attachment["size"] < 320  # Approximate: counts base64 line breaks
+
+
+def test_parse_raw_message_falls_back_to_html():
+    assert "<b>there</b>" in parse_raw_message(html_only_message().as_bytes())["body"]
+
+
+def test_messages_round_trip_through_shared_memory():
+    messages = [
+        fetched("m1", plain_message()),
+        fetched("m2", message_with_attachment(), padded=False),  # Padding is optional in base64url
+        fetched("m3", html_only_message()),
+    ]
+    shm, entries = _pack_batch(messages)
+    try:
+        assert [meta["id"] for _, _, meta in entries] == ["m1", "m2", "m3"]
+        assert sum(length for _, length, _ in entries) == sum(len(m["raw"]) for m in messages)
+        # Chunks parse independently, as they would in separate workers.
+        records = parse_shared_chunk(shm.name, entries[:2]) + parse_shared_chunk(shm.name, entries[2:])
+    finally:
+        shm.close()
+        shm.unlink()
+
+    assert [record["id"] for record in records] == ["m1", "m2", "m3"]
+    assert records[0]["subject"] == "Quarterly report"
+    assert records[0]["from"] == "Alice <alice@example.com>"
+    assert records[0]["body"] == "The numbers are in.\nRevenue is up 4%.\n"
+    assert records[0]["labels"] == ["INBOX"] and records[0]["internal_date"] == 1760864400000
+    assert records[1]["attachments"][0]["filename"] == "beach.png"
+    assert records[2]["subject"] == "Newsletter"
+
+
+def test_a_corrupt_message_yields_an_error_record():
+    shm, entries = _pack_batch([{"id": "bad", "raw": "!!!not base64!!!"}, fetched("m1", plain_message())])
+    try:
+        records = parse_shared_chunk(shm.name, entries)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    assert records[0]["id"] == "bad" and "error" in records[0]
+    assert records[1]["subject"] == "Quarterly report"
+
+
+class ListSink:
+    def __init__(self):
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def mailbox(monkeypatch):
+    messages = {f"m{i}": fetched(f"m{i}", plain_message()) for i in range(7)}
+    fetches = []
+
+    def fetch_messages_batch(service, user_id, batch_ids, need):
+        fetches.append(list(batch_ids))
+        return {msg_id: messages[msg_id] for msg_id in batch_ids if msg_id in messages}
+
+    monkeypatch.setattr(ingest, "fetch_messages_batch", fetch_messages_batch)
+    return fetches
+
+
+def test_ingest_streams_records_in_order_and_releases_shared_memory(mailbox, monkeypatch):
+    blocks = []
+    pack_batch = ingest._pack_batch
+
+    def tracking_pack_batch(messages):
+        shm, entries = pack_batch(messages)
+        blocks.append(shm.name)
+        return shm, entries
+
+    monkeypatch.setattr(ingest, "_pack_batch", tracking_pack_batch)
+    sink = ListSink()
+    ids = [f"m{i}" for i in range(7)] + ["deleted"]
+
+    with create_parse_pool(2) as pool:
+        written = ingest_messages(None, "me", ids, sink, batch_size=3, pool=pool)
+
+    assert written == 7
+    assert [record["id"] for record in sink.records] == [f"m{i}" for i in range(7)]
+    assert mailbox == [["m0", "m1", "m2"], ["m3", "m4", "m5"], ["m6", "deleted"]]
+    for name in blocks:
+        with pytest.raises(FileNotFoundError):
+            SharedMemory(name=name)
+
+
+def test_ingest_stops_fetching_when_asked(mailbox):
+    sink = ListSink()
+
+    with create_parse_pool(1) as pool:
+        ingest_messages(None, "me", [f"m{i}" for i in range(7)], sink, batch_size=3, pool=pool,
+                        stop=lambda: len(mailbox) >= 2)
+
+    assert len(mailbox) == 2
+    assert [record["id"] for record in sink.records] == [f"m{i}" for i in range(6)]
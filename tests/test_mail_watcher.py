@@ -0,0 +1,187 @@
+import base64
+import json
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from multi_tool_agent import mail_watcher
+from multi_tool_agent.mail_watcher import (
+    PUSH_MAX_POLL_SECONDS,
+    EventBus,
+    LabelChangeEvent,
+    MailboxResyncEvent,
+    MailEvent,
+    MailWatcher,
+    MessageDeletedEvent,
+    NewMessageEvent,
+    events_from_history,
+    get_mail_watcher,
+    handle_push_notification,
+    load_history_id,
+)
+
+
+def test_events_from_history_keeps_mailbox_order():
+    records = [
+        {"id": "101", "messagesAdded": [{"message": {"id": "m1", "threadId": "t1", "labelIds": ["INBOX", "UNREAD"]}}]},
+        {"id": "102", "labelsRemoved": [{"message": {"id": "m1", "threadId": "t1"}, "labelIds": ["UNREAD"]}],
+         "labelsAdded": [{"message": {"id": "m2", "threadId": "t2"}, "labelIds": ["STARRED"]}]},
+        {"id": "103", "messagesDeleted": [{"message": {"id": "m3", "threadId": "t3"}}]},
+    ]
+
+    events = events_from_history("me", records)
+
+    assert [(type(event), event.message_id, event.history_id) for event in events] == [
+        (NewMessageEvent, "m1", "101"),
+        (LabelChangeEvent, "m2", "102"),
+        (LabelChangeEvent, "m1", "102"),
+        (MessageDeletedEvent, "m3", "103"),
+    ]
+    assert events[0].label_ids == ["INBOX", "UNREAD"] and events[0].thread_id == "t1"
+    assert (events[1].added, events[1].removed) == (["STARRED"], [])
+    assert (events[2].added, events[2].removed) == ([], ["UNREAD"])
+
+
+class FakeRequest:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+class FakeGmail:
+    """Answers getProfile and history().list from canned pages."""
+
+    def __init__(self, pages=(), history_id="500"):
+        self.pages = list(pages)
+        self.history_id = history_id
+        self.list_calls = []
+
+    def users(self):
+        return self
+
+    def history(self):
+        return self
+
+    def getProfile(self, userId, fields=None):
+        return FakeRequest({"historyId": self.history_id})
+
+    def list(self, **kwargs):
+        self.list_calls.append(kwargs)
+        return FakeRequest(self.pages.pop(0))
+
+
+@pytest.fixture
+def gmail(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # The watch state file is relative to the working directory
+    service = FakeGmail()
+    monkeypatch.setattr(mail_watcher, "get_gmail_service", lambda user_id: service)
+    return service
+
+
+@pytest.fixture
+def published():
+    bus = EventBus()
+    events = []
+    bus.subscribe(MailEvent, events.append)
+    return bus, events
+
+
+def test_first_poll_only_seeds_the_history_id(gmail, published):
+    bus, events = published
+    watcher = MailWatcher("me", bus=bus)
+
+    assert watcher.poll_once() == 0
+
+    assert events == [] and gmail.list_calls == []
+    assert load_history_id("me") == "500"
+
+
+def test_poll_follows_pages_publishes_events_and_saves_the_new_history_id(gmail, published):
+    bus, events = published
+    watcher = MailWatcher("me", bus=bus)
+    watcher._history_id = "400"
+    gmail.pages = [
+        {"history": [{"id": "401", "messagesAdded": [{"message": {"id": "m1"}}]}], "nextPageToken": "p2"},
+        {"history": [{"id": "402", "messagesDeleted": [{"message": {"id": "m0"}}]}], "historyId": "402"},
+    ]
+
+    assert watcher.poll_once() == 2
+
+    assert [type(event) for event in events] == [NewMessageEvent, MessageDeletedEvent]
+    assert [call["pageToken"] for call in gmail.list_calls] == [None, "p2"]
+    assert all(call["startHistoryId"] == "400" for call in gmail.list_calls)
+    assert load_history_id("me") == "402"
+
+
+def test_an_expired_history_id_resyncs_from_the_profile(gmail, published):
+    bus, events = published
+    watcher = MailWatcher("me", bus=bus)
+    watcher._history_id = "1"
+    gmail.pages = [HttpError(httplib2.Response({"status": 404}), b'{"error": {"code": 404}}')]
+
+    assert watcher.poll_once() == 1
+
+    [event] = events
+    assert isinstance(event, MailboxResyncEvent) and event.history_id == "500"
+    assert load_history_id("me") == "500"
+
+
+def test_other_history_errors_are_raised(gmail, published):
+    watcher = MailWatcher("me", bus=published[0])
+    watcher._history_id = "1"
+    gmail.pages = [HttpError(httplib2.Response({"status": 500}), b"")]
+
+    with pytest.raises(HttpError):
+        watcher.poll_once()
+
+
+def test_poll_interval_resets_on_change_and_backs_off_while_quiet(gmail):
+    watcher = MailWatcher("me", min_interval=5, max_interval=20)
+
+    intervals = []
+    for changed in [False, False, False, False, True, False]:
+        watcher.interval = watcher._next_interval(changed)
+        intervals.append(watcher.interval)
+
+    assert intervals == [7.5, 11.25, 16.875, 20, 5, 7.5]
+
+    watcher.push_enabled = True  # Polling is only a safety net now
+    watcher.interval = 500
+    assert watcher._next_interval(False) == PUSH_MAX_POLL_SECONDS
+
+
+@pytest.fixture
+def watchers(monkeypatch):
+    monkeypatch.setattr(mail_watcher, "_watchers", {})
+    return mail_watcher._watchers
+
+
+def pubsub_envelope(payload):
+    data = base64.b64encode(json.dumps(payload).encode()).decode().rstrip("=")  # Padding may be dropped
+    return {"message": {"data": data, "messageId": "1"}, "subscription": "projects/p/subscriptions/s"}
+
+
+def test_push_notification_wakes_the_matching_watcher(gmail, watchers):
+    watcher = get_mail_watcher("a@example.com")
+    watcher.interval = 60
+
+    assert handle_push_notification(pubsub_envelope({"emailAddress": "a@example.com", "historyId": 600}))
+
+    assert watcher._wake.is_set() and watcher.push_enabled
+    assert watcher.interval == watcher.min_interval
+    assert not handle_push_notification({"emailAddress": "b@example.com", "historyId": 600})
+
+
+def test_push_notification_falls_back_to_a_lone_me_watcher(gmail, watchers):
+    watcher = get_mail_watcher("me")
+
+    assert handle_push_notification({"emailAddress": "me@example.com", "historyId": 600})
+    assert watcher._wake.is_set()
+
+    get_mail_watcher("a@example.com")
+    assert not handle_push_notification({"emailAddress": "me@example.com", "historyId": 601})
@@ -0,0 +1,277 @@
+import base64
+import email
+import threading
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from multi_tool_agent import gmail_agent_logic, outbox
+from multi_tool_agent.outbox import (
+    OUTBOX_ID_HEADER,
+    STATUS_FAILED,
+    STATUS_SENDING,
+    STATUS_SENT,
+    Outbox,
+    make_outbox_id,
+)
+
+REPLY = {
+    "user_id": "me",
+    "to": "alice@example.com",
+    "sender": "me@example.com",
+    "subject": "Lunch",
+    "reply_body": "Sounds good, see you at noon.",
+    "thread_id": "thread-1",
+    "original_message_id": "<orig@example.com>",
+    "references": "",
+}
+
+
+def http_error(status):
+    return HttpError(httplib2.Response({"status": status}), b"{}")
+
+
+class Request:
+    def __init__(self, run):
+        self._run = run
+
+    def execute(self):
+        return self._run()
+
+
+class FakeGmail:
+    """messages().send and threads().get over an in-memory mailbox.
+
+    errors holds what each send raises in turn (None to succeed); an error
+    listed in errors_after_delivery is raised after the message was stored,
+    like a connection dropping once Gmail has accepted the send.
+    """
+
+    def __init__(self, errors=(), errors_after_delivery=()):
+        self.errors = list(errors)
+        self.errors_after_delivery = list(errors_after_delivery)
+        self.threads_by_id = {}
+        self.sent = []
+        self.send_calls = 0
+        self.thread_lookups = 0
+        self._lock = threading.Lock()
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def threads(self):
+        return self
+
+    def send(self, userId, body, fields=None):
+        return Request(lambda: self._send(body))
+
+    def get(self, userId, id, format=None, metadataHeaders=None, fields=None):
+        return Request(lambda: self._get_thread(id))
+
+    def _send(self, body):
+        with self._lock:
+            self.send_calls += 1
+            error = self.errors.pop(0) if self.errors else None
+            if error is not None:
+                raise error
+            parsed = email.message_from_bytes(base64.urlsafe_b64decode(body["raw"]))
+            message = {
+                "id": f"sent-{len(self.sent) + 1}",
+                "payload": {"headers": [{"name": name, "value": value} for name, value in parsed.items()]},
+            }
+            self.sent.append(message)
+            self.threads_by_id.setdefault(body["threadId"], []).append(message)
+            if self.errors_after_delivery:
+                raise self.errors_after_delivery.pop(0)
+            return {"id": message["id"], "threadId": body["threadId"]}
+
+    def _get_thread(self, thread_id):
+        with self._lock:
+            self.thread_lookups += 1
+            return {"messages": list(self.threads_by_id.get(thread_id, []))}
+
+
+@pytest.fixture
+def gmail(monkeypatch):
+    service = FakeGmail()
+    monkeypatch.setattr(outbox, "get_gmail_service", lambda user_id: service)
+    monkeypatch.setattr(outbox, "RETRY_BASE_DELAY_SECONDS", 0.01)
+    return service
+
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return str(tmp_path / "outbox_journal.jsonl")
+
+
+def started(journal_path, **kwargs):
+    box = Outbox(journal_path, workers=2, **kwargs)
+    box.start()
+    return box
+
+
+def enqueue(box, **changes):
+    return box.enqueue(**{**REPLY, **changes})
+
+
+def test_sends_a_queued_reply_with_the_outbox_header(gmail, journal_path):
+    box = started(journal_path)
+    entry, duplicate = enqueue(box)
+
+    sent = box.wait(entry["outbox_id"], timeout=5)
+
+    assert not duplicate
+    assert sent["status"] == STATUS_SENT and sent["message_id"] == "sent-1"
+    headers = {h["name"]: h["value"] for h in gmail.sent[0]["payload"]["headers"]}
+    assert headers[OUTBOX_ID_HEADER] == make_outbox_id("thread-1", REPLY["reply_body"])
+    assert headers["In-Reply-To"] == "<orig@example.com>"
+
+
+def test_the_same_draft_in_the_same_thread_is_sent_once(gmail, journal_path):
+    box = started(journal_path)
+    first, _ = enqueue(box)
+    box.wait(first["outbox_id"], timeout=5)
+
+    again, duplicate = enqueue(box)
+    other, other_duplicate = enqueue(box, reply_body="Actually, make it one o'clock.")
+    box.wait(other["outbox_id"], timeout=5)
+
+    assert duplicate and again["outbox_id"] == first["outbox_id"]
+    assert not other_duplicate and other["outbox_id"] != first["outbox_id"]
+    assert len(gmail.sent) == 2
+
+
+def test_transient_errors_are_retried_with_a_sent_check(gmail, journal_path):
+    gmail.errors = [http_error(503), http_error(429), None]
+    box = started(journal_path)
+    entry, _ = enqueue(box)
+
+    sent = box.wait(entry["outbox_id"], timeout=5)
+
+    assert sent["status"] == STATUS_SENT and sent["attempts"] == 3
+    assert gmail.send_calls == 3 and len(gmail.sent) == 1
+    # The first attempt has nothing to check; each retry looks for an earlier delivery.
+    assert gmail.thread_lookups == 2
+
+
+def test_bad_requests_fail_without_retrying(gmail, journal_path):
+    gmail.errors = [http_error(400)]
+    box = started(journal_path)
+    entry, _ = enqueue(box)
+
+    failed = box.wait(entry["outbox_id"], timeout=5)
+
+    assert failed["status"] == STATUS_FAILED and failed["attempts"] == 1
+    assert gmail.send_calls == 1
+
+
+def test_gives_up_after_max_attempts(gmail, journal_path):
+    gmail.errors = [http_error(503)] * 3
+    box = started(journal_path, max_attempts=3)
+    entry, _ = enqueue(box)
+
+    failed = box.wait(entry["outbox_id"], timeout=5)
+
+    assert failed["status"] == STATUS_FAILED and failed["attempts"] == 3
+    assert "503" in failed["error"]
+
+
+def test_a_failed_reply_can_be_queued_again(gmail, journal_path):
+    gmail.errors = [http_error(400)]
+    box = started(journal_path)
+    entry, _ = enqueue(box)
+    box.wait(entry["outbox_id"], timeout=5)
+
+    retried, duplicate = enqueue(box)
+
+    assert not duplicate
+    assert box.wait(retried["outbox_id"], timeout=5)["status"] == STATUS_SENT
+
+
+def test_a_dropped_connection_after_delivery_does_not_send_twice(gmail, journal_path):
+    gmail.errors_after_delivery = [ConnectionResetError("connection reset")]
+    box = started(journal_path)
+    entry, _ = enqueue(box)
+
+    sent = box.wait(entry["outbox_id"], timeout=5)
+
+    assert sent["status"] == STATUS_SENT and sent["message_id"] == "sent-1"
+    assert len(gmail.sent) == 1 and gmail.send_calls == 1
+
+
+def test_a_crash_between_sending_and_journaling_does_not_send_twice(gmail, journal_path):
+    crashed = Outbox(journal_path, workers=1)
+    entry, _ = enqueue(crashed)
+    # What a sender thread does, up to the crash: journal the attempt, deliver,
+    # and die before journaling the result.
+    sending = crashed._next_ready()
+    crashed._deliver(sending)
+    crashed._journal.close()
+    assert len(gmail.sent) == 1
+
+    restarted = Outbox(journal_path, workers=1)
+    assert restarted.get_status(entry["outbox_id"])["status"] == STATUS_SENDING
+    restarted.start()
+    sent = restarted.wait(entry["outbox_id"], timeout=5)
+
+    assert sent["status"] == STATUS_SENT and sent["message_id"] == "sent-1"
+    assert len(gmail.sent) == 1 and gmail.send_calls == 1
+
+
+def test_replaying_the_journal_resumes_pending_replies(gmail, journal_path):
+    stopped = Outbox(journal_path, workers=1)
+    first, _ = enqueue(stopped)
+    second, _ = enqueue(stopped, thread_id="thread-2")
+    stopped._journal.close()
+    with open(journal_path, "a", encoding="utf-8") as journal:
+        journal.write('{"outbox_id": "torn')  # A write cut off by the crash.
+
+    restarted = started(journal_path)
+
+    assert restarted.wait(first["outbox_id"], timeout=5)["status"] == STATUS_SENT
+    assert restarted.wait(second["outbox_id"], timeout=5)["status"] == STATUS_SENT
+    assert sorted(m["id"] for m in gmail.sent) == ["sent-1", "sent-2"]
+    # Finished entries stay known, so the same draft is still suppressed.
+    assert enqueue(Outbox(journal_path, workers=1))[1] is True
+
+
+class IgnoreActions:
+    def record_action(self, email_details, action):
+        pass
+
+
+@pytest.fixture
+def module_outbox(monkeypatch, journal_path):
+    box = started(journal_path)
+    monkeypatch.setattr(outbox, "_outbox", box)
+    monkeypatch.setattr(outbox, "get_triage_scorer", lambda: IgnoreActions())
+    return box
+
+
+def test_send_reply_waits_for_the_sent_message(gmail, module_outbox):
+    result = gmail_agent_logic.send_reply(**REPLY)
+
+    assert result == {"status": "success", "message_id": "sent-1"}
+
+
+def test_send_reply_reports_a_failed_send(gmail, module_outbox):
+    gmail.errors = [http_error(400)]
+
+    result = gmail_agent_logic.send_reply(**REPLY)
+
+    assert result["status"] == "error" and "400" in result["error_message"]
+
+
+def test_send_reply_reports_a_reply_still_queued(gmail, module_outbox, monkeypatch):
+    gmail.errors = [http_error(503)] * 10
+    monkeypatch.setattr(outbox, "RETRY_BASE_DELAY_SECONDS", 60)
+    monkeypatch.setattr(outbox, "SEND_WAIT_SECONDS", 0.2)
+
+    result = gmail_agent_logic.send_reply(**REPLY)
+
+    assert result["status"] == "error"
+    assert result["outbox_id"] == make_outbox_id(REPLY["thread_id"], REPLY["reply_body"])
@@ -0,0 +1,79 @@
+import contextvars
+import threading
+import time
+
+from multi_tool_agent.planner import PlanStep, build_plan, execute_plan
+
+READS = {"summarize_last", "draft_reply", "send_reply"}
+WRITES = {"search", "summarize_last", "draft_reply"}
+
+
+def test_context_readers_depend_on_every_earlier_writer():
+    steps = build_plan(
+        [("unread_count", {}), ("search", {"query": "from:boss"}), ("summarize_last", {}), ("draft_reply", {})],
+        reads_context=READS, writes_context=WRITES,
+    )
+    assert [step.depends_on for step in steps] == [set(), set(), {1}, {1, 2}]
+
+
+def test_independent_steps_have_no_dependencies():
+    steps = build_plan([("unread_count", {}), ("today_count", {}), ("search", {})], READS, WRITES)
+    assert all(not step.depends_on for step in steps)
+
+
+def test_predicates_can_decide_on_arguments():
+    steps = build_plan(
+        [("search", {}), ("summarize", {"email_id": "123"}), ("summarize", {"email_id": ""})],
+        reads_context=lambda name, args: name == "summarize" and not args.get("email_id"),
+        writes_context=lambda name, args: name == "search",
+    )
+    assert [step.depends_on for step in steps] == [set(), set(), {0}]
+
+
+def test_dependent_steps_wait_and_outputs_keep_plan_order():
+    steps = build_plan([("search", {}), ("unread_count", {}), ("summarize_last", {})], READS, WRITES)
+    finished = []
+    lock = threading.Lock()
+
+    def run_step(step):
+        time.sleep({"search": 0.1, "unread_count": 0.01, "summarize_last": 0}[step.name])
+        with lock:
+            finished.append(step.name)
+        return step.name
+
+    assert execute_plan(steps, run_step) == ["search", "unread_count", "summarize_last"]
+    assert finished.index("summarize_last") > finished.index("search")
+    # The independent count finished first even though it was listed second.
+    assert finished[0] == "unread_count"
+
+
+def test_independent_steps_run_concurrently():
+    steps = build_plan([("a", {}), ("b", {}), ("c", {})])
+    barrier = threading.Barrier(3, timeout=2)
+    assert execute_plan(steps, lambda step: barrier.wait() is not None) == [True, True, True]
+
+
+def test_failing_step_returns_its_exception_and_dependents_still_run():
+    steps = build_plan([("search", {}), ("summarize_last", {})], READS, WRITES)
+
+    def run_step(step):
+        if step.name == "search":
+            raise ValueError("search failed")
+        return "ran"
+
+    outputs = execute_plan(steps, run_step)
+    assert isinstance(outputs[0], ValueError)
+    assert outputs[1] == "ran"
+
+
+def test_unresolvable_dependency_is_reported():
+    outputs = execute_plan([PlanStep(0, "a"), PlanStep(1, "b", depends_on=[5])], lambda step: step.name)
+    assert outputs[0] == "a"
+    assert isinstance(outputs[1], RuntimeError)
+
+
+def test_steps_run_in_the_callers_context():
+    turn = contextvars.ContextVar("turn", default=None)
+    turn.set("turn-1")
+    steps = build_plan([("a", {}), ("b", {})])
+    assert execute_plan(steps, lambda step: turn.get()) == ["turn-1", "turn-1"]
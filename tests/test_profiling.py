@@ -0,0 +1,74 @@
+import threading
+import time
+
+from multi_tool_agent.planner import PlanStep, execute_plan
+from multi_tool_agent.profiling import TurnProfiler, profile_turn, turn_task
+
+
+def spin(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def busy_foreign_turn(seconds):
+    spin(seconds)
+
+
+def turn_step_work(seconds):
+    spin(seconds)
+
+
+def sampled_functions(profiler):
+    return {frame.split(" (")[0] for folded in profiler.wall_stacks for frame in folded.split(";")}
+
+
+def profile(tmp_path, body):
+    with TurnProfiler("test", interval=0.002, output_dir=str(tmp_path)) as profiler:
+        body()
+    return profiler
+
+
+def test_a_busy_thread_from_another_turn_is_not_sampled(tmp_path):
+    stop = threading.Event()
+
+    def other_user():
+        while not stop.is_set():
+            busy_foreign_turn(0.01)
+
+    foreign = threading.Thread(target=other_user)
+    foreign.start()
+    try:
+        profiler = profile(tmp_path, lambda: spin(0.2))
+    finally:
+        stop.set()
+        foreign.join()
+
+    functions = sampled_functions(profiler)
+    assert "spin" in functions
+    assert "busy_foreign_turn" not in functions
+    assert "other_user" not in functions
+
+
+def test_plan_worker_threads_are_sampled_with_the_turn(tmp_path):
+    steps = [PlanStep(0, "a"), PlanStep(1, "b")]
+
+    profiler = profile(tmp_path, lambda: execute_plan(steps, lambda step: turn_step_work(0.1)))
+
+    assert "turn_step_work" in sampled_functions(profiler)
+
+
+def test_turn_task_leaves_functions_alone_outside_a_profiled_turn():
+    assert turn_task(spin) is spin
+
+
+def test_profile_turn_is_a_no_op_unless_selected():
+    assert not isinstance(profile_turn("turn"), TurnProfiler)
+    assert isinstance(profile_turn("turn", force=True), TurnProfiler)
+
+
+def test_writes_folded_stacks_and_a_report(tmp_path):
+    profiler = profile(tmp_path, lambda: spin(0.05))
+
+    assert [path.split("-test")[-1] for path in profiler.paths] == [".wall.folded", ".cpu.folded", ".top.txt"]
+    assert "Wall clock, top" in profiler.report()
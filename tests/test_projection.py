@@ -0,0 +1,114 @@
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from multi_tool_agent.projection import (
+    MESSAGE_PROJECTIONS,
+    NEED_ATTACHMENTS,
+    NEED_BODY,
+    NEED_HEADERS,
+    NEED_IDS,
+    NEED_LABELS,
+    NEED_RAW,
+    MeteredHttp,
+    WireMeter,
+    message_projection,
+)
+
+
+def test_each_need_uses_the_smallest_format_that_carries_it():
+    assert {need: fmt for need, (fmt, _) in MESSAGE_PROJECTIONS.items()} == {
+        NEED_IDS: "minimal",
+        NEED_LABELS: "minimal",
+        NEED_HEADERS: "metadata",
+        NEED_BODY: "full",
+        NEED_ATTACHMENTS: "full",
+        NEED_RAW: "raw",
+    }
+
+
+def test_masks_ask_only_for_what_each_need_reads():
+    fields = {need: mask for need, (_, mask) in MESSAGE_PROJECTIONS.items()}
+
+    assert all(mask.startswith("id,threadId") for mask in fields.values())
+    assert "labelIds" not in fields[NEED_IDS] and "labelIds" in fields[NEED_LABELS]
+    assert "payload/headers" in fields[NEED_HEADERS] and "body" not in fields[NEED_HEADERS]
+    assert "body/data" in fields[NEED_BODY]
+    assert fields[NEED_RAW].endswith(",raw") and "payload" not in fields[NEED_RAW]
+
+
+def test_message_projection_adds_metadata_headers_only_for_metadata():
+    assert message_projection(NEED_HEADERS, ["Subject", "From"]) == {
+        "format": "metadata", "fields": MESSAGE_PROJECTIONS[NEED_HEADERS][1], "metadataHeaders": ["Subject", "From"]}
+    assert "metadataHeaders" not in message_projection(NEED_BODY, ["Subject"])
+    assert "metadataHeaders" not in message_projection(NEED_HEADERS)
+    with pytest.raises(KeyError):
+        message_projection("everything")
+
+
+class FakeHttp:
+    def __init__(self, content=b"{}"):
+        self.content = content
+        self.timeout = 7
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        return {"status": "200"}, self.content
+
+
+def test_metered_http_counts_uri_body_and_content_per_method():
+    meter = WireMeter()
+    uri = "https://gmail.googleapis.com/gmail/v1/users/me/messages/m1"
+    http = MeteredHttp(FakeHttp(b"x" * 100), "gmail.users.messages.get", meter=meter)
+
+    http.request(uri)
+    http.request(uri, "POST", b"y" * 10)
+    MeteredHttp(FakeHttp(b"z" * 50), "gmail.users.messages.get", meter=meter).request(
+        "https://gmail.googleapis.com/batch/gmail/v1", "POST", b"b" * 20)
+    MeteredHttp(FakeHttp(), meter=meter).request(uri)
+
+    totals = meter.process.totals()
+    assert totals["gmail.users.messages.get"] == {"calls": 2, "bytes_sent": 2 * len(uri) + 10, "bytes_received": 200}
+    assert totals["gmail.users.messages.get (batch)"]["bytes_received"] == 50
+    assert totals["unknown"]["calls"] == 1
+    assert http.timeout == 7  # Other attributes pass through to the wrapped http
+
+
+def test_turn_tally_collects_calls_from_threads_started_with_the_turn_context():
+    meter = WireMeter()
+    other_turn_started, other_turn_done = threading.Event(), threading.Event()
+    other_tallies = []
+
+    def other_turn():
+        with meter.turn() as tally:
+            other_tallies.append(tally)
+            other_turn_started.set()
+            meter.record("gmail.users.getProfile", 10, 10)
+            other_turn_done.wait()
+
+    concurrent = threading.Thread(target=other_turn)
+    concurrent.start()
+    other_turn_started.wait()
+    try:
+        with meter.turn() as wire, ThreadPoolExecutor(max_workers=3) as executor:
+            for _ in range(6):
+                context = contextvars.copy_context()
+                executor.submit(context.run, meter.record, "gmail.users.messages.get", 10, 1024)
+            # Without the turn's context, a worker's call counts only for the process.
+            executor.submit(meter.record, "gmail.users.labels.get", 10, 100)
+    finally:
+        other_turn_done.set()
+        concurrent.join()
+
+    assert wire.totals() == {"gmail.users.messages.get": {"calls": 6, "bytes_sent": 60, "bytes_received": 6144}}
+    assert wire.summary() == "6 Gmail calls, 6.0 KB received (messages.get x6 6.0 KB)"
+    assert list(other_tallies[0].totals()) == ["gmail.users.getProfile"]
+    assert {method: counts["calls"] for method, counts in meter.process.totals().items()} == {
+        "gmail.users.getProfile": 1, "gmail.users.messages.get": 6, "gmail.users.labels.get": 1}
+
+
+def test_an_empty_turn_says_so():
+    with WireMeter().turn() as wire:
+        pass
+    assert wire.summary() == "no Gmail calls"
@@ -0,0 +1,230 @@
+import threading
+import time
+
+import pytest
+
+from multi_tool_agent import resilience
+from multi_tool_agent.resilience import (
+    STATE_CLOSED,
+    STATE_HALF_OPEN,
+    STATE_OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    DeadlineExceededError,
+    DependencyBusyError,
+    StaleCache,
+)
+from multi_tool_agent.shared_cache import DiskBackend, SharedCache
+
+
+class StatusError(Exception):
+    def __init__(self, code):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+
+def fail_with(code):
+    def call():
+        raise StatusError(code)
+    return call
+
+
+def make_breaker(**kwargs):
+    options = {"deadline_seconds": 1.0, "failure_threshold": 2, "reset_seconds": 0.1}
+    options.update(kwargs)
+    return CircuitBreaker("Test", **options)
+
+
+def test_opens_after_consecutive_failures_and_fails_fast():
+    breaker = make_breaker()
+    for _ in range(2):
+        with pytest.raises(StatusError):
+            breaker.call(fail_with(503))
+    assert breaker.state == STATE_OPEN
+
+    calls = []
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: calls.append(1))
+    assert calls == []
+
+
+def test_success_resets_the_failure_count():
+    breaker = make_breaker()
+    with pytest.raises(StatusError):
+        breaker.call(fail_with(503))
+    assert breaker.call(lambda: "ok") == "ok"
+    with pytest.raises(StatusError):
+        breaker.call(fail_with(503))
+    assert breaker.state == STATE_CLOSED
+
+
+def test_client_errors_do_not_count_as_dependency_failures():
+    breaker = make_breaker()
+    for _ in range(3):
+        with pytest.raises(StatusError):
+            breaker.call(fail_with(404))
+    assert breaker.state == STATE_CLOSED
+
+
+def test_is_failure_predicate_counts_returned_errors():
+    breaker = make_breaker()
+    for _ in range(2):
+        assert breaker.call(lambda: 503, is_failure=lambda status: status >= 500) == 503
+    assert breaker.state == STATE_OPEN
+
+
+def test_half_open_trial_success_closes_the_circuit():
+    breaker = make_breaker()
+    for _ in range(2):
+        with pytest.raises(StatusError):
+            breaker.call(fail_with(503))
+    time.sleep(0.15)
+    assert breaker.state == STATE_HALF_OPEN
+    assert breaker.call(lambda: "ok") == "ok"
+    assert breaker.state == STATE_CLOSED
+
+
+def test_half_open_trial_failure_reopens_the_circuit():
+    breaker = make_breaker()
+    for _ in range(2):
+        with pytest.raises(StatusError):
+            breaker.call(fail_with(503))
+    time.sleep(0.15)
+    with pytest.raises(StatusError):
+        breaker.call(fail_with(503))
+    assert breaker.state == STATE_OPEN
+
+
+def test_half_open_lets_only_one_trial_through():
+    breaker = make_breaker()
+    for _ in range(2):
+        with pytest.raises(StatusError):
+            breaker.call(fail_with(503))
+    time.sleep(0.15)
+    release = threading.Event()
+    trial = threading.Thread(target=breaker.call, args=(release.wait,))
+    trial.start()
+    time.sleep(0.05)
+    try:
+        with pytest.raises(CircuitOpenError):
+            breaker.call(lambda: "second")
+    finally:
+        release.set()
+        trial.join()
+    assert breaker.state == STATE_CLOSED
+
+
+def test_deadline_raises_and_counts_as_failure():
+    breaker = make_breaker(deadline_seconds=0.05, failure_threshold=1)
+    release = threading.Event()
+    with pytest.raises(DeadlineExceededError):
+        breaker.call(release.wait)
+    release.set()
+    assert breaker.state == STATE_OPEN
+
+
+def test_rejects_when_every_slot_is_taken_without_recording_a_failure():
+    breaker = make_breaker(deadline_seconds=0.05, failure_threshold=5, max_calls_in_flight=2)
+    release = threading.Event()
+    for _ in range(2):
+        with pytest.raises(DeadlineExceededError):
+            breaker.call(release.wait)
+
+    started = time.monotonic()
+    for _ in range(5):
+        with pytest.raises(DependencyBusyError):
+            breaker.call(lambda: "ok")
+    assert time.monotonic() - started < 0.05
+    # Only the two timed-out calls count; the rejections don't open the circuit.
+    assert breaker.state == STATE_CLOSED
+
+    release.set()
+    deadline = time.monotonic() + 1
+    while time.monotonic() < deadline:
+        try:
+            assert breaker.call(lambda: "ok") == "ok"
+            break
+        except DependencyBusyError:
+            time.sleep(0.01)
+    else:
+        pytest.fail("slots were not released when the timed-out calls returned")
+
+
+def test_breakers_do_not_share_threads():
+    busy = make_breaker(deadline_seconds=0.05, max_calls_in_flight=1, failure_threshold=5)
+    other = make_breaker(max_calls_in_flight=1)
+    release = threading.Event()
+    with pytest.raises(DeadlineExceededError):
+        busy.call(release.wait)
+    try:
+        with pytest.raises(DependencyBusyError):
+            busy.call(lambda: "ok")
+        assert other.call(lambda: "ok") == "ok"
+    finally:
+        release.set()
+
+
+class CountingBackend(DiskBackend):
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.writes = 0
+
+    def set(self, key, value, ttl=None):
+        self.writes += 1
+        super().set(key, value, ttl)
+
+
+@pytest.fixture
+def shared(tmp_path, monkeypatch):
+    shared = SharedCache(CountingBackend(str(tmp_path / "cache")))
+    monkeypatch.setattr(resilience, "get_shared_cache", lambda: shared)
+    return shared
+
+
+def test_stale_cache_writes_the_shared_tier_only_when_the_result_changes(shared, monkeypatch):
+    cache = StaleCache()
+    key = ("list_recent_emails", ("user_id", "'a@example.com'"))
+
+    for _ in range(3):
+        cache.put(key, {"status": "success", "emails": [1]}, "a@example.com")
+    assert shared.backend.writes == 1
+
+    cache.put(key, {"status": "success", "emails": [1, 2]}, "a@example.com")
+    assert shared.backend.writes == 2
+
+    # An unchanged result is rewritten once the shared copy is half its TTL old.
+    monkeypatch.setattr(resilience, "STALE_SHARED_REWRITE_SECONDS", 0)
+    cache.put(key, {"status": "success", "emails": [1, 2]}, "a@example.com")
+    assert shared.backend.writes == 3
+
+
+def test_stale_entries_are_shared_per_account_and_cleared_by_invalidate_user(shared):
+    key = ("list_recent_emails", ("user_id", "'a@example.com'"))
+    StaleCache().put(key, {"status": "success", "emails": [1]}, "a@example.com")
+
+    other_worker = StaleCache()
+    assert other_worker.get(key, "a@example.com")[0] == {"status": "success", "emails": [1]}
+    assert StaleCache().get(key, "b@example.com") is None
+
+    shared.invalidate_user("a@example.com")
+    other_worker.invalidate_user("a@example.com")
+
+    assert other_worker.get(key, "a@example.com") is None
+    assert StaleCache().get(key, "a@example.com") is None
+
+
+def test_serve_stale_on_error_keys_entries_by_the_user_id_argument(shared):
+    results = [{"status": "success", "count": 3}, {"status": "error", "error_message": "Gmail is down"}]
+
+    @resilience.serve_stale_on_error
+    def count_unread(user_id="me"):
+        return results.pop(0) if len(results) > 1 else results[0]  # The background refresh fails too
+
+    assert count_unread(user_id="a@example.com") == {"status": "success", "count": 3}
+    resilience.stale_cache.invalidate_user("a@example.com")  # Only the shared copy is left
+
+    stale = count_unread(user_id="a@example.com")
+
+    assert stale["stale"] and stale["count"] == 3 and stale["stale_reason"] == "Gmail is down"
+    assert shared.get("stale", "a@example.com", StaleCache._shared_key(
+        ("count_unread", ("user_id", "'a@example.com'")))) is not None
@@ -0,0 +1,66 @@
+import pytest
+
+from multi_tool_agent.routing import (
+    REPLY_AGENT,
+    ROUTE_AGENT,
+    ROUTE_TOOL,
+    SEARCH_AGENT,
+    SENDING_AGENT,
+    format_tool_result,
+    route_message,
+)
+
+
+def route_tuple(text):
+    route = route_message(text)
+    return None if route is None else (route.kind, route.name, route.args)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("how many unread emails do I have", (ROUTE_TOOL, "get_total_unread_count", {})),
+    ("Count my unread mail", (ROUTE_TOOL, "get_total_unread_count", {})),
+    ("how many emails did I get today", (ROUTE_TOOL, "get_emails_received_today_count", {})),
+    ("show my last 3 emails", (ROUTE_TOOL, "list_recent_emails", {"max_results": 3})),
+    ("list my latest emails", (ROUTE_TOOL, "list_recent_emails", {"max_results": 5})),
+    ("show emails from boss@company.com", (ROUTE_TOOL, "search_emails", {"query": "from:boss@company.com"})),
+    ("summarize email 18c2f0a1b2c3d4e5",
+     (ROUTE_TOOL, "summarize_email_with_gemini", {"email_id": "18c2f0a1b2c3d4e5"})),
+])
+def test_obvious_requests_call_a_tool_directly(text, expected):
+    assert route_tuple(text) == expected
+
+
+@pytest.mark.parametrize("text, agent", [
+    ("yes send it", SENDING_AGENT),
+    ("Okay, go ahead and send it please", SENDING_AGENT),
+    ("send", SENDING_AGENT),
+    ("draft a reply saying I'll be there", REPLY_AGENT),
+    ("find emails about the quarterly report", SEARCH_AGENT),
+])
+def test_obvious_requests_go_to_a_specialist(text, agent):
+    assert route_tuple(text) == (ROUTE_AGENT, agent, {})
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "   ",
+    "hello there",
+    "summarize the latest email",  # Needs a lookup first
+    "how many unread do I have, and show the last 5 from boss@company.com",
+    "list my last 5 emails and then summarize the first",
+    "show emails from boss@company.com about the budget",
+    "send the report to alice when it's ready",
+])
+def test_everything_else_goes_to_the_coordinator(text):
+    assert route_message(text) is None
+
+
+def test_format_tool_result_reports_errors():
+    result = {"status": "error", "error_message": "Gmail is down"}
+    assert format_tool_result("get_total_unread_count", result) == "Sorry, that didn't work: Gmail is down"
+
+
+def test_format_tool_result_lists_emails():
+    result = {"status": "success", "emails": [{"id": "1", "subject": "Hi", "from": "a@b.com", "date": "Mon"}]}
+    assert format_tool_result("search_emails", result) == "1. Hi — a@b.com (Mon) [id: 1]"
+    assert format_tool_result("search_emails", {"status": "success", "emails": []}) == "No emails found."
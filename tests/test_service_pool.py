@@ -0,0 +1,123 @@
+import json
+import threading
+import time
+
+import httplib2
+import pytest
+
+from multi_tool_agent import service_pool
+from multi_tool_agent.service_pool import QuotaTracker, ServicePool, _ThreadConnections
+
+
+def test_quota_charges_method_costs_and_counts_usage():
+    quota = QuotaTracker(units_per_second=250)
+
+    assert quota.charge("a@example.com", "gmail.users.messages.send") == 100
+    assert quota.charge("a@example.com", "gmail.users.threads.get") == 10
+    assert quota.charge("a@example.com", None) == 5  # Unknown methods
+    quota.charge("b@example.com", "gmail.users.getProfile")
+
+    assert quota.usage("a@example.com") == {
+        "gmail.users.messages.send": 100, "gmail.users.threads.get": 10, "unknown": 5}
+    assert quota.usage() == {"a@example.com": quota.usage("a@example.com"), "b@example.com": {"gmail.users.getProfile": 1}}
+
+
+def test_quota_blocks_until_the_bucket_refills():
+    quota = QuotaTracker(units_per_second=50)
+    started = time.monotonic()
+    for _ in range(5):
+        quota.charge("a@example.com", "gmail.users.threads.get")
+    assert time.monotonic() - started < 0.1
+
+    quota.charge("a@example.com", "gmail.users.threads.get")
+
+    assert time.monotonic() - started >= 0.15
+
+
+def test_quota_buckets_are_per_account():
+    quota = QuotaTracker(units_per_second=100)
+    quota.charge("a@example.com", "gmail.users.messages.send")
+    started = time.monotonic()
+
+    quota.charge("b@example.com", "gmail.users.messages.send")
+
+    assert time.monotonic() - started < 0.1
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = ServicePool(scopes=[], max_services=2, idle_evict_seconds=60)
+    monkeypatch.setattr(pool, "_load_credentials", lambda account: f"creds-{account}")
+    monkeypatch.setattr(pool, "_build_service", lambda account, creds: f"service-{account}")
+    monkeypatch.setattr(pool, "_start_refresher", lambda: None)
+    return pool
+
+
+def test_services_are_built_once_per_account(pool):
+    assert pool.get_service("a") == "service-a"
+    assert pool.get_service("a") is pool.get_service("a")
+    assert pool.get_credentials("a") == "creds-a"
+    assert pool.accounts() == ["a"]
+
+
+def test_least_recently_used_account_is_evicted_with_its_lock(pool):
+    pool.get_service("a")
+    pool.get_service("b")
+    pool.get_service("a")  # b is now the least recently used
+
+    pool.get_service("c")
+
+    assert pool.accounts() == ["a", "c"]
+    assert "b" not in pool._account_locks
+
+
+def test_idle_accounts_are_evicted(pool):
+    pool.get_service("a")
+    pool.get_service("b")
+    pool._accounts["a"].last_used -= 120
+
+    pool.evict_idle()
+
+    assert pool.accounts() == ["b"]
+    assert set(pool._account_locks) == {"b"}
+
+
+def test_connections_are_kept_per_thread_not_per_request():
+    opened = []
+    connections = _ThreadConnections(lambda: opened.append(threading.get_ident()) or FakeHttp())
+
+    for _ in range(3):
+        connections.request("https://example.com")
+    other = threading.Thread(target=lambda: connections.request("https://example.com"))
+    other.start()
+    other.join()
+
+    assert len(opened) == 2 and opened[0] != opened[1]
+
+
+class FakeHttp:
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        return httplib2.Response({"status": 200}), json.dumps({"emailAddress": "me@example.com"}).encode()
+
+
+def test_service_requests_reuse_their_thread_connection(monkeypatch):
+    opened_on, served_by = [], []
+
+    class FakeAuthorizedHttp(FakeHttp):
+        def __init__(self, credentials, http=None):
+            opened_on.append(threading.get_ident())
+
+        def request(self, *args, **kwargs):
+            served_by.append(threading.get_ident())
+            return super().request(*args, **kwargs)
+
+    monkeypatch.setattr(service_pool.google_auth_httplib2, "AuthorizedHttp", FakeAuthorizedHttp)
+    pool = ServicePool(scopes=[])
+    service = pool._build_service("me", creds=None)
+
+    for _ in range(5):
+        assert service.users().getProfile(userId="me").execute() == {"emailAddress": "me@example.com"}
+
+    # One connection per thread serving requests, however many requests it served.
+    assert all(opened_on.count(thread) == 1 for thread in set(served_by))
+    assert pool.quota.usage("me") == {"gmail.users.getProfile": 5}
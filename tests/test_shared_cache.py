@@ -0,0 +1,203 @@
+import threading
+import time
+
+import pytest
+
+from multi_tool_agent import shared_cache
+from multi_tool_agent.shared_cache import REDIS_DELETE_IF_SCRIPT, DiskBackend, RedisBackend, SharedCache
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return DiskBackend(str(tmp_path / "cache"))
+
+
+def test_disk_incr_is_atomic_across_workers(backend):
+    workers = [DiskBackend(backend.directory) for _ in range(8)]
+
+    def bump(worker):
+        for _ in range(25):
+            worker.incr("counter")
+
+    threads = [threading.Thread(target=bump, args=(worker,)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert int(backend.get("counter")) == 200
+
+
+def test_disk_incr_gives_up_without_touching_a_live_lock(backend, monkeypatch):
+    monkeypatch.setattr(shared_cache, "COUNTER_LOCK_SECONDS", 0.05)
+    assert backend.add("counter:lock", b"other-worker", ttl=60)
+
+    with pytest.raises(TimeoutError):
+        backend.incr("counter")
+
+    assert backend.get("counter:lock") == b"other-worker"
+    assert backend.get("counter") is None
+
+
+def test_disk_incr_takes_over_an_expired_lock(backend):
+    assert backend.add("counter:lock", b"dead-worker", ttl=0.01)
+    time.sleep(0.05)
+    assert backend.incr("counter") == 1
+    assert backend.get("counter:lock") is None
+
+
+def slow_fill(value, seconds, calls):
+    def fill():
+        calls.append(value)
+        time.sleep(seconds)
+        return value
+    return fill
+
+
+def test_waiters_wait_for_a_fill_as_long_as_its_deadline(backend, monkeypatch):
+    monkeypatch.setattr(shared_cache, "FILL_WAIT_MARGIN_SECONDS", 0.1)
+    filler, waiter = SharedCache(backend), SharedCache(DiskBackend(backend.directory))
+    calls = []
+    filling = threading.Thread(target=filler.get_or_fill,
+                               args=("summary", "me", ("m1",), slow_fill("filled", 0.4, calls), 60),
+                               kwargs={"fill_seconds": 0.5})
+    filling.start()
+    time.sleep(0.05)
+
+    value = waiter.get_or_fill("summary", "me", ("m1",), slow_fill("own", 0, calls), 60, fill_seconds=0.5)
+    filling.join()
+
+    assert value == "filled"
+    assert calls == ["filled"]
+    assert waiter.stats()["waited_hits"] == 1
+
+
+def test_waiters_fill_themselves_once_the_fill_deadline_passes(backend, monkeypatch):
+    monkeypatch.setattr(shared_cache, "FILL_WAIT_MARGIN_SECONDS", 0.05)
+    filler, waiter = SharedCache(backend), SharedCache(DiskBackend(backend.directory))
+    calls = []
+    filling = threading.Thread(target=filler.get_or_fill,
+                               args=("summary", "me", ("m1",), slow_fill("filled", 0.5, calls), 60),
+                               kwargs={"fill_seconds": 0.05})
+    filling.start()
+    time.sleep(0.05)
+
+    value = waiter.get_or_fill("summary", "me", ("m1",), slow_fill("own", 0, calls), 60, fill_seconds=0.05)
+    filling.join()
+
+    assert value == "own"
+    assert waiter.stats()["wait_timeouts"] == 1
+
+
+class FakeRedis:
+    """The subset of redis.Redis that RedisBackend uses, kept in a dict."""
+
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        self.ttls[key] = ex
+        return True
+
+    def pipeline(self, transaction=True):
+        client = self
+
+        class Pipeline:
+            def __init__(self):
+                self.calls = []
+
+            def set(self, *args, **kwargs):
+                self.calls.append((args, kwargs))
+
+            def execute(self):
+                return [client.set(*args, **kwargs) for args, kwargs in self.calls]
+
+        return Pipeline()
+
+    def delete(self, key):
+        return int(self.data.pop(key, None) is not None)
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode("ascii")
+        return int(self.data[key])
+
+    def eval(self, script, numkeys, *keys_and_args):
+        assert script == REDIS_DELETE_IF_SCRIPT and numkeys == 1
+        key, value = keys_and_args
+        return self.delete(key) if self.data.get(key) == value else 0
+
+
+@pytest.fixture
+def redis_client():
+    return FakeRedis()
+
+
+def test_redis_backend_stores_entries_with_their_ttl(redis_client):
+    cache = SharedCache(RedisBackend(redis_client))
+
+    cache.put("summary", "me", ("m1",), {"summary": "hi"}, ttl=60.5)
+    cache.put_many("metadata", "me", {("m2",): {"labels": ["INBOX"]}, ("m3",): {"labels": []}}, ttl=30)
+
+    assert cache.get("summary", "me", "m1") == {"summary": "hi"}
+    assert cache.get_many("metadata", "me", [("m2",), ("m3",), ("m4",)]) == {
+        ("m2",): {"labels": ["INBOX"]}, ("m3",): {"labels": []}}
+    assert redis_client.ttls[cache.key("summary", "me", "m1")] == 60
+    assert redis_client.ttls[cache.key("metadata", "me", "m2")] == 30
+
+
+def test_redis_backend_invalidate_user_bumps_the_generation(redis_client):
+    cache = SharedCache(RedisBackend(redis_client))
+    cache.put("summary", "me", ("m1",), "old", ttl=60)
+
+    cache.invalidate_user("me")
+
+    assert cache.get("summary", "me", "m1") is None
+    assert redis_client.get("gmail-agent:generation:me") == b"1"
+
+
+def test_redis_delete_if_only_deletes_a_matching_value(redis_client):
+    backend = RedisBackend(redis_client)
+    assert backend.add("lock", b"mine", ttl=30)
+    assert not backend.add("lock", b"theirs", ttl=30)
+
+    assert not backend.delete_if("lock", b"theirs")
+    assert backend.get("lock") == b"mine"
+    assert backend.delete_if("lock", b"mine")
+    assert backend.get("lock") is None
+
+
+@pytest.mark.parametrize("make_backend", [lambda tmp_path: RedisBackend(FakeRedis()),
+                                          lambda tmp_path: DiskBackend(str(tmp_path / "cache"))])
+def test_a_fill_does_not_release_a_lock_taken_over_by_another_worker(make_backend, tmp_path):
+    backend = make_backend(tmp_path)
+    cache = SharedCache(backend)
+    lock_key = f"{cache.key('summary', 'me', 'm1')}:filling"
+    seen = []
+
+    def fill():
+        seen.append(backend.get(lock_key))
+        # The fill outlived its lock, and another worker took the lock over.
+        backend.set(lock_key, b"other-worker", ttl=30)
+        return "filled"
+
+    assert cache.get_or_fill("summary", "me", ("m1",), fill, 60) == "filled"
+
+    assert seen[0].startswith(cache.worker_id.encode("ascii"))
+    assert backend.get(lock_key) == b"other-worker"
+
+
+def test_a_fill_releases_its_own_lock(redis_client):
+    cache = SharedCache(RedisBackend(redis_client))
+
+    cache.get_or_fill("summary", "me", ("m1",), lambda: "filled", 60)
+
+    assert [key for key in redis_client.data if key.endswith(":filling")] == []
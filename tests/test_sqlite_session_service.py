@@ -0,0 +1,107 @@
+import sqlite3
+import threading
+
+import pytest
+from google.adk.events import Event
+from google.genai import types
+
+from multi_tool_agent.sqlite_session_service import (
+    COMPACT_KEEP_RECENT,
+    COMPACT_THRESHOLD,
+    SNAPSHOT_AUTHOR,
+    SqliteSessionService,
+)
+
+APP = "test-app"
+USER = "user-1"
+
+
+@pytest.fixture
+def service(tmp_path):
+    return SqliteSessionService(db_path=str(tmp_path / "sessions.db"))
+
+
+def text_event(text):
+    return Event(author="user", invocation_id="inv", content=types.Content(role="user", parts=[types.Part(text=text)]))
+
+
+def append(service, session, count, start=0):
+    for i in range(start, start + count):
+        service.append_event(session, text_event(f"message {i}"))
+
+
+def event_count(service, session_id):
+    return service._connect().execute(
+        "SELECT COUNT(*) FROM events WHERE app_name = ? AND user_id = ? AND session_id = ?", (APP, USER, session_id)
+    ).fetchone()[0]
+
+
+def compacted_events(service, session_id):
+    row = service._connect().execute(
+        "SELECT compacted_events FROM snapshots WHERE app_name = ? AND user_id = ? AND session_id = ?",
+        (APP, USER, session_id),
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def test_no_compaction_below_threshold(service):
+    session = service.create_session(app_name=APP, user_id=USER, session_id="s")
+    append(service, session, COMPACT_THRESHOLD - 1)
+    assert event_count(service, "s") == COMPACT_THRESHOLD - 1
+    assert compacted_events(service, "s") == 0
+
+
+def test_compacts_at_threshold_down_to_recent_events(service):
+    session = service.create_session(app_name=APP, user_id=USER, session_id="s")
+    append(service, session, COMPACT_THRESHOLD)
+    assert event_count(service, "s") == COMPACT_KEEP_RECENT
+    assert compacted_events(service, "s") == COMPACT_THRESHOLD - COMPACT_KEEP_RECENT
+
+
+def test_does_not_compact_every_append_after_the_first_compaction(service):
+    session = service.create_session(app_name=APP, user_id=USER, session_id="s")
+    append(service, session, COMPACT_THRESHOLD)
+    append(service, session, 10, start=COMPACT_THRESHOLD)
+    assert event_count(service, "s") == COMPACT_KEEP_RECENT + 10
+    assert compacted_events(service, "s") == COMPACT_THRESHOLD - COMPACT_KEEP_RECENT
+
+
+def test_compacts_again_once_the_log_refills(service):
+    session = service.create_session(app_name=APP, user_id=USER, session_id="s")
+    refill = COMPACT_THRESHOLD - COMPACT_KEEP_RECENT
+    append(service, session, COMPACT_THRESHOLD + refill)
+    assert event_count(service, "s") == COMPACT_KEEP_RECENT
+    assert compacted_events(service, "s") == 2 * refill
+
+
+def test_get_session_leads_with_the_snapshot(service):
+    session = service.create_session(app_name=APP, user_id=USER, session_id="s")
+    append(service, session, COMPACT_THRESHOLD)
+    loaded = service.get_session(app_name=APP, user_id=USER, session_id="s")
+    assert loaded.events[0].author == SNAPSHOT_AUTHOR
+    snapshot_text = loaded.events[0].content.parts[0].text
+    assert f"{COMPACT_THRESHOLD - COMPACT_KEEP_RECENT} earlier events" in snapshot_text
+    assert f"message {COMPACT_THRESHOLD - COMPACT_KEEP_RECENT - 1}" in snapshot_text
+    assert loaded.events[-1].content.parts[0].text == f"message {COMPACT_THRESHOLD - 1}"
+    # Snapshot, then the events left in the log
+    assert len(loaded.events) == 1 + COMPACT_KEEP_RECENT
+
+
+def test_concurrent_appends_get_distinct_sequence_numbers(service):
+    service.create_session(app_name=APP, user_id=USER, session_id="s")
+    errors = []
+
+    def worker(worker_id):
+        session = service.get_session(app_name=APP, user_id=USER, session_id="s")
+        try:
+            append(service, session, 25, start=worker_id * 100)
+        except sqlite3.Error as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert event_count(service, "s") == 100
@@ -0,0 +1,106 @@
+from multi_tool_agent import triage
+from multi_tool_agent.triage import TriageScorer
+
+
+def listing(msg_id, labels=(), sender="someone@example.com"):
+    return {"id": msg_id, "threadId": f"t-{msg_id}", "from": sender, "subject": "Hello", "labels": list(labels)}
+
+
+def test_rank_orders_by_priority_and_keeps_recency():
+    scorer = TriageScorer(path=None)
+    newest_first = [
+        listing("newest", ["CATEGORY_PROMOTIONS"]),
+        listing("middle"),
+        listing("oldest", ["STARRED", "IMPORTANT"]),
+    ]
+
+    ranked = scorer.rank(newest_first, record_impressions=False)
+
+    assert [email["id"] for email in ranked] == ["oldest", "middle", "newest"]
+    assert {email["id"]: email["recency"] for email in ranked} == {"newest": 0, "middle": 1, "oldest": 2}
+    assert min(ranked, key=lambda email: email["recency"])["id"] == "newest"
+
+
+def test_rank_ties_keep_listing_order():
+    scorer = TriageScorer(path=None)
+    ranked = scorer.rank([listing("a"), listing("b"), listing("c")], record_impressions=False)
+    assert [email["id"] for email in ranked] == ["a", "b", "c"]
+
+
+def test_rank_does_not_modify_the_input():
+    scorer = TriageScorer(path=None)
+    emails = [listing("a")]
+    scorer.rank(emails, record_impressions=False)
+    assert "recency" not in emails[0] and "priority" not in emails[0]
+
+
+def test_replies_raise_and_trashing_lowers_a_senders_score():
+    scorer = TriageScorer(path=None)
+    friend, spammer = "friend@example.com", "deals@shop.example"
+    before = (scorer.score(listing("f0", sender=friend)), scorer.score(listing("s0", sender=spammer)))
+
+    for i in range(5):
+        scorer.record_action(listing(f"f{i}", sender=friend), "replied")
+        scorer.record_action(listing(f"s{i}", sender=spammer), "trashed")
+
+    assert scorer.score(listing("f9", sender=friend)) > before[0]
+    assert scorer.score(listing("s9", sender=spammer)) < before[1]
+    assert scorer.senders[friend] == [0, 5, 5]
+    assert "t-f0" in scorer.threads
+
+
+def test_actions_by_id_use_the_message_seen_in_a_ranking():
+    scorer = TriageScorer(path=None)
+    scorer.rank([listing("a", sender="boss@example.com")])
+    before = scorer.score(listing("b", sender="boss@example.com"))
+
+    scorer.record_action("a", "starred")
+    scorer.record_action("unknown-id", "starred")  # Never scored: nothing to learn from
+
+    assert scorer.score(listing("b", sender="boss@example.com")) > before
+
+
+def test_impressions_left_alone_are_learned_as_ignored(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(triage.time, "monotonic", lambda: clock[0])
+    scorer = TriageScorer(path=None)
+    scorer.rank([listing("shown", sender="list@example.com"), listing("opened", sender="pal@example.com")])
+    scorer.record_action("opened", "opened")
+    # The opened message was acted on, so it won't also count as ignored.
+    assert list(scorer._impressions) == ["shown"]
+    before = scorer.score(listing("next", sender="list@example.com"))
+
+    clock[0] += triage.IGNORE_AFTER_SECONDS
+    scorer.rank([listing("later")])
+
+    assert scorer.score(listing("next", sender="list@example.com")) < before
+    assert list(scorer._impressions) == ["later"]
+
+
+def test_learned_weights_and_sender_stats_are_capped(monkeypatch):
+    monkeypatch.setattr(triage, "MAX_LEARNED_WEIGHTS", 20)
+    monkeypatch.setattr(triage, "MAX_TRACKED_SENDERS", 3)
+    scorer = TriageScorer(path=None)
+
+    for i in range(50):
+        scorer.record_action(listing(f"m{i}", sender=f"person{i}@domain{i}.example"), "opened")
+
+    assert len(scorer.weights) == len(triage.PRIOR_WEIGHTS) + 20
+    assert all(name in scorer.weights for name in triage.PRIOR_WEIGHTS)
+    assert "sender:person49@domain49.example" in scorer.weights
+    assert "sender:person0@domain0.example" not in scorer.weights
+    assert list(scorer.senders) == [f"person{i}@domain{i}.example" for i in (47, 48, 49)]
+
+
+def test_a_saved_model_loads_within_the_caps(tmp_path, monkeypatch):
+    path = str(tmp_path / "triage.json")
+    scorer = TriageScorer(path=path)
+    for i in range(10):
+        scorer.record_action(listing(f"m{i}", sender=f"person{i}@example.com"), "opened")
+    scorer.save()
+    monkeypatch.setattr(triage, "MAX_TRACKED_SENDERS", 2)
+
+    loaded = TriageScorer(path=path)
+
+    assert list(loaded.senders) == ["person8@example.com", "person9@example.com"]
+    assert loaded.weights["sender:person9@example.com"] == scorer.weights["sender:person9@example.com"]